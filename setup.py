@@ -34,6 +34,12 @@ setup(
 		"console_scripts": [
 			"tinfoil = tinfoil.tinfoilcli:main",
 			"tinfoil-spd = tinfoil.speedtest:main",
+			"tinfoil-agent = tinfoil.agent:main",
+			"tinfoil-bench = tinfoil.benchmark:main",
+			"tinfoil-compact = tinfoil.compact:main",
+			"tinfoil-migrate = tinfoil.migrate:main",
+			"tinfoil-backup = tinfoil.backup:main",
+			"tinfoil-serve = tinfoil.serve:main",
 		]
     }
 )
@@ -0,0 +1,275 @@
+#!/bin/python3
+
+import os
+import sys
+import json
+import time
+import stat
+import ctypes
+import socket
+import struct
+import getpass
+import argparse
+import tempfile
+import socketserver
+
+from . import cachelib
+
+SOCKET_ENVIRONMENT_VARIABLE = "TINFOIL_AGENT_SOCK"
+
+DEFAULT_DATABASE = "tinfoil.db"
+DEFAULT_IDLE_TIMEOUT = 15 * 60 # seconds
+
+CLIENT_TIMEOUT = 30 # seconds
+REQUEST_TIMEOUT = 5 # seconds the agent waits on a quiet connection; requests are served one at a time, so an idle client holds up every other one
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+PR_SET_DUMPABLE = 4
+
+def runtime_path(filename):
+	"""Return the path of a per-user file, such as a socket, under XDG_RUNTIME_DIR or a tinfoil directory in the temporary directory"""
+	runtime_directory = os.environ.get("XDG_RUNTIME_DIR")
+	if not runtime_directory:
+		runtime_directory = os.path.join(tempfile.gettempdir(), "tinfoil-" + str(os.getuid()))
+	return os.path.join(runtime_directory, filename)
+
+def default_socket_path():
+	return runtime_path("tinfoil-agent.sock")
+
+def prepare_runtime_path(path):
+	"""Create the directory a socket or other private file goes in if needed, refusing one that other users can reach, and remove whatever a previous run left at the path"""
+	directory = os.path.dirname(path)
+	os.makedirs(directory, mode = 0o700, exist_ok = True)
+	if stat.S_IMODE(os.stat(directory).st_mode) & 0o077:
+		raise AssertionError("directory '" + directory + "' must not be accessible by other users!")
+	if os.path.exists(path):
+		os.unlink(path)
+
+def protect_process_memory():
+	"""Lock the process's pages into RAM and make it non-dumpable (best effort; returns False if locking was refused)"""
+	try:
+		libc = ctypes.CDLL(None, use_errno = True)
+	except OSError:
+		return False
+
+	if hasattr(libc, "prctl"):
+		libc.prctl(PR_SET_DUMPABLE, 0, 0, 0, 0) # no core dumps, no ptrace from other same-uid processes
+
+	if not hasattr(libc, "mlockall"):
+		return False
+	return (libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0)
+
+def peer_uid(connection):
+	if not hasattr(socket, "SO_PEERCRED"):
+		return None
+	credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+	pid, uid, gid = struct.unpack("3i", credentials)
+	return uid
+
+class _AgentRequestHandler(socketserver.StreamRequestHandler):
+	timeout = REQUEST_TIMEOUT
+
+	def handle(self):
+		uid = peer_uid(self.connection)
+		if (uid is not None) and (uid != os.getuid()):
+			return # only the agent's own user may talk to it
+
+		try:
+			for line in self.rfile:
+				try:
+					request = json.loads(line)
+					response = {"ok": True, "result": self.server.dispatch(request)}
+				except Exception as exception:
+					response = {"ok": False, "error": str(exception)}
+
+				self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+				self.wfile.flush()
+				self.server.last_activity = time.monotonic()
+		except OSError:
+			return # timed out or gone; the next client is served
+
+class AgentServer(socketserver.UnixStreamServer):
+	"""Serves get/set/check/del requests for an unlocked TinfoilDB over a Unix domain socket
+
+Requests are handled one at a time on the calling thread, so the SQLite connection never changes threads"""
+
+	def __init__(self, socket_path, database, idle_timeout = DEFAULT_IDLE_TIMEOUT, database_path = None):
+		self.database = database
+		self.database_path = database_path # the resolved location of the database, reported by ping
+		self.idle_timeout = idle_timeout
+		self.last_activity = time.monotonic()
+
+		prepare_runtime_path(socket_path)
+
+		old_umask = os.umask(0o177) # the socket is created 0600
+		try:
+			super().__init__(socket_path, _AgentRequestHandler)
+		finally:
+			os.umask(old_umask)
+		self.socket_path = socket_path
+		self.timeout = 1 # seconds between idle checks
+
+	def dispatch(self, request):
+		operation = request["op"]
+		if operation == "ping":
+			return self.database_path or True
+		elif operation == "get":
+			return self.database.retrieve_record(request["key"])
+		elif operation == "check":
+			return self.database.check_record(request["key"])
+		elif operation == "set":
+			return self.database.store_record(request["key"], request["value"])
+		elif operation == "del":
+			self.database.delete_record(request["key"])
+			return True
+		else:
+			raise AssertionError("unknown operation '" + str(operation) + "'!")
+
+	def run(self):
+		try:
+			while (time.monotonic() - self.last_activity) < self.idle_timeout:
+				self.handle_request()
+		finally:
+			self.shutdown_agent()
+
+	def shutdown_agent(self):
+		"""Forget the keys, close the database and remove the socket
+
+The master keys are overwritten first, but only as a best effort: the record crypter, the derived lookup and index keys
+and the derived master key hold immutable copies that Python cannot wipe, so they are only released"""
+		for key in (self.database.master_aes_key, self.database.master_hmac_key):
+			if isinstance(key, bytearray):
+				cachelib.wipe(key)
+		self.database.clear_master_keys()
+		self.database.close()
+
+		self.server_close()
+		if os.path.exists(self.socket_path):
+			os.unlink(self.socket_path)
+
+class AgentClient:
+	"""Talks to a running tinfoil-agent; mirrors the TinfoilDB record methods so it can stand in for an unlocked database
+
+Each request uses its own short-lived connection, so a long-running client never holds up the agent"""
+
+	def __init__(self, socket_path = None):
+		if socket_path is None:
+			socket_path = os.environ.get(SOCKET_ENVIRONMENT_VARIABLE) or default_socket_path()
+		self.socket_path = socket_path
+		self.database_path = None # the resolved location of the database the agent serves, once pinged
+
+	def _request(self, **request):
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+			connection.settimeout(CLIENT_TIMEOUT)
+			connection.connect(self.socket_path)
+			with connection.makefile("rwb") as stream:
+				stream.write(json.dumps(request).encode("utf-8") + b"\n")
+				stream.flush()
+				connection.shutdown(socket.SHUT_WR)
+				line = stream.readline()
+
+		if not line:
+			raise AssertionError("tinfoil-agent closed the connection!")
+
+		response = json.loads(line)
+		if not response["ok"]:
+			raise AssertionError("tinfoil-agent error: " + response["error"])
+		return response["result"]
+
+	def ping(self):
+		"""Return the resolved location of the database the agent serves (True from agents that do not report it)"""
+		result = self._request(op = "ping")
+		self.database_path = result if isinstance(result, str) else None
+		return result
+
+	def retrieve_record(self, key):
+		return self._request(op = "get", key = key)
+
+	def check_record(self, key):
+		return self._request(op = "check", key = key)
+
+	def store_record(self, key, value):
+		return self._request(op = "set", key = key, value = value)
+
+	def delete_record(self, key):
+		self._request(op = "del", key = key)
+
+	def close(self):
+		pass # the agent keeps running; nothing is held open between requests
+
+def connect_agent(socket_path = None):
+	"""Return an AgentClient for a live agent, or None if no agent is reachable"""
+	if socket_path is None:
+		socket_path = os.environ.get(SOCKET_ENVIRONMENT_VARIABLE)
+	if not socket_path:
+		return None
+
+	try:
+		client = AgentClient(socket_path)
+		client.ping()
+	except (OSError, AssertionError):
+		return None
+	return client
+
+def parse_arguments(arguments = None):
+	parser = argparse.ArgumentParser(prog = "tinfoil-agent", description = "unlock a tinfoil database once and serve it to later tinfoil invocations")
+	parser.add_argument("-d", "--database", default = DEFAULT_DATABASE, help = "database location (default: " + DEFAULT_DATABASE + ")")
+	parser.add_argument("-a", "--socket", default = None, help = "socket path (default: " + default_socket_path() + ")")
+	parser.add_argument("-t", "--timeout", type = int, default = DEFAULT_IDLE_TIMEOUT, help = "idle seconds before the agent forgets its keys and exits (default: " + str(DEFAULT_IDLE_TIMEOUT) + ")")
+	parser.add_argument("-f", "--foreground", action = "store_true", help = "do not fork into the background")
+	parser.add_argument("--cache-size", type = int, default = 0, help = "decrypted values to keep in memory, so fetching them again is faster (default: 0, no cache)")
+	parser.add_argument("--cache-ttl", type = int, default = cachelib.DEFAULT_CACHE_TTL, help = "seconds a decrypted value is kept (default: " + str(cachelib.DEFAULT_CACHE_TTL) + ")")
+	return parser.parse_args(arguments)
+
+def main():
+	# only the agent itself needs the database, so clients such as one-shot tinfoil commands never load cryptography
+	from . import cryptolib
+	from .tinfoillib import TinfoilDB
+
+	arguments = parse_arguments()
+	socket_path = arguments.socket or default_socket_path()
+
+	database = TinfoilDB(arguments.database)
+	if not database.check_database_initialized():
+		print("error: database is not initialized! run 'tinfoil' to set it up first")
+		sys.exit(1)
+
+	while True:
+		password = getpass.getpass("database master password: ")
+		if password:
+			master_key = cryptolib.do_scrypt_parallel(password = password, **database.get_kdf_parameters())
+			if database.set_derived_master_key(master_key): # kept, so the forked agent can unlock without deriving again
+				break
+		print("incorrect master password!")
+		print()
+
+	database.close()
+
+	server = AgentServer(socket_path, None, idle_timeout = arguments.timeout, database_path = os.path.realpath(arguments.database)) # bound before forking, so it is ready once the parent returns
+	print(SOCKET_ENVIRONMENT_VARIABLE + "=" + socket_path + "; export " + SOCKET_ENVIRONMENT_VARIABLE + ";")
+	sys.stdout.flush()
+
+	if not arguments.foreground:
+		if os.fork() != 0:
+			os._exit(0)
+		os.setsid()
+
+		devnull = os.open(os.devnull, os.O_RDWR)
+		for descriptor in (0, 1, 2):
+			os.dup2(devnull, descriptor)
+
+	if not protect_process_memory():
+		print("warning: could not lock agent memory; keys may be swapped to disk", file = sys.stderr)
+
+	database = TinfoilDB(arguments.database, session = True, cache_size = arguments.cache_size, cache_ttl = arguments.cache_ttl)
+	database.set_derived_master_key(master_key)
+	database.master_aes_key = bytearray(database.master_aes_key) # mutable copies, which shutdown_agent() overwrites; other copies are only released
+	database.master_hmac_key = bytearray(database.master_hmac_key)
+	del master_key
+
+	server.database = database
+	server.run()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,159 @@
+import asyncio
+import functools
+import concurrent.futures
+
+from . import cryptolib
+from .tinfoillib import TinfoilDB
+
+class AsyncTinfoilDB:
+	"""Asyncio front-end for TinfoilDB
+
+All SQLite work runs on one dedicated thread (the connection never leaves it), and the scrypt derivation in unlock() runs on kdf_executor
+kdf_executor defaults to a private thread pool (scrypt releases the GIL); pass a ProcessPoolExecutor to keep it off this process entirely
+Concurrent get() calls issued in the same event loop iteration are coalesced into one retrieve_records() query, and duplicate keys share a single lookup;
+if that query fails, such as on a tampered record, its keys are looked up again one at a time, so only the gets of the failing keys raise"""
+
+	def __init__(self, database_location, kdf_executor = None, **database_kwargs):
+		self._database_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "tinfoil-sqlite")
+		self._database_future = self._database_executor.submit(TinfoilDB, database_location, **database_kwargs)
+
+		self._owns_kdf_executor = (kdf_executor is None)
+		if kdf_executor is None:
+			kdf_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "tinfoil-kdf")
+		self._kdf_executor = kdf_executor
+
+		self._unlock_task = None
+		self._pending_gets = {} # key -> future, waiting for the next flush
+		self._inflight_gets = {} # key -> future, part of a query that is already running
+		self._flush_scheduled = False
+		self._get_tasks = set() # running _run_gets() tasks; the event loop only keeps weak references to tasks
+
+	def _call(self, function, *args, **kwargs):
+		"""Run function(database, *args, **kwargs) on the SQLite thread"""
+		def task():
+			return function(self._database_future.result(), *args, **kwargs)
+		return asyncio.get_running_loop().run_in_executor(self._database_executor, task)
+
+	async def _wait_for_unlock(self):
+		if self._unlock_task is not None:
+			await asyncio.wait({self._unlock_task}) # unlock failures are reported to the unlock() caller, not here
+
+	async def check_database_initialized(self):
+		return await self._call(TinfoilDB.check_database_initialized)
+
+	async def initialize(self, password, **parameters):
+		"""Initialize a new database (see TinfoilDB.initialize_database); the key derivation runs on the SQLite thread"""
+		await self._call(TinfoilDB.initialize_database, password, **parameters)
+
+	async def _unlock(self, password, previous_unlock):
+		if previous_unlock is not None:
+			await asyncio.wait({previous_unlock})
+
+		kdf_parameters = await self._call(TinfoilDB.get_kdf_parameters)
+
+		loop = asyncio.get_running_loop()
+		derive = functools.partial(cryptolib.do_scrypt_parallel, password = password, **kdf_parameters)
+		master_key = await loop.run_in_executor(self._kdf_executor, derive)
+
+		return await self._call(TinfoilDB.set_derived_master_key, master_key)
+
+	def _unlock_finished(self, task):
+		if self._unlock_task is task:
+			self._unlock_task = None
+
+	def unlock(self, password):
+		"""Derive the master keys without blocking the event loop; the returned awaitable gives False if the password is incorrect
+
+Must be called from a running event loop; data operations issued after this call wait for the unlock to finish"""
+		task = asyncio.ensure_future(self._unlock(password, self._unlock_task))
+		task.add_done_callback(self._unlock_finished)
+		self._unlock_task = task
+		return asyncio.shield(task)
+
+	async def get(self, key):
+		await self._wait_for_unlock()
+
+		future = self._inflight_gets.get(key) or self._pending_gets.get(key)
+		if future is None:
+			future = asyncio.get_running_loop().create_future()
+			self._pending_gets[key] = future
+			if not self._flush_scheduled:
+				self._flush_scheduled = True
+				asyncio.get_running_loop().call_soon(self._flush_gets)
+
+		return await asyncio.shield(future) # a cancelled caller must not cancel the shared lookup
+
+	def _flush_gets(self):
+		self._flush_scheduled = False
+		pending = self._pending_gets
+		self._pending_gets = {}
+		self._inflight_gets.update(pending)
+		task = asyncio.ensure_future(self._run_gets(pending))
+		self._get_tasks.add(task)
+		task.add_done_callback(self._get_tasks.discard)
+
+	async def _run_gets(self, pending):
+		try:
+			try:
+				results = await self._call(TinfoilDB.retrieve_records, list(pending))
+			except Exception as exception:
+				if len(pending) == 1:
+					results = {key: exception for key in pending}
+				else:
+					results = {key: await self._retrieve_alone(key) for key in pending}
+
+			for key, future in pending.items():
+				if future.done():
+					continue
+				if isinstance(results[key], Exception):
+					future.set_exception(results[key])
+				else:
+					future.set_result(results[key])
+		finally:
+			for key in pending:
+				self._inflight_gets.pop(key, None)
+
+	async def _retrieve_alone(self, key):
+		"""Return the value of one key, or the exception raised while retrieving it"""
+		try:
+			return await self._call(TinfoilDB.retrieve_record, key)
+		except Exception as exception:
+			return exception
+
+	async def check(self, key):
+		await self._wait_for_unlock()
+		return await self._call(TinfoilDB.check_record, key)
+
+	async def set(self, key, value):
+		await self._wait_for_unlock()
+		return await self._call(TinfoilDB.store_record, key, value)
+
+	async def delete(self, key):
+		await self._wait_for_unlock()
+		await self._call(TinfoilDB.delete_record, key)
+
+	async def get_many(self, keys):
+		await self._wait_for_unlock()
+		return await self._call(TinfoilDB.retrieve_records, list(keys))
+
+	async def set_many(self, mapping):
+		await self._wait_for_unlock()
+		return await self._call(TinfoilDB.store_records, dict(mapping))
+
+	async def delete_many(self, keys):
+		await self._wait_for_unlock()
+		return await self._call(TinfoilDB.delete_records, list(keys))
+
+	async def close(self):
+		await self._wait_for_unlock()
+		await self._call(TinfoilDB.close)
+
+		self._database_executor.shutdown(wait = True)
+		if self._owns_kdf_executor:
+			self._kdf_executor.shutdown(wait = True)
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, traceback):
+		await self.close()
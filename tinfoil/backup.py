@@ -0,0 +1,73 @@
+#!/bin/python3
+
+import sys
+import time
+import getpass
+import argparse
+
+from . import backuplib, storagelib
+
+DEFAULT_DATABASE = "tinfoil.db"
+
+def parse_arguments(arguments = None):
+	parser = argparse.ArgumentParser(prog = "tinfoil-backup", description = "take full or incremental snapshots of a tinfoil database while it is in use, and restore them")
+	commands = parser.add_subparsers(dest = "command", required = True)
+
+	create = commands.add_parser("create", help = "snapshot a database into a backup directory; only what changed since the last snapshot is stored, unless --full is given")
+	create.add_argument("directory", help = "backup directory; created if missing")
+	create.add_argument("database", nargs = "?", default = DEFAULT_DATABASE, help = "database location (default: " + DEFAULT_DATABASE + ")")
+	create.add_argument("--full", action = "store_true", help = "store every record, starting a new chain of incremental snapshots")
+	create.add_argument("--pages", type = int, default = storagelib.DEFAULT_COPY_PAGES_PER_STEP, help = "SQLite pages copied per step, between which a live session may write (default: " + str(storagelib.DEFAULT_COPY_PAGES_PER_STEP) + ")")
+	create.add_argument("--pause", type = float, default = storagelib.DEFAULT_COPY_PAUSE, help = "seconds to pause between steps (default: " + str(storagelib.DEFAULT_COPY_PAUSE) + ")")
+
+	commands.add_parser("list", help = "list the snapshots in a backup directory").add_argument("directory", help = "backup directory")
+
+	restore = commands.add_parser("restore", help = "rebuild the database as it was at a snapshot into a new file, and verify it")
+	restore.add_argument("directory", help = "backup directory")
+	restore.add_argument("destination", help = "where to write the restored database; must not exist")
+	restore.add_argument("-s", "--sequence", type = int, default = None, help = "snapshot to restore (default: the latest)")
+	restore.add_argument("-e", "--engine", choices = list(storagelib.ENGINES), default = None, help = "storage engine of the restored database (default: the backed up database's)")
+	restore.add_argument("-w", "--workers", type = int, default = None, help = "processes checking records (default: one per core)")
+	restore.add_argument("--no-password", action = "store_true", help = "only check that every record and stream is present, without decrypting them")
+	return parser.parse_args(arguments)
+
+def do_create(arguments):
+	def report(done, total):
+		print("\rcopying... " + str((100 * done) // max(total, 1)) + "%", end = "", file = sys.stderr, flush = True)
+
+	info = backuplib.create_snapshot(arguments.database, arguments.directory, full = arguments.full, pages_per_step = arguments.pages, pause = arguments.pause, report = report)
+	print(file = sys.stderr)
+	print("snapshot " + str(info["sequence"]) + " (" + info["kind"] + "): " + str(info["changed_records"]) + " records and " + str(info["changed_streams"]) + " streams stored, " + str(info["deleted_records"] + info["deleted_streams"]) + " deletions, in " + str(round(info["seconds"], 2)) + "s")
+
+def do_list(arguments):
+	for sequence, kind, path in backuplib.list_snapshots(arguments.directory):
+		info = backuplib.read_snapshot_info(path)
+		created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info["created"]))
+		print(str(sequence).rjust(6) + "  " + kind + "  " + created + "  " + str(info["records"]) + " records, " + str(info["streams"]) + " streams (" + str(info["changed_records"]) + " stored, " + str(info["deleted_records"]) + " deleted)")
+
+def do_restore(arguments):
+	password = None
+	if not arguments.no_password:
+		password = getpass.getpass("database master password (at the time of the snapshot): ")
+
+	info = backuplib.restore_snapshot(arguments.directory, arguments.destination, sequence = arguments.sequence, engine = arguments.engine, password = password, workers = arguments.workers)
+	checked = "verified" if password is not None else "verified without decrypting"
+	print("restored snapshot " + str(info["sequence"]) + " into '" + arguments.destination + "' (" + str(info["records"]) + " records, " + str(info["streams"]) + " streams; " + checked + ") in " + str(round(info["seconds"], 2)) + "s")
+
+COMMANDS = {
+	"create": do_create,
+	"list": do_list,
+	"restore": do_restore,
+}
+
+def main():
+	arguments = parse_arguments()
+	try:
+		COMMANDS[arguments.command](arguments)
+	except AssertionError as exception:
+		print(file = sys.stderr)
+		print("error: " + str(exception))
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,350 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import pathlib
+
+from . import storagelib, tinfoillib
+
+BACKUP_FORMAT_VERSION = 1
+
+MANIFEST_NAME = "manifest.db" # what the last snapshot held, so the next one can ship only what changed; never needed to restore
+STAGING_NAME = "staging.tmp"
+SNAPSHOT_FULL = "full"
+SNAPSHOT_INCREMENTAL = "incr"
+SNAPSHOT_NAME = re.compile(r"^(\d{6})\.(full|incr)\.db$")
+
+SNAPSHOT_BATCH_SIZE = 1000
+
+# a snapshot is a SQLite file of sealed rows as they are in the database, so nothing is decrypted to back up
+# a full snapshot holds every record and stream; an incremental one holds those added or re-sealed since the previous snapshot, and the keys deleted since
+SQL_CREATE_SNAPSHOT = (
+	"CREATE TABLE snapshot_info(name TEXT PRIMARY KEY NOT NULL, value NOT NULL)",
+	"CREATE TABLE snapshot_records(hashed_key BLOB PRIMARY KEY NOT NULL, encrypted_value BLOB NOT NULL, iv BLOB NOT NULL, hmac_signature BLOB NOT NULL)",
+	"CREATE TABLE snapshot_deleted(hashed_key BLOB PRIMARY KEY NOT NULL)",
+	"CREATE TABLE snapshot_streams(hashed_key BLOB NOT NULL, chunk_index INTEGER NOT NULL, encrypted_chunk BLOB NOT NULL, iv BLOB NOT NULL, hmac_signature BLOB NOT NULL, PRIMARY KEY (hashed_key, chunk_index))",
+	"CREATE TABLE snapshot_deleted_streams(hashed_key BLOB PRIMARY KEY NOT NULL)",
+)
+SQL_INSERT_SNAPSHOT_INFO = "INSERT INTO snapshot_info VALUES(?, ?)"
+SQL_INSERT_SNAPSHOT_RECORD = "INSERT INTO snapshot_records VALUES(?, ?, ?, ?)"
+SQL_INSERT_SNAPSHOT_DELETED = "INSERT INTO snapshot_deleted VALUES(?)"
+SQL_INSERT_SNAPSHOT_STREAM_CHUNK = "INSERT INTO snapshot_streams VALUES(?, ?, ?, ?, ?)"
+SQL_INSERT_SNAPSHOT_DELETED_STREAM = "INSERT INTO snapshot_deleted_streams VALUES(?)"
+SQL_SELECT_SNAPSHOT_INFO = "SELECT name, value FROM snapshot_info"
+SQL_SELECT_SNAPSHOT_RECORDS = "SELECT hashed_key, encrypted_value, iv, hmac_signature FROM snapshot_records"
+SQL_SELECT_SNAPSHOT_DELETED = "SELECT hashed_key FROM snapshot_deleted UNION ALL SELECT hashed_key FROM snapshot_records"
+SQL_SELECT_SNAPSHOT_STREAM_KEYS = "SELECT DISTINCT hashed_key FROM snapshot_streams"
+SQL_SELECT_SNAPSHOT_STREAM_CHUNKS = "SELECT chunk_index, encrypted_chunk, iv, hmac_signature FROM snapshot_streams WHERE hashed_key = ? ORDER BY chunk_index"
+SQL_SELECT_SNAPSHOT_DELETED_STREAMS = "SELECT hashed_key FROM snapshot_deleted_streams UNION SELECT hashed_key FROM snapshot_streams"
+
+# the manifest maps each record and stream of the last snapshot to the signature it was sealed with; signatures change whenever a value is re-sealed
+SQL_CREATE_MANIFEST = (
+	"CREATE TABLE IF NOT EXISTS manifest_info(name TEXT PRIMARY KEY NOT NULL, value NOT NULL)",
+	"CREATE TABLE IF NOT EXISTS manifest_records(hashed_key BLOB PRIMARY KEY NOT NULL, hmac_signature BLOB NOT NULL) WITHOUT ROWID",
+	"CREATE TABLE IF NOT EXISTS manifest_streams(hashed_key BLOB PRIMARY KEY NOT NULL, hmac_signature BLOB NOT NULL) WITHOUT ROWID",
+)
+SQL_SELECT_MANIFEST_SEQUENCE = "SELECT value FROM manifest_info WHERE name = 'sequence'"
+SQL_REPLACE_MANIFEST_SEQUENCE = "INSERT OR REPLACE INTO manifest_info VALUES('sequence', ?)"
+SQL_CLEAR_MANIFEST = ("DELETE FROM manifest_records", "DELETE FROM manifest_streams")
+SQL_SELECT_MANIFEST_RECORDS = "SELECT hashed_key, hmac_signature FROM manifest_records"
+SQL_REPLACE_MANIFEST_RECORD = "INSERT OR REPLACE INTO manifest_records VALUES(?, ?)"
+SQL_DELETE_MANIFEST_RECORD = "DELETE FROM manifest_records WHERE hashed_key = ?"
+SQL_SELECT_MANIFEST_STREAMS = "SELECT hashed_key, hmac_signature FROM manifest_streams"
+SQL_REPLACE_MANIFEST_STREAM = "INSERT OR REPLACE INTO manifest_streams VALUES(?, ?)"
+SQL_DELETE_MANIFEST_STREAM = "DELETE FROM manifest_streams WHERE hashed_key = ?"
+
+def _read_only_uri(path):
+	return pathlib.Path(path).absolute().as_uri() + "?mode=ro"
+
+def _digest(hashed_key, hmac_signature, domain = b"record"):
+	return int.from_bytes(hashlib.sha256(domain + bytes(hashed_key) + bytes(hmac_signature)).digest(), "big")
+
+def _format_digest(digest):
+	return format(digest, "064x")
+
+def _first_chunk_signature(storage, hashed_key):
+	"""Return the signature of a stream's first chunk, which identifies the stream as it was sealed"""
+	chunks = storage.iterate_stream(hashed_key)
+	try:
+		return bytes(next(chunks)[3])
+	finally:
+		chunks.close()
+
+def snapshot_path(directory, sequence, kind):
+	return os.path.join(directory, "%06d.%s.db" % (sequence, kind))
+
+def list_snapshots(directory):
+	"""Return (sequence, kind, path) for every snapshot in a backup directory, in sequence order"""
+	snapshots = []
+	for name in os.listdir(directory):
+		match = SNAPSHOT_NAME.match(name)
+		if match:
+			snapshots.append((int(match.group(1)), match.group(2), os.path.join(directory, name)))
+	snapshots.sort()
+	return snapshots
+
+def read_snapshot_info(path):
+	"""Return the dict of metadata stored in a snapshot"""
+	connection = sqlite3.connect(_read_only_uri(path), uri = True)
+	try:
+		info = dict(connection.execute(SQL_SELECT_SNAPSHOT_INFO).fetchall())
+	finally:
+		connection.close()
+
+	if info.get("format_version") != BACKUP_FORMAT_VERSION:
+		raise AssertionError("backup format version mismatch in '" + path + "'! expected '" + str(BACKUP_FORMAT_VERSION) + "', got '" + str(info.get("format_version")) + "'")
+	return info
+
+def create_snapshot(location, directory, full = False, pages_per_step = storagelib.DEFAULT_COPY_PAGES_PER_STEP, pause = storagelib.DEFAULT_COPY_PAUSE, report = None):
+	"""Back up the database at location into a backup directory, while it may be in use elsewhere
+
+The database is first copied at one point in time with storagelib.copy_store, then compared with the manifest of the last snapshot,
+so an incremental snapshot only holds what changed; a full snapshot is taken if asked for, or if there is no usable manifest
+Returns the snapshot's metadata"""
+	start = time.perf_counter()
+	os.makedirs(directory, mode = 0o700, exist_ok = True)
+
+	manifest = sqlite3.connect(os.path.join(directory, MANIFEST_NAME), isolation_level = None)
+	staging_location = os.path.join(directory, STAGING_NAME)
+	temporary_location = None
+	try:
+		for statement in SQL_CREATE_MANIFEST:
+			manifest.execute(statement)
+		manifest.execute("BEGIN IMMEDIATE") # also keeps two backups from running into the same directory at once
+
+		row = manifest.execute(SQL_SELECT_MANIFEST_SEQUENCE).fetchone()
+		manifest_sequence = row[0] if row is not None else 0
+		snapshots = list_snapshots(directory)
+		last_sequence = snapshots[-1][0] if snapshots else 0
+		if (manifest_sequence == 0) or (manifest_sequence != last_sequence):
+			full = True # the manifest does not describe the last snapshot, so nothing can be diffed against it
+		sequence = max(manifest_sequence, last_sequence) + 1
+
+		storagelib.remove_store(staging_location) # left by an interrupted backup
+		engine = storagelib.copy_store(location, staging_location, pages_per_step = pages_per_step, pause = pause, report = report)
+		staged = storagelib.open_storage(staging_location, engine)
+
+		kind = SNAPSHOT_FULL if full else SNAPSHOT_INCREMENTAL
+		if full:
+			for statement in SQL_CLEAR_MANIFEST:
+				manifest.execute(statement)
+
+		temporary_location = snapshot_path(directory, sequence, kind) + ".tmp"
+		if os.path.exists(temporary_location):
+			os.remove(temporary_location)
+		snapshot = sqlite3.connect(temporary_location)
+		try:
+			for statement in SQL_CREATE_SNAPSHOT:
+				snapshot.execute(statement)
+
+			known = dict(manifest.execute(SQL_SELECT_MANIFEST_RECORDS).fetchall()) # one pass over the manifest, instead of a lookup per batch
+			records = changed = 0
+			digest = 0
+			for rows in staged.scan(batch_size = SNAPSHOT_BATCH_SIZE):
+				new_rows = [row[1:] for row in rows if known.pop(row[1], None) != row[4]]
+				snapshot.executemany(SQL_INSERT_SNAPSHOT_RECORD, new_rows)
+				manifest.executemany(SQL_REPLACE_MANIFEST_RECORD, ((row[0], row[3]) for row in new_rows))
+
+				for row in rows:
+					digest ^= _digest(row[1], row[4])
+				records += len(rows)
+				changed += len(new_rows)
+
+			deleted = list(known) # what is left was deleted since the last snapshot
+			snapshot.executemany(SQL_INSERT_SNAPSHOT_DELETED, ((hashed_key, ) for hashed_key in deleted))
+			manifest.executemany(SQL_DELETE_MANIFEST_RECORD, ((hashed_key, ) for hashed_key in deleted))
+
+			known_streams = dict(manifest.execute(SQL_SELECT_MANIFEST_STREAMS).fetchall())
+			streams = changed_streams = 0
+			current_streams = staged.stream_keys() if staged.supports_streams else []
+			for hashed_key in current_streams:
+				signature = _first_chunk_signature(staged, hashed_key)
+				digest ^= _digest(hashed_key, signature, domain = b"stream")
+				streams += 1
+				if known_streams.pop(hashed_key, None) != signature:
+					snapshot.executemany(SQL_INSERT_SNAPSHOT_STREAM_CHUNK, (((hashed_key, ) + tuple(chunk)) for chunk in staged.iterate_stream(hashed_key)))
+					manifest.execute(SQL_REPLACE_MANIFEST_STREAM, (hashed_key, signature))
+					changed_streams += 1
+			for hashed_key in known_streams: # what is left was deleted since the last snapshot
+				snapshot.execute(SQL_INSERT_SNAPSHOT_DELETED_STREAM, (hashed_key, ))
+				manifest.execute(SQL_DELETE_MANIFEST_STREAM, (hashed_key, ))
+
+			info = {
+				"format_version": BACKUP_FORMAT_VERSION,
+				"kind": kind,
+				"sequence": sequence,
+				"parent": (sequence - 1) if not full else 0,
+				"created": int(time.time()),
+				"engine": engine,
+				"parameters": storagelib.encode_parameters(staged.load_parameters()).decode("utf-8"),
+				"records": records,
+				"streams": streams,
+				"changed_records": changed,
+				"deleted_records": len(deleted),
+				"changed_streams": changed_streams,
+				"deleted_streams": len(known_streams),
+				"digest": _format_digest(digest),
+			}
+			if engine == storagelib.ENGINE_SHARDED:
+				info["shards"] = staged.shard_count
+			snapshot.executemany(SQL_INSERT_SNAPSHOT_INFO, info.items())
+			snapshot.commit()
+		finally:
+			snapshot.close()
+			staged.close()
+
+		os.chmod(temporary_location, 0o600)
+		os.replace(temporary_location, snapshot_path(directory, sequence, kind))
+		temporary_location = None
+
+		manifest.execute(SQL_REPLACE_MANIFEST_SEQUENCE, (sequence, ))
+		manifest.execute("COMMIT")
+	except:
+		if manifest.in_transaction:
+			manifest.execute("ROLLBACK")
+		raise
+	finally:
+		manifest.close()
+		storagelib.remove_store(staging_location)
+		if (temporary_location is not None) and os.path.exists(temporary_location):
+			os.remove(temporary_location)
+
+	info["seconds"] = time.perf_counter() - start
+	return info
+
+def snapshot_chain(directory, sequence = None):
+	"""Return the (sequence, kind, path) of the snapshots needed to restore the given one (by default, the latest): the last full snapshot before it, then every incremental one up to it"""
+	snapshots = list_snapshots(directory)
+	if not snapshots:
+		raise AssertionError("no snapshots in '" + directory + "'!")
+	if sequence is None:
+		sequence = snapshots[-1][0]
+
+	by_sequence = {snapshot[0]: snapshot for snapshot in snapshots}
+	if sequence not in by_sequence:
+		raise AssertionError("there is no snapshot " + str(sequence) + "!")
+
+	chain = []
+	current = sequence
+	while True:
+		if current not in by_sequence:
+			raise AssertionError("snapshot " + str(current) + ", needed to restore snapshot " + str(sequence) + ", is missing!")
+		chain.append(by_sequence[current])
+		if by_sequence[current][1] == SNAPSHOT_FULL:
+			break
+		current -= 1
+
+	chain.reverse()
+	return chain
+
+def _apply_snapshot(storage, path):
+	snapshot = sqlite3.connect(_read_only_uri(path), uri = True)
+	try:
+		with storage.transaction():
+			cursor = snapshot.execute(SQL_SELECT_SNAPSHOT_DELETED) # re-sealed records are replaced, so they are deleted first
+			while True:
+				rows = cursor.fetchmany(SNAPSHOT_BATCH_SIZE)
+				if not rows:
+					break
+				storage.delete_many([row[0] for row in rows])
+
+			cursor = snapshot.execute(SQL_SELECT_SNAPSHOT_RECORDS)
+			while True:
+				rows = cursor.fetchmany(SNAPSHOT_BATCH_SIZE)
+				if not rows:
+					break
+				storage.insert_many(rows)
+
+		stream_keys = [row[0] for row in snapshot.execute(SQL_SELECT_SNAPSHOT_STREAM_KEYS).fetchall()]
+		removed_streams = [row[0] for row in snapshot.execute(SQL_SELECT_SNAPSHOT_DELETED_STREAMS).fetchall()]
+		if (stream_keys or removed_streams) and not storage.supports_streams:
+			raise AssertionError("the snapshot holds streams, which the restored database's storage engine does not support!")
+
+		for hashed_key in removed_streams:
+			storage.delete_stream(hashed_key)
+		for hashed_key in stream_keys:
+			storage.insert_stream(hashed_key, snapshot.execute(SQL_SELECT_SNAPSHOT_STREAM_CHUNKS, (hashed_key, )))
+	finally:
+		snapshot.close()
+
+def verify_restored(location, info, password = None, workers = None, rebuild_index = False):
+	"""Check that a restored database holds exactly the records and streams of the snapshot described by info,
+and if a password is given, that it unlocks the database and every record and stream authenticates under it
+If rebuild_index is set, the key index (which snapshots do not hold) is then rebuilt where the database supports it"""
+	storage = storagelib.open_storage(location)
+	try:
+		records = 0
+		digest = 0
+		for rows in storage.scan(batch_size = SNAPSHOT_BATCH_SIZE):
+			for row in rows:
+				digest ^= _digest(row[1], row[4])
+			records += len(rows)
+
+		stream_keys = storage.stream_keys() if storage.supports_streams else []
+		for hashed_key in stream_keys:
+			digest ^= _digest(hashed_key, _first_chunk_signature(storage, hashed_key), domain = b"stream")
+	finally:
+		storage.close()
+
+	if (records != info["records"]) or (len(stream_keys) != info["streams"]) or (_format_digest(digest) != info["digest"]):
+		raise AssertionError("the restored database does not match snapshot " + str(info["sequence"]) + "!")
+
+	if password is None:
+		return
+
+	database = tinfoillib.TinfoilDB(location)
+	try:
+		if not database.set_master_keys(password):
+			raise AssertionError("incorrect master password!")
+
+		result = database.verify_all(workers = workers, batch_size = SNAPSHOT_BATCH_SIZE)
+		if result["corrupt_records"]:
+			raise AssertionError(str(len(result["corrupt_records"])) + " restored records failed authentication!")
+		if result["corrupt_streams"]:
+			raise AssertionError("a restored stream failed authentication!")
+
+		if rebuild_index and database.storage.supports_index and (database.version >= 4):
+			database.rebuild_index()
+	finally:
+		database.close()
+
+def restore_snapshot(directory, destination, sequence = None, engine = None, password = None, workers = None):
+	"""Rebuild the database as it was at a snapshot (by default, the latest) into a new file, then verify it (see verify_restored)
+Without a password, the restored database's key index stays empty until it is rebuilt
+
+The database is assembled next to the destination and only moved into place once verified
+engine defaults to the engine the database was backed up from
+Returns the restored snapshot's metadata"""
+	start = time.perf_counter()
+	if os.path.exists(destination):
+		raise AssertionError("'" + destination + "' already exists!")
+
+	chain = snapshot_chain(directory, sequence)
+	info = read_snapshot_info(chain[-1][2])
+	for previous, current in zip(chain, chain[1:]):
+		if read_snapshot_info(current[2])["parent"] != previous[0]:
+			raise AssertionError("snapshot " + str(current[0]) + " was not taken after snapshot " + str(previous[0]) + "!")
+
+	temporary_location = destination + ".restore"
+	storagelib.remove_store(temporary_location) # left by an interrupted restore
+
+	try:
+		storage = storagelib.open_storage(temporary_location, (engine or info["engine"]), shards = info.get("shards"))
+		try:
+			storage.create(storagelib.decode_parameters(info["parameters"].encode("utf-8")))
+			for snapshot in chain:
+				_apply_snapshot(storage, snapshot[2])
+		finally:
+			storage.close()
+
+		verify_restored(temporary_location, info, password = password, workers = workers, rebuild_index = True)
+		for path in storagelib.store_files(temporary_location):
+			os.chmod(path, 0o600)
+		storagelib.move_store(temporary_location, destination)
+	except:
+		storagelib.remove_store(temporary_location)
+		raise
+
+	info["seconds"] = time.perf_counter() - start
+	return info
@@ -0,0 +1,593 @@
+#!/bin/python3
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+
+from . import cryptolib, passwordlib, storagelib
+from .tinfoillib import TinfoilDB
+
+BENCHMARK_PASSWORD = "benchmark"
+BENCHMARK_SCRYPT_N = 2 ** 10 # the KDF is not what is being measured by the record benchmarks
+BENCHMARK_VALUE = "correct horse battery staple" # a typical password-sized secret
+
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+DEFAULT_SCALES = ("1k", "100k", "1m")
+STORAGES = ("memory", "disk", "log") # "log" is an on-disk database using the append-only log engine
+SUITES = ("records", "crypto", "crypter", "unlock", "session", "scrypt", "layout", "passwords", "threads", "shards")
+DEFAULT_SUITES = ("records", "crypto", "unlock")
+
+DEFAULT_SAMPLE_SIZE = 2000 # lookups timed per operation, independent of the database size
+DEFAULT_WRITE_SAMPLE_SIZE = 200 # each on-disk store/delete commits, so these are sampled more sparingly
+DEFAULT_CRYPTO_ITERATIONS = 10000
+DEFAULT_UNLOCK_N = 2 ** 14
+DEFAULT_UNLOCK_SAMPLES = 5
+POPULATE_BATCH_SIZE = 10000
+
+DEFAULT_REGRESSION_THRESHOLD = 0.20 # fraction by which p50 latency may grow (or throughput shrink) before failing
+
+DEFAULT_RECORDS = 1000
+DEFAULT_ROUNDS = 5
+
+# the SQLite layouts, each with the hashed key size of the database version that introduced it
+LAYOUTS = (("entries", storagelib.SQLiteStorage, 64), ("records", storagelib.CompactSQLiteStorage, 16))
+LAYOUT_SEALED_SIZES = (12, 48, 16) # nonce, ciphertext and tag of a version 4 record holding a short name and password
+
+PASSWORD_BENCHMARK_COUNT = 10000
+PASSWORD_BENCHMARK_LENGTHS = (40, 64)
+
+THREAD_BENCHMARK_COUNTS = (1, 2, 4, 8)
+THREAD_BENCHMARK_RECORDS = 10000
+THREAD_BENCHMARK_LOOKUPS = 20000 # per thread count, shared out between the threads
+THREAD_BENCHMARK_WRITES = 2000
+
+SHARD_BENCHMARK_COUNTS = (1, 2, 4, 8)
+SHARD_BENCHMARK_WRITERS = 4 # threads, each with a connection of its own
+SHARD_BENCHMARK_RECORDS = 20000
+SHARD_BENCHMARK_WRITES = 2000 # per shard count, shared out between the writers
+
+SCRYPT_BENCHMARK_N = 2 ** 16
+SCRYPT_BENCHMARK_R = 8
+SCRYPT_BENCHMARK_P_VALUES = (1, 2, 4, 8)
+
+def _percentile(ordered, fraction):
+	return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+def summarize(latencies):
+	"""Summarize per-op latencies (in seconds) as throughput and p50/p99 in microseconds"""
+	ordered = sorted(latencies)
+	total = sum(ordered)
+	return {
+		"ops": len(ordered),
+		"ops_per_second": (len(ordered) / total) if total > 0 else None,
+		"p50_us": _percentile(ordered, 0.50) * (10 ** 6),
+		"p99_us": _percentile(ordered, 0.99) * (10 ** 6),
+	}
+
+def time_each(function, arguments):
+	"""Call function once per item in arguments, returning the latency of each call in seconds"""
+	latencies = []
+	for argument in arguments:
+		start = time.perf_counter()
+		function(argument)
+		latencies.append(time.perf_counter() - start)
+	return latencies
+
+def _open_database(database_location, **kwargs):
+	database = TinfoilDB(database_location, **kwargs)
+	if not database.check_database_initialized():
+		database.initialize_database(password = BENCHMARK_PASSWORD, scrypt_n = BENCHMARK_SCRYPT_N)
+	database.set_master_keys(BENCHMARK_PASSWORD)
+	return database
+
+def _evict_file_cache(path):
+	"""Ask the OS to drop its cached pages for the database file, so the next read comes from disk (best effort)"""
+	if not hasattr(os, "posix_fadvise"):
+		return False
+	descriptor = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(descriptor)
+		os.posix_fadvise(descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+	finally:
+		os.close(descriptor)
+	return True
+
+def _database_size(database, database_location):
+	if database.database is None: # not SQLite; the store is a single file
+		return os.path.getsize(database_location)
+	if database_location == ":memory:":
+		page_count = database.database.execute("PRAGMA page_count").fetchone()[0]
+		page_size = database.database.execute("PRAGMA page_size").fetchone()[0]
+		return page_count * page_size
+	size = os.path.getsize(database_location)
+	for suffix in ("-wal", "-journal"):
+		if os.path.exists(database_location + suffix):
+			size += os.path.getsize(database_location + suffix)
+	return size
+
+def _populate(database, keys):
+	for i in range(0, len(keys), POPULATE_BATCH_SIZE):
+		database.store_records({key: BENCHMARK_VALUE for key in keys[i:(i + POPULATE_BATCH_SIZE)]})
+
+def bench_records(count, storage, directory, sample_size = DEFAULT_SAMPLE_SIZE, write_sample_size = DEFAULT_WRITE_SAMPLE_SIZE, seed = 0, **database_kwargs):
+	"""Benchmark the TinfoilDB record operations against a database holding count entries
+
+Returns a dict of metric name -> summary; cold metrics are only produced on disk, after the database is reopened and evicted from the OS cache"""
+	rng = random.Random(seed) # fixed key sampling, so runs are comparable
+	keys = ["service-" + str(i) for i in range(count)]
+	database_location = ":memory:" if (storage == "memory") else os.path.join(directory, "records-" + str(count) + "." + storage)
+	if storage == "log":
+		database_kwargs = dict(database_kwargs, engine = "log")
+
+	database = _open_database(database_location, **database_kwargs)
+	populate_start = time.perf_counter()
+	_populate(database, keys)
+	populate_time = time.perf_counter() - populate_start
+
+	lookup_size = min(sample_size, count)
+	retrieve_keys = rng.sample(keys, lookup_size)
+	check_keys = rng.sample(keys, lookup_size)
+	missing_keys = ["missing-" + str(i) for i in range(lookup_size)]
+
+	results = {}
+	results["populate"] = {"ops": count, "ops_per_second": count / populate_time}
+
+	if storage != "memory":
+		database.close()
+		_evict_file_cache(database_location)
+		database = _open_database(database_location, **database_kwargs)
+		results["retrieve_record/cold"] = summarize(time_each(database.retrieve_record, retrieve_keys))
+		results["check_record/cold"] = summarize(time_each(database.check_record, check_keys))
+
+	results["retrieve_record/warm"] = summarize(time_each(database.retrieve_record, retrieve_keys))
+	results["check_record/warm"] = summarize(time_each(database.check_record, check_keys))
+	results["check_record/missing"] = summarize(time_each(database.check_record, missing_keys))
+
+	write_size = min(write_sample_size, count)
+	new_keys = ["new-" + str(i) for i in range(write_size)]
+	results["store_record"] = summarize(time_each(lambda key: database.store_record(key, BENCHMARK_VALUE), new_keys))
+	results["delete_record"] = summarize(time_each(database.delete_record, rng.sample(keys, write_size)))
+
+	results["size_bytes"] = _database_size(database, database_location)
+	results["size_bytes_per_record"] = results["size_bytes"] / count
+
+	database.close()
+	if database_location != ":memory:":
+		os.remove(database_location)
+	return results
+
+def bench_crypto(iterations = DEFAULT_CRYPTO_ITERATIONS):
+	"""Benchmark the cryptolib primitives on a password-sized value"""
+	aes_key = cryptolib.get_random_bytes(32)
+	hmac_key = cryptolib.get_random_bytes(64)
+	data = BENCHMARK_VALUE.encode("utf-8")
+	iv, encrypted = cryptolib.aes_encrypt_bytes(data = data, key = aes_key)
+	signature = cryptolib.do_hmac(hmac_key = hmac_key, aes_encrypted_data = (iv + encrypted))
+	nonce, aead_encrypted, tag = cryptolib.aead_encrypt_bytes(data = data, key = aes_key)
+	inputs = range(iterations)
+
+	return {
+		"do_sha512_hash": summarize(time_each(lambda _: cryptolib.do_sha512_hash(data = data), inputs)),
+		"aes_encrypt_bytes": summarize(time_each(lambda _: cryptolib.aes_encrypt_bytes(data = data, key = aes_key), inputs)),
+		"aes_decrypt_bytes": summarize(time_each(lambda _: cryptolib.aes_decrypt_bytes(data = encrypted, iv = iv, key = aes_key), inputs)),
+		"do_hmac": summarize(time_each(lambda _: cryptolib.do_hmac(hmac_key = hmac_key, aes_encrypted_data = (iv + encrypted)), inputs)),
+		"verify_hmac": summarize(time_each(lambda _: cryptolib.verify_hmac(hmac_key = hmac_key, aes_encrypted_data = (iv + encrypted), signature = signature), inputs)),
+		"aead_encrypt_bytes": summarize(time_each(lambda _: cryptolib.aead_encrypt_bytes(data = data, key = aes_key), inputs)),
+		"aead_decrypt_bytes": summarize(time_each(lambda _: cryptolib.aead_decrypt_bytes(data = aead_encrypted, nonce = nonce, tag = tag, key = aes_key), inputs)),
+		"do_scrypt": summarize(time_each(lambda _: cryptolib.do_scrypt(password = BENCHMARK_PASSWORD, salt = iv, n = 2 ** 10, r = 8, p = 1, key_length = 96), range(max(1, iterations // 1000)))),
+	}
+
+def bench_record_crypter(iterations = DEFAULT_CRYPTO_ITERATIONS):
+	"""Compare sealing/opening records with per-call cryptolib setup against the reusable record crypters"""
+	aes_key = cryptolib.get_random_bytes(32)
+	hmac_key = cryptolib.get_random_bytes(64)
+	hashed_key = cryptolib.do_sha512_hash(data = BENCHMARK_PASSWORD)
+	data = BENCHMARK_VALUE.encode("utf-8")
+	inputs = range(iterations)
+
+	def v1_seal_per_call(_):
+		iv, encrypted = cryptolib.aes_encrypt_bytes(data = data, key = aes_key)
+		return iv, encrypted, cryptolib.do_hmac(hmac_key = hmac_key, aes_encrypted_data = (iv + encrypted))
+
+	def v1_open_per_call(sealed):
+		iv, encrypted, signature = sealed
+		if not cryptolib.verify_hmac(hmac_key = hmac_key, aes_encrypted_data = (iv + encrypted), signature = signature):
+			raise AssertionError("HMAC verification failed!")
+		return cryptolib.aes_decrypt_bytes(data = encrypted, iv = iv, key = aes_key)
+
+	def v2_seal_per_call(_):
+		return cryptolib.aead_encrypt_bytes(data = data, key = aes_key, associated_data = hashed_key)
+
+	def v2_open_per_call(sealed):
+		nonce, encrypted, tag = sealed
+		return cryptolib.aead_decrypt_bytes(data = encrypted, nonce = nonce, tag = tag, key = aes_key, associated_data = hashed_key)
+
+	v1_crypter = cryptolib.RecordCrypter(aes_key, hmac_key)
+	v2_crypter = cryptolib.AEADRecordCrypter(aes_key)
+
+	v1_sealed = v1_seal_per_call(None)
+	v2_sealed = v2_seal_per_call(None)
+	v1_sealed_repeated = [v1_sealed] * iterations
+	v2_sealed_repeated = [v2_sealed] * iterations
+
+	return {
+		"v1/seal/per_call": summarize(time_each(v1_seal_per_call, inputs)),
+		"v1/seal/crypter": summarize(time_each(lambda _: v1_crypter.seal(data), inputs)),
+		"v1/open/per_call": summarize(time_each(v1_open_per_call, v1_sealed_repeated)),
+		"v1/open/crypter": summarize(time_each(lambda sealed: v1_crypter.open(*sealed), v1_sealed_repeated)),
+		"v2/seal/per_call": summarize(time_each(v2_seal_per_call, inputs)),
+		"v2/seal/crypter": summarize(time_each(lambda _: v2_crypter.seal(data, associated_data = hashed_key), inputs)),
+		"v2/open/per_call": summarize(time_each(v2_open_per_call, v2_sealed_repeated)),
+		"v2/open/crypter": summarize(time_each(lambda sealed: v2_crypter.open(*sealed, associated_data = hashed_key), v2_sealed_repeated)),
+	}
+
+def bench_unlock(n = DEFAULT_UNLOCK_N, samples = DEFAULT_UNLOCK_SAMPLES):
+	"""Benchmark set_master_keys (scrypt derivation plus unwrapping the data key) and change_master_password at the given N"""
+	database = TinfoilDB(":memory:")
+	database.initialize_database(password = BENCHMARK_PASSWORD, scrypt_n = n)
+
+	def unlock(_):
+		database.clear_master_keys()
+		database.set_master_keys(BENCHMARK_PASSWORD)
+
+	results = {"set_master_keys": summarize(time_each(unlock, range(samples)))}
+	results["change_master_password"] = summarize(time_each(lambda _: database.change_master_password(BENCHMARK_PASSWORD, BENCHMARK_PASSWORD), range(samples)))
+	database.close()
+	return results
+
+def bench_session(records = DEFAULT_RECORDS, rounds = DEFAULT_ROUNDS):
+	"""Compare per-op latency of the default path against session mode (with and without WAL)"""
+	keys = ["service-" + str(i) for i in range(records)]
+	modes = [
+		("default", {}),
+		("session", {"session": True}),
+		("session+wal", {"session": True, "wal": True}),
+	]
+
+	results = {}
+	with tempfile.TemporaryDirectory() as directory:
+		for name, kwargs in modes:
+			database_location = os.path.join(directory, name + ".db")
+			database = _open_database(database_location, **kwargs)
+
+			results[name + "/store_record"] = summarize(time_each(lambda key: database.store_record(key, BENCHMARK_VALUE), keys))
+			results[name + "/check_record"] = summarize(time_each(database.check_record, keys * rounds))
+			results[name + "/retrieve_record"] = summarize(time_each(database.retrieve_record, keys * rounds))
+			database.close()
+
+	return results
+
+def bench_scrypt_parallel(n = SCRYPT_BENCHMARK_N, r = SCRYPT_BENCHMARK_R, p_values = SCRYPT_BENCHMARK_P_VALUES):
+	"""Time the serial and multi-core scrypt derivations for each p, checking that both produce the same key"""
+	password = os.urandom(40)
+	salt = os.urandom(16)
+
+	results = {}
+	for p in p_values:
+		start = time.perf_counter()
+		serial_key = cryptolib.do_scrypt(password = password, salt = salt, n = n, r = r, p = p, key_length = 96)
+		serial_time = time.perf_counter() - start
+
+		start = time.perf_counter()
+		parallel_key = cryptolib.do_scrypt_parallel(password = password, salt = salt, n = n, r = r, p = p, key_length = 96)
+		parallel_time = time.perf_counter() - start
+
+		if parallel_key != serial_key:
+			raise AssertionError("parallel scrypt derivation does not match the serial derivation for p = " + str(p) + "!")
+
+		results["p" + str(p) + "/serial"] = summarize([serial_time])
+		results["p" + str(p) + "/parallel"] = summarize([parallel_time])
+
+	return results
+
+def bench_layout(count, directory, sample_size = DEFAULT_SAMPLE_SIZE, seed = 0):
+	"""Compare the file size and lookup latency of the SQLite layouts holding count records, at the storage level with random sealed values
+
+Cold lookups run after the file is evicted from the OS cache"""
+	rng = random.Random(seed)
+	iv_size, ciphertext_size, tag_size = LAYOUT_SEALED_SIZES
+	sampled_per_batch = -(-(sample_size * POPULATE_BATCH_SIZE) // count) # hashed keys are random, so the first few of each batch are a fair sample
+
+	results = {}
+	for name, engine, key_size in LAYOUTS:
+		location = os.path.join(directory, "layout-" + name + "-" + str(count) + ".db")
+		storage = engine(location)
+		storage.create({"version": 0})
+		hashed_keys = []
+		populate_start = time.perf_counter()
+		for i in range(0, count, POPULATE_BATCH_SIZE):
+			rows = [(os.urandom(key_size), os.urandom(ciphertext_size), os.urandom(iv_size), os.urandom(tag_size)) for _ in range(min(POPULATE_BATCH_SIZE, count - i))]
+			with storage.transaction():
+				storage.insert_many(rows)
+			hashed_keys.extend(row[0] for row in rows[:sampled_per_batch])
+		populate_time = time.perf_counter() - populate_start
+		storage.close()
+
+		lookup_keys = rng.sample(hashed_keys, min(sample_size, len(hashed_keys)))
+		missing_keys = [os.urandom(key_size) for _ in lookup_keys]
+
+		_evict_file_cache(location)
+		storage = engine(location)
+		results[name + "/populate"] = {"ops": count, "ops_per_second": count / populate_time}
+		results[name + "/get/cold"] = summarize(time_each(storage.get, lookup_keys))
+		results[name + "/get/warm"] = summarize(time_each(storage.get, lookup_keys))
+		results[name + "/contains/missing"] = summarize(time_each(storage.contains, missing_keys))
+
+		results[name + "/size_bytes"] = os.path.getsize(location)
+		results[name + "/size_bytes_per_record"] = os.path.getsize(location) / count
+		results.update({name + "/" + metric: value for metric, value in _btree_shape(storage.connection, storage.records_table).items()})
+		storage.close()
+		os.remove(location)
+
+	return results
+
+def bench_passwords(count = PASSWORD_BENCHMARK_COUNT, lengths = PASSWORD_BENCHMARK_LENGTHS):
+	"""Compare generating count passwords one call at a time against a single generate_passwords() call, without and with a policy"""
+	results = {}
+	for length in lengths:
+		policies = (("", passwordlib.PasswordPolicy(length = length)), ("/policy", passwordlib.PasswordPolicy(length = length, min_digits = 1, min_special = 1)))
+
+		start = time.perf_counter()
+		for _ in range(count):
+			passwordlib.generate_password(length = length)
+		results["generate_password/" + str(length)] = {"ops": count, "ops_per_second": count / (time.perf_counter() - start)}
+
+		for name, policy in policies:
+			start = time.perf_counter()
+			passwordlib.generate_passwords(count, policy)
+			results["generate_passwords/" + str(length) + name] = {"ops": count, "ops_per_second": count / (time.perf_counter() - start)}
+			results["entropy_bits/" + str(length) + name] = policy.entropy_bits()
+
+	return results
+
+def _run_threads(thread_count, function, items):
+	"""Call function once per item, shared out between thread_count threads started together; returns the wall-clock seconds taken"""
+	barrier = threading.Barrier(thread_count + 1)
+	def work(share):
+		barrier.wait()
+		for item in share:
+			function(item)
+
+	threads = [threading.Thread(target = work, args = (items[i::thread_count], )) for i in range(thread_count)]
+	for thread in threads:
+		thread.start()
+	barrier.wait()
+	start = time.perf_counter()
+	for thread in threads:
+		thread.join()
+	return time.perf_counter() - start
+
+def bench_threads(thread_counts = THREAD_BENCHMARK_COUNTS, records = THREAD_BENCHMARK_RECORDS, lookups = THREAD_BENCHMARK_LOOKUPS, writes = THREAD_BENCHMARK_WRITES, seed = 0):
+	"""Measure the lookup and store throughput of a thread-safe database shared by a growing number of threads,
+against a single-connection session database used by one thread"""
+	rng = random.Random(seed)
+	keys = ["service-" + str(i) for i in range(records)]
+
+	results = {}
+	with tempfile.TemporaryDirectory() as directory:
+		database_location = os.path.join(directory, "threads.db")
+		database = _open_database(database_location, readers = max(thread_counts))
+		_populate(database, keys)
+
+		for thread_count in thread_counts:
+			lookup_keys = [rng.choice(keys) for _ in range(lookups)]
+			elapsed = _run_threads(thread_count, database.retrieve_record, lookup_keys)
+			results["retrieve_record/" + str(thread_count)] = {"ops": lookups, "ops_per_second": lookups / elapsed}
+
+			commits, grouped_writes = database.storage.commits, database.storage.grouped_writes
+			new_keys = ["new-" + str(thread_count) + "-" + str(i) for i in range(writes)]
+			elapsed = _run_threads(thread_count, lambda key: database.store_record(key, BENCHMARK_VALUE), new_keys)
+			results["store_record/" + str(thread_count)] = {"ops": writes, "ops_per_second": writes / elapsed}
+			results["writes_per_commit/" + str(thread_count)] = (database.storage.grouped_writes - grouped_writes) / max(1, database.storage.commits - commits)
+		database.close()
+
+		database = _open_database(database_location, session = True, wal = True) # its connection only works on this thread
+		lookup_keys = [rng.choice(keys) for _ in range(lookups)]
+		results["single/retrieve_record"] = {"ops": lookups, "ops_per_second": lookups / sum(time_each(database.retrieve_record, lookup_keys))}
+		new_keys = ["single-" + str(i) for i in range(writes)]
+		results["single/store_record"] = {"ops": writes, "ops_per_second": writes / sum(time_each(lambda key: database.store_record(key, BENCHMARK_VALUE), new_keys))}
+		database.close()
+
+	return results
+
+def _run_writers(database_location, writer_count, keys):
+	"""Store keys from writer_count threads, each with its own unlocked database, started together once all have opened; returns the wall-clock seconds taken"""
+	barrier = threading.Barrier(writer_count + 1)
+	errors = []
+	def work(share):
+		database = _open_database(database_location, wal = True)
+		try:
+			barrier.wait()
+			for key in share:
+				database.store_record(key, BENCHMARK_VALUE)
+		except Exception as exception:
+			errors.append(exception)
+		finally:
+			database.close()
+
+	threads = [threading.Thread(target = work, args = (keys[i::writer_count], )) for i in range(writer_count)]
+	for thread in threads:
+		thread.start()
+	barrier.wait()
+	start = time.perf_counter()
+	for thread in threads:
+		thread.join()
+	elapsed = time.perf_counter() - start
+	if errors:
+		raise errors[0]
+	return elapsed
+
+def bench_shards(shard_counts = SHARD_BENCHMARK_COUNTS, writers = SHARD_BENCHMARK_WRITERS, records = SHARD_BENCHMARK_RECORDS, writes = SHARD_BENCHMARK_WRITES):
+	"""Measure how the store throughput of concurrent writers and the throughput of a full scan change with the shard count of a sharded database,
+against an unsharded SQLite database"""
+	keys = ["service-" + str(i) for i in range(records)]
+
+	results = {}
+	with tempfile.TemporaryDirectory() as directory:
+		for shard_count in (None, ) + tuple(shard_counts):
+			name = "unsharded" if shard_count is None else str(shard_count)
+			database_location = os.path.join(directory, "shards-" + name + ".db")
+			database = _open_database(database_location, engine = (storagelib.ENGINE_SQLITE if shard_count is None else storagelib.ENGINE_SHARDED), shards = shard_count, wal = True)
+			_populate(database, keys)
+			database.close()
+
+			new_keys = ["new-" + str(i) for i in range(writes)]
+			elapsed = _run_writers(database_location, writers, new_keys)
+			results["store_record/" + name] = {"ops": writes, "ops_per_second": writes / elapsed}
+
+			storage = storagelib.open_storage(database_location)
+			start = time.perf_counter()
+			rows = sum(len(batch) for batch in storage.scan())
+			results["scan/" + name] = {"ops": rows, "ops_per_second": rows / (time.perf_counter() - start)}
+			storage.close()
+
+	return results
+
+def _btree_shape(connection, table):
+	"""Return the b-tree levels a lookup in table descends (through its UNIQUE index first, if it has one),
+and the interior pages that have to stay cached for lookups to read only one leaf from disk
+
+Returns an empty dict if SQLite was built without the dbstat table"""
+	try:
+		rows = connection.execute("SELECT name, path, pagetype FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = ?)", (table, )).fetchall()
+	except sqlite3.OperationalError:
+		return {}
+
+	levels = {}
+	for name, path, pagetype in rows:
+		levels[name] = max(levels.get(name, 0), path.count("/"))
+	return {"lookup_levels": sum(levels.values()), "interior_pages": sum(1 for name, path, pagetype in rows if pagetype == "internal")}
+
+def run_suites(suites = DEFAULT_SUITES, scales = DEFAULT_SCALES, storages = STORAGES, report = None, **database_kwargs):
+	"""Run the selected suites, returning a flat dict of metric name -> summary"""
+	if report is None:
+		report = lambda name, metric: None
+
+	metrics = {}
+	def collect(prefix, results):
+		for name, metric in results.items():
+			metrics[prefix + "/" + name] = metric
+			report(prefix + "/" + name, metric)
+
+	if "records" in suites:
+		with tempfile.TemporaryDirectory() as directory:
+			for scale in scales:
+				for storage in storages:
+					collect("records/" + storage + "/" + scale, bench_records(SCALES[scale], storage, directory, **database_kwargs))
+	if "crypto" in suites:
+		collect("crypto", bench_crypto())
+	if "crypter" in suites:
+		collect("crypter", bench_record_crypter())
+	if "unlock" in suites:
+		collect("unlock", bench_unlock())
+	if "session" in suites:
+		collect("session", bench_session())
+	if "scrypt" in suites:
+		collect("scrypt", bench_scrypt_parallel())
+	if "layout" in suites:
+		with tempfile.TemporaryDirectory() as directory:
+			for scale in scales:
+				collect("layout/" + scale, bench_layout(SCALES[scale], directory))
+	if "passwords" in suites:
+		collect("passwords", bench_passwords())
+	if "threads" in suites:
+		collect("threads", bench_threads())
+	if "shards" in suites:
+		collect("shards", bench_shards())
+
+	return metrics
+
+def environment():
+	return {
+		"python": platform.python_version(),
+		"sqlite": sqlite3.sqlite_version,
+		"platform": platform.platform(),
+		"cores": os.cpu_count(),
+		"timestamp": time.time(),
+	}
+
+def compare(metrics, baseline_metrics, threshold = DEFAULT_REGRESSION_THRESHOLD):
+	"""Compare metrics against a saved baseline, returning a list of (name, description) regressions"""
+	regressions = []
+	for name, metric in metrics.items():
+		baseline = baseline_metrics.get(name)
+		if (not isinstance(metric, dict)) or (not isinstance(baseline, dict)):
+			if isinstance(metric, (int, float)) and isinstance(baseline, (int, float)) and (baseline > 0):
+				if metric > baseline * (1 + threshold):
+					regressions.append((name, str(baseline) + " -> " + str(metric)))
+			continue
+
+		if ("p50_us" in metric) and ("p50_us" in baseline) and (metric["p50_us"] > baseline["p50_us"] * (1 + threshold)):
+			regressions.append((name, "p50 " + str(round(baseline["p50_us"], 1)) + "us -> " + str(round(metric["p50_us"], 1)) + "us"))
+		elif metric.get("ops_per_second") and baseline.get("ops_per_second") and (metric["ops_per_second"] < baseline["ops_per_second"] * (1 - threshold)):
+			regressions.append((name, "throughput " + str(round(baseline["ops_per_second"])) + "/s -> " + str(round(metric["ops_per_second"])) + "/s"))
+	return regressions
+
+def format_metric(name, metric):
+	if not isinstance(metric, dict):
+		return name + ": " + str(round(metric, 1))
+
+	line = name + ": " + str(round(metric["ops_per_second"] or 0)) + " ops/s"
+	if "p50_us" in metric:
+		line += "; p50 = " + str(round(metric["p50_us"], 1)) + "us; p99 = " + str(round(metric["p99_us"], 1)) + "us"
+	return line
+
+def _split(value, choices):
+	selected = tuple(item.strip() for item in value.split(",") if item.strip())
+	for item in selected:
+		if item not in choices:
+			raise argparse.ArgumentTypeError("'" + item + "' is not one of: " + ", ".join(choices))
+	return selected
+
+def parse_arguments(arguments = None):
+	parser = argparse.ArgumentParser(prog = "tinfoil-bench", description = "benchmark TinfoilDB operations and cryptolib primitives")
+	parser.add_argument("--suites", type = lambda value: _split(value, SUITES), default = DEFAULT_SUITES, help = "comma-separated suites from " + ", ".join(SUITES) + " (default: " + ",".join(DEFAULT_SUITES) + ")")
+	parser.add_argument("--scales", type = lambda value: _split(value, tuple(SCALES)), default = DEFAULT_SCALES, help = "comma-separated record counts from " + ", ".join(SCALES) + " (default: all)")
+	parser.add_argument("--storages", type = lambda value: _split(value, STORAGES), default = STORAGES, help = "comma-separated storages from " + ", ".join(STORAGES) + " (default: all)")
+	parser.add_argument("--session", action = "store_true", help = "open record benchmark databases in session mode")
+	parser.add_argument("--wal", action = "store_true", help = "open record benchmark databases with WAL journaling")
+	parser.add_argument("-o", "--output", default = None, help = "write results as JSON to this file (usable as a later --baseline)")
+	parser.add_argument("-b", "--baseline", default = None, help = "compare against results previously saved with --output")
+	parser.add_argument("--threshold", type = float, default = DEFAULT_REGRESSION_THRESHOLD, help = "allowed slowdown before a metric counts as a regression (default: " + str(DEFAULT_REGRESSION_THRESHOLD) + ")")
+	return parser.parse_args(arguments)
+
+def main():
+	arguments = parse_arguments()
+
+	database_kwargs = {}
+	if arguments.session:
+		database_kwargs["session"] = True
+	if arguments.wal:
+		database_kwargs["wal"] = True
+
+	print("--- tinfoil benchmarks (" + ", ".join(arguments.suites) + ") ---")
+	print()
+	metrics = run_suites(arguments.suites, arguments.scales, arguments.storages, report = lambda name, metric: print(format_metric(name, metric)), **database_kwargs)
+	print()
+
+	if arguments.output:
+		with open(arguments.output, "w", encoding = "utf-8") as f:
+			json.dump({"environment": environment(), "metrics": metrics}, f, indent = 4)
+		print("results saved to '" + arguments.output + "'")
+
+	if arguments.baseline:
+		with open(arguments.baseline, "r", encoding = "utf-8") as f:
+			baseline = json.load(f)
+
+		regressions = compare(metrics, baseline["metrics"], arguments.threshold)
+		if regressions:
+			print("regressions against '" + arguments.baseline + "':")
+			for name, description in regressions:
+				print("  " + name + ": " + description)
+			sys.exit(1)
+		print("no regressions against '" + arguments.baseline + "'")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,78 @@
+import time
+import threading
+import collections
+
+DEFAULT_CACHE_TTL = 5 * 60 # seconds
+
+def wipe(buffer):
+	"""Overwrite a bytearray with zeroes in place"""
+	buffer[:] = bytes(len(buffer)) # a slice assignment of the same length writes into the existing buffer
+
+class RecordCache:
+	"""A bounded LRU cache of decrypted record values, keyed by hashed key, whose entries expire ttl seconds after they were added
+
+Values are held in bytearrays, which are overwritten with zeroes when they are evicted, expired, invalidated or cleared
+The strings handed back to callers are copies, which Python cannot wipe
+Every method holds a lock, so a cache may be shared between threads"""
+
+	def __init__(self, capacity, ttl = DEFAULT_CACHE_TTL):
+		if capacity < 1:
+			raise AssertionError("cache capacity must be at least 1!")
+
+		self.capacity = capacity
+		self.ttl = ttl # None to never expire entries
+		self._entries = collections.OrderedDict() # hashed_key -> (expiry, bytearray value), least recently used first
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+		self._lock = threading.Lock()
+
+	def get(self, hashed_key):
+		"""Return the cached value for a hashed key as a string, or None"""
+		with self._lock:
+			entry = self._entries.get(hashed_key)
+			if entry is None:
+				self.misses += 1
+				return None
+
+			expiry, value = entry
+			if (expiry is not None) and (time.monotonic() >= expiry):
+				self._drop(hashed_key)
+				self.expirations += 1
+				self.misses += 1
+				return None
+
+			self._entries.move_to_end(hashed_key)
+			self.hits += 1
+			return value.decode("utf-8")
+
+	def put(self, hashed_key, value):
+		"""Cache a value given as bytes, evicting the least recently used entry if the cache is full"""
+		expiry = (time.monotonic() + self.ttl) if (self.ttl is not None) else None
+		with self._lock:
+			self._drop(hashed_key)
+			self._entries[hashed_key] = (expiry, bytearray(value))
+
+			while len(self._entries) > self.capacity:
+				wipe(self._entries.popitem(last = False)[1][1])
+				self.evictions += 1
+
+	def _drop(self, hashed_key):
+		entry = self._entries.pop(hashed_key, None)
+		if entry is not None:
+			wipe(entry[1])
+
+	def invalidate(self, hashed_key):
+		with self._lock:
+			self._drop(hashed_key)
+
+	def clear(self):
+		"""Wipe and drop every entry; the counters are kept"""
+		with self._lock:
+			while self._entries:
+				wipe(self._entries.popitem()[1][1])
+
+	def stats(self):
+		with self._lock:
+			return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations, "entries": len(self._entries), "capacity": self.capacity, "ttl": self.ttl}
@@ -0,0 +1,26 @@
+#!/bin/python3
+
+import sys
+import argparse
+
+from . import storagelib
+
+DEFAULT_DATABASE = "tinfoil.db"
+
+def parse_arguments(arguments = None):
+	parser = argparse.ArgumentParser(prog = "tinfoil-compact", description = "rewrite a log-engine tinfoil database without its deleted and overwritten entries; nothing else may have the database open")
+	parser.add_argument("database", nargs = "?", default = DEFAULT_DATABASE, help = "database location (default: " + DEFAULT_DATABASE + ")")
+	return parser.parse_args(arguments)
+
+def main():
+	arguments = parse_arguments()
+
+	if storagelib.detect_engine(arguments.database) != storagelib.ENGINE_LOG:
+		print("error: '" + arguments.database + "' is not a log-engine database! SQLite databases can be compacted with 'VACUUM'")
+		sys.exit(1)
+
+	old_size, new_size = storagelib.compact_log(arguments.database)
+	print("compacted '" + arguments.database + "' from " + str(old_size) + " to " + str(new_size) + " bytes")
+
+if __name__ == "__main__":
+	main()
@@ -1,12 +1,30 @@
 import os
+import mmap
+import ctypes
+import hashlib
+import concurrent.futures
 
 import scrypt
+from cryptography.exceptions import InvalidSignature, InvalidTag
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 from cryptography.hazmat.primitives.ciphers import algorithms, modes, Cipher
 from cryptography.hazmat.primitives import hashes, padding as symmetric_padding, hmac
 
 backend = default_backend()
 
+AEAD_AES_GCM = "aes-gcm"
+AEAD_CHACHA20_POLY1305 = "chacha20-poly1305"
+AEAD_ALGORITHMS = {
+	AEAD_AES_GCM: AESGCM,
+	AEAD_CHACHA20_POLY1305: ChaCha20Poly1305,
+}
+
+AES_BLOCK_SIZE = algorithms.AES.block_size // 8 # 128 bits = 16 bytes
+
+AEAD_NONCE_SIZE = 96 // 8 # 96 bits = 12 bytes
+AEAD_TAG_SIZE = 128 // 8 # 128 bits = 16 bytes
+
 def do_sha512_hash(data):
 	"""Calculate the SHA-512 hash for the given data"""
 	if type(data) != bytes:
@@ -30,6 +48,63 @@ def do_scrypt(password, salt, n, r, p, key_length):
 
 	return scrypt.hash(password = password, salt = salt, N = n, r = r, p = p, buflen = key_length)
 
+_smix = None
+
+def _load_smix():
+	"""Locate the ROMix routine (crypto_scrypt_smix) exported by the scrypt package's bundled C library, or None if unavailable"""
+	global _smix
+	if _smix is None:
+		try:
+			import _scrypt
+			function = ctypes.CDLL(_scrypt.__file__).crypto_scrypt_smix
+		except (ImportError, OSError, AttributeError):
+			function = False
+		else:
+			function.restype = None
+			function.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.c_uint64, ctypes.c_void_p, ctypes.c_void_p]
+		_smix = function
+	return (_smix or None)
+
+def _scrypt_lane(block, n, r):
+	"""Run scrypt's ROMix over a single 128 * r byte lane"""
+	smix = _load_smix()
+
+	# anonymous maps are page-aligned and lazily zeroed, so the N-sized scratchpad costs nothing until it is touched
+	v = mmap.mmap(-1, 128 * r * n)
+	xy = mmap.mmap(-1, 256 * r + 64)
+	try:
+		v_pointer = ctypes.c_char.from_buffer(v)
+		xy_pointer = ctypes.c_char.from_buffer(xy)
+		lane = ctypes.create_string_buffer(block, len(block))
+		smix(lane, r, n, ctypes.addressof(v_pointer), ctypes.addressof(xy_pointer))
+		del v_pointer, xy_pointer # release the buffer exports so the maps can close
+		return lane.raw
+	finally:
+		v.close()
+		xy.close()
+
+def do_scrypt_parallel(password, salt, n, r, p, key_length, max_workers = None):
+	"""Derive the same key as do_scrypt, computing the p independent scrypt lanes across a process pool
+
+Peak memory is (128 * r * N) per concurrently running lane; falls back to do_scrypt when p is 1 or the ROMix routine is unavailable"""
+	if type(password) != bytes:
+		password = password.encode("utf-8")
+
+	if max_workers is None:
+		max_workers = min(p, os.cpu_count() or 1)
+
+	if (p == 1) or (max_workers < 2) or (_load_smix() is None):
+		return do_scrypt(password = password, salt = salt, n = n, r = r, p = p, key_length = key_length)
+
+	lane_size = 128 * r
+	blocks = hashlib.pbkdf2_hmac("sha256", password, salt, 1, p * lane_size)
+	lanes = [blocks[(i * lane_size):((i + 1) * lane_size)] for i in range(p)]
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers = max_workers) as executor:
+		mixed = b"".join(executor.map(_scrypt_lane, lanes, [n] * p, [r] * p))
+
+	return hashlib.pbkdf2_hmac("sha256", password, mixed, 1, key_length)
+
 def _pad_bytes(data):
 	"""Pad bytes of data for encryption by a CBC-mode AES cipher"""
 	padder = symmetric_padding.PKCS7(algorithms.AES.block_size).padder()
@@ -75,6 +150,10 @@ def do_hmac(hmac_key, aes_encrypted_data):
 	signer.update(aes_encrypted_data)
 	return signer.finalize()
 
+def do_keyed_hash(key, data, digest_size):
+	"""Calculate a keyed BLAKE2b hash of the given data, truncated to digest_size bytes; key is at most 64 bytes"""
+	return hashlib.blake2b(data, key = key, digest_size = digest_size).digest()
+
 def verify_hmac(hmac_key, aes_encrypted_data, signature):
 	"""Verify a HMAC signature for the given encrypted data and HMAC key"""
 	verifier = hmac.HMAC(
@@ -88,3 +167,95 @@ def verify_hmac(hmac_key, aes_encrypted_data, signature):
 		return True
 	except: # if verifying the signature fails for any reason, return failure
 		return False
+
+def aead_encrypt_bytes(data, key, algorithm = AEAD_AES_GCM, associated_data = None):
+	"""Encrypt and authenticate some data in a single pass with the given AEAD algorithm and key"""
+	nonce = get_random_bytes(AEAD_NONCE_SIZE)
+	sealed_data = AEAD_ALGORITHMS[algorithm](key).encrypt(nonce, data, associated_data)
+	return nonce, sealed_data[:-AEAD_TAG_SIZE], sealed_data[-AEAD_TAG_SIZE:]
+
+def aead_decrypt_bytes(data, nonce, tag, key, algorithm = AEAD_AES_GCM, associated_data = None):
+	"""Decrypt data that was encrypted by aead_encrypt_bytes, or return None if authentication fails"""
+	try:
+		return AEAD_ALGORITHMS[algorithm](key).decrypt(nonce, data + tag, associated_data)
+	except InvalidTag:
+		return None
+
+class RecordCrypter:
+	"""Seals and opens records with AES-CBC + HMAC-SHA512 (database version 1), reusing per-key state across calls
+
+The AES algorithm object and a pre-keyed HMAC context are built once; each record clones the HMAC context instead of re-keying it
+If associated_data is given, it is authenticated ahead of the IV and ciphertext; it must have a fixed length for a given use
+open() accepts any bytes-like arguments, such as memoryview slices of a mapped file"""
+
+	def __init__(self, aes_key, hmac_key):
+		self._algorithm = algorithms.AES(aes_key)
+		self._hmac = hmac.HMAC(key = hmac_key, algorithm = hashes.SHA512(), backend = backend)
+
+	def _sign(self, iv, ciphertext, associated_data):
+		signer = self._hmac.copy()
+		if associated_data:
+			signer.update(associated_data)
+		signer.update(iv)
+		signer.update(ciphertext)
+		return signer
+
+	def seal(self, plaintext, associated_data = None):
+		"""Encrypt and sign some data, returning (iv, ciphertext, tag)"""
+		padding_length = AES_BLOCK_SIZE - (len(plaintext) % AES_BLOCK_SIZE)
+		padded_data = plaintext + (bytes((padding_length, )) * padding_length) # PKCS7, as _pad_bytes
+
+		iv = get_random_bytes(AES_BLOCK_SIZE)
+		encryptor = Cipher(algorithm = self._algorithm, mode = modes.CBC(iv), backend = backend).encryptor()
+		ciphertext = encryptor.update(padded_data) + encryptor.finalize()
+
+		return iv, ciphertext, self._sign(iv, ciphertext, associated_data).finalize()
+
+	def _verify(self, iv, ciphertext, tag, associated_data):
+		try:
+			self._sign(iv, ciphertext, associated_data).verify(bytes(tag)) # verify() only takes bytes
+		except InvalidSignature:
+			return False
+		return True
+
+	def verify(self, iv, ciphertext, tag, associated_data = None):
+		"""Check the tag of data sealed by seal() without decrypting it"""
+		return self._verify(iv, ciphertext, tag, associated_data)
+
+	def open(self, iv, ciphertext, tag, associated_data = None):
+		"""Verify and decrypt data sealed by seal(), or return None if authentication fails"""
+		if not self._verify(iv, ciphertext, tag, associated_data):
+			return None
+
+		decryptor = Cipher(algorithm = self._algorithm, mode = modes.CBC(iv), backend = backend).decryptor()
+		padded_data = decryptor.update(ciphertext) + decryptor.finalize()
+
+		padding_length = padded_data[-1] if padded_data else 0
+		if not (1 <= padding_length <= AES_BLOCK_SIZE) or (padded_data[-padding_length:] != (bytes((padding_length, )) * padding_length)):
+			return None
+		return padded_data[:-padding_length]
+
+class AEADRecordCrypter:
+	"""Seals and opens records with a single-pass AEAD (database version 2 and later), keyed once
+
+open() accepts any bytes-like arguments, such as memoryview slices of a mapped file"""
+
+	def __init__(self, key, algorithm = AEAD_AES_GCM):
+		self._aead = AEAD_ALGORITHMS[algorithm](key)
+
+	def seal(self, plaintext, associated_data = None):
+		"""Encrypt and authenticate some data, returning (nonce, ciphertext, tag)"""
+		nonce = get_random_bytes(AEAD_NONCE_SIZE)
+		sealed_data = self._aead.encrypt(nonce, plaintext, associated_data)
+		return nonce, sealed_data[:-AEAD_TAG_SIZE], sealed_data[-AEAD_TAG_SIZE:]
+
+	def verify(self, nonce, ciphertext, tag, associated_data = None):
+		"""Check the tag of data sealed by seal(); an AEAD tag can only be checked by decrypting"""
+		return self.open(nonce, ciphertext, tag, associated_data) is not None
+
+	def open(self, nonce, ciphertext, tag, associated_data = None):
+		"""Decrypt data sealed by seal(), or return None if authentication fails"""
+		try:
+			return self._aead.decrypt(nonce, b"".join((ciphertext, tag)), associated_data)
+		except InvalidTag:
+			return None
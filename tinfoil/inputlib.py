@@ -1,3 +1,8 @@
+import os
+import getpass
+
+PASSWORD_FD_ENVIRONMENT_VARIABLE = "TINFOIL_PASSWORD_FD" # a file descriptor to read the master password from, for one-shot commands and tinfoil-serve
+
 
 def ask_string(prompt, default = None, verification_function = None):
 	user_input = input(prompt)
@@ -46,3 +51,19 @@ def do_input_loop(input_function, args, kwargs, error_message = None):
 		elif not error_message is None:
 			print(error_message)
 			print()
+
+def read_secret(descriptor, prompt):
+	"""Read a secret from the next line of an open file descriptor, or ask for it with getpass if descriptor is None"""
+	if descriptor is None:
+		return getpass.getpass(prompt)
+
+	line = bytearray()
+	try:
+		while True:
+			byte = os.read(descriptor, 1) # one byte at a time, so whatever follows the line is left for the next read
+			if (not byte) or (byte == b"\n"):
+				break
+			line += byte
+	except OSError as exception:
+		raise AssertionError("cannot read from file descriptor " + str(descriptor) + ": " + exception.strerror)
+	return line.decode("utf-8").rstrip("\r")
@@ -0,0 +1,218 @@
+#!/bin/python3
+
+import sys
+import time
+import getpass
+import argparse
+
+from . import storagelib, tinfoillib, transferlib
+from .tinfoillib import TinfoilDB
+
+DEFAULT_BATCH_SIZE = 5000
+
+MIGRATION_CHECKPOINT = "migration" # the last source position whose batch is committed to the destination
+
+_source = None # (version, record crypter) in each worker, set by _initialize_worker
+_destination = None # (version, record crypter, lookup key or None, index key or None)
+
+def _initialize_worker(source_keys, destination_keys, destination_index_key = None):
+	global _source, _destination
+	source_version = source_keys[0]
+	destination_version, destination_aes_key = destination_keys[:2]
+	_source = (source_version, tinfoillib.make_record_crypter(*source_keys))
+	_destination = (destination_version, tinfoillib.make_record_crypter(*destination_keys), tinfoillib.derive_lookup_key(destination_version, destination_aes_key), destination_index_key)
+
+def _destination_hashed_key(source_version, destination_lookup_key, hashed_key):
+	"""Map a source hashed key to the destination's: SHA-512 digests from before version 5 are shortened under the destination's lookup key,
+while version 5 keys carry over unchanged, since the destination keeps the source's data key"""
+	if (destination_lookup_key is None) or (source_version >= 5):
+		return hashed_key
+	return tinfoillib.lookup_hash(destination_lookup_key, hashed_key)
+
+def _reseal_batch(rows):
+	"""Open each scanned source row and seal it for the destination, returning (last position, destination rows, destination key index rows)"""
+	source_version, source_crypter = _source
+	destination_version, destination_crypter, destination_lookup_key, destination_index_key = _destination
+
+	resealed = []
+	index_rows = []
+	for position, hashed_key, encrypted_value, iv, hmac_signature in rows:
+		plaintext = source_crypter.open(iv, encrypted_value, hmac_signature, associated_data = tinfoillib.record_associated_data(source_version, hashed_key))
+		if plaintext is None:
+			raise AssertionError("authentication failed for the source record at position " + str(position) + "!")
+
+		name, value = tinfoillib.decode_record_plaintext(source_version, plaintext) # names are only known from version 4 on
+		plaintext = tinfoillib.encode_record_plaintext(destination_version, name, value)
+
+		new_hashed_key = _destination_hashed_key(source_version, destination_lookup_key, hashed_key)
+		new_iv, new_encrypted_value, new_hmac_signature = destination_crypter.seal(plaintext, associated_data = tinfoillib.record_associated_data(destination_version, new_hashed_key))
+		resealed.append((new_hashed_key, new_encrypted_value, new_iv, new_hmac_signature))
+		if (name is not None) and (destination_index_key is not None):
+			index_rows.append(tinfoillib.make_index_row(destination_crypter, destination_index_key, new_hashed_key, name.decode("utf-8")))
+
+	return rows[-1][0], resealed, index_rows
+
+def _reseal_stream(source, destination, hashed_key, new_hashed_key):
+	"""Yield the chunks of one source stream, opened and sealed again for the destination under new_hashed_key"""
+	rows = source.storage.iterate_stream(hashed_key)
+	try:
+		previous = next(rows, None)
+		position = 0
+		while previous is not None:
+			current = next(rows, None) # look one chunk ahead, since only the last chunk is opened as final
+			chunk_index, encrypted_chunk, iv, hmac_signature = previous
+			if chunk_index != position:
+				raise AssertionError("source stream is missing chunk " + str(position) + "!")
+
+			final = (current is None)
+			chunk = source._crypter.open(iv, encrypted_chunk, hmac_signature, associated_data = tinfoillib.stream_chunk_associated_data(hashed_key, position, final))
+			if chunk is None:
+				raise AssertionError("authentication failed for chunk " + str(position) + " of a source stream!")
+
+			new_iv, new_encrypted_chunk, new_hmac_signature = destination._crypter.seal(chunk, associated_data = tinfoillib.stream_chunk_associated_data(new_hashed_key, position, final))
+			yield (position, new_encrypted_chunk, new_iv, new_hmac_signature)
+
+			previous = current
+			position += 1
+	finally:
+		rows.close()
+
+def _open_destination(source, destination_location, password, engine, scrypt_parameters, shards = None):
+	"""Open the destination, creating it with the source's scrypt parameters (unless given) or resuming an interrupted migration
+
+A version 5 source's data key is kept, since its hashed keys are derived from it and records stored without their names could not be hashed again"""
+	destination = TinfoilDB(destination_location, engine = engine, shards = shards)
+	if destination.check_database_initialized():
+		if destination.storage.load_checkpoint(MIGRATION_CHECKPOINT) is None:
+			destination.close()
+			raise AssertionError("'" + destination_location + "' already holds a database that is not an interrupted migration!")
+	else:
+		if scrypt_parameters is None:
+			kdf_parameters = source.get_kdf_parameters()
+			scrypt_parameters = (kdf_parameters["n"], kdf_parameters["r"], kdf_parameters["p"])
+		scrypt_n, scrypt_r, scrypt_p = scrypt_parameters
+
+		data_key = source.master_aes_key if (source.version >= 5) else None
+		key_size = len(data_key) if (data_key is not None) else tinfoillib.DEFAULT_AES_KEY_SIZE
+		destination.initialize_database(password = password, scrypt_n = scrypt_n, scrypt_r = scrypt_r, scrypt_p = scrypt_p, aes_key_size = key_size, aead_algorithm = (source.aead_algorithm or tinfoillib.DEFAULT_AEAD_ALGORITHM), data_key = data_key)
+		with destination.storage.transaction():
+			destination.storage.save_checkpoint(MIGRATION_CHECKPOINT, storagelib.SCAN_START)
+
+	if not destination.set_master_keys(password):
+		destination.close()
+		raise AssertionError("the master password does not unlock the interrupted migration at '" + destination_location + "'!")
+	return destination
+
+def migrate(source_location, destination_location, password, engine = None, scrypt_parameters = None, workers = None, batch_size = DEFAULT_BATCH_SIZE, report = None, shards = None):
+	"""Copy every record and stream of a database of any supported version into a new database of the current version
+
+The destination uses the same master password, and the source's scrypt parameters unless scrypt_parameters (N, r, p) is given
+shards is the shard count of a new sharded destination
+Rows are read in batches, re-encrypted on a pool of worker processes, and committed one batch per transaction together with a checkpoint,
+so running again after an interruption resumes after the last committed batch
+Returns a dict of what was copied by this run"""
+	if report is None:
+		report = lambda records: None
+
+	start = time.perf_counter()
+
+	source = TinfoilDB(source_location)
+	if not source.check_database_initialized():
+		source.close()
+		raise AssertionError("source database not yet initialized!")
+	if not source.set_master_keys(password):
+		source.close()
+		raise AssertionError("incorrect master password!")
+
+	stream_keys = source.storage.stream_keys() if source.storage.supports_streams else []
+	if stream_keys and not storagelib.resolve_engine(destination_location, engine).supports_streams:
+		source.close()
+		raise AssertionError("the source holds streams, which the destination's storage engine does not support!")
+
+	destination = _open_destination(source, destination_location, password, engine, scrypt_parameters, shards = shards)
+
+	checkpoint = destination.storage.load_checkpoint(MIGRATION_CHECKPOINT)
+
+	def commit(last_position, rows, index_rows):
+		with destination.storage.transaction():
+			existing = destination.storage.find_existing([row[0] for row in rows])
+			destination.storage.insert_many([row for row in rows if row[0] not in existing])
+			if index_rows:
+				destination.storage.insert_names([row for row in index_rows if row[0] not in existing])
+			destination.storage.save_checkpoint(MIGRATION_CHECKPOINT, last_position)
+		return len(rows) - len(existing)
+
+	records = 0
+	def consume(result):
+		nonlocal records
+		records += commit(*result)
+		report(records)
+
+	# the keys are handed to the worker processes once, through the pool's initializer
+	transferlib.run_pipeline(source.storage.scan(after = checkpoint, batch_size = batch_size), _reseal_batch, consume, workers = workers, initializer = _initialize_worker, initargs = (source.get_record_keys(), destination.get_record_keys(), (destination.get_index_key() if destination.storage.supports_index else None)))
+
+	streams = 0
+	destination_lookup_key = destination.get_lookup_key()
+	for hashed_key in stream_keys:
+		new_hashed_key = _destination_hashed_key(source.version, destination_lookup_key, hashed_key)
+		if destination.storage.contains_stream(new_hashed_key):
+			continue # copied by an earlier run
+		if destination.storage.insert_stream(new_hashed_key, _reseal_stream(source, destination, hashed_key, new_hashed_key)):
+			streams += 1
+
+	with destination.storage.transaction():
+		destination.storage.save_checkpoint(MIGRATION_CHECKPOINT, None)
+
+	source.close()
+	destination.close()
+	return {"records": records, "streams": streams, "seconds": time.perf_counter() - start}
+
+def parse_arguments(arguments = None):
+	parser = argparse.ArgumentParser(prog = "tinfoil-migrate", description = "re-encrypt a tinfoil database of any version into a new database of the current version")
+	parser.add_argument("source", help = "database to migrate; it is only read")
+	parser.add_argument("-o", "--output", default = None, help = "where to write the migrated database (default: <source>.migrated); an interrupted migration there is resumed")
+	parser.add_argument("-e", "--engine", choices = list(storagelib.ENGINES), default = None, help = "storage engine of the new database (default: the source's)")
+	parser.add_argument("--scrypt-n", type = int, default = None, help = "scrypt work factor of the new database, as a power of 2 (default: the source's)")
+	parser.add_argument("--scrypt-r", type = int, default = None, help = "scrypt memory factor of the new database (default: the source's)")
+	parser.add_argument("--scrypt-p", type = int, default = None, help = "scrypt parallelism factor of the new database (default: the source's)")
+	parser.add_argument("--shards", type = int, default = None, help = "shard files of a new sharded database (default: " + str(storagelib.DEFAULT_SHARD_COUNT) + ")")
+	parser.add_argument("-w", "--workers", type = int, default = None, help = "re-encryption processes (default: one per core)")
+	parser.add_argument("-b", "--batch-size", type = int, default = DEFAULT_BATCH_SIZE, help = "records per batch and per transaction (default: " + str(DEFAULT_BATCH_SIZE) + ")")
+	parser.add_argument("--replace", action = "store_true", help = "once finished, move the source to <source>.bak and the migrated database into its place")
+	return parser.parse_args(arguments)
+
+def main():
+	arguments = parse_arguments()
+	output = arguments.output or (arguments.source + ".migrated")
+	engine = arguments.engine or storagelib.detect_engine(arguments.source)
+
+	scrypt_parameters = None
+	if (arguments.scrypt_n is not None) or (arguments.scrypt_r is not None) or (arguments.scrypt_p is not None):
+		if None in (arguments.scrypt_n, arguments.scrypt_r, arguments.scrypt_p):
+			print("error: --scrypt-n, --scrypt-r and --scrypt-p must be given together!")
+			sys.exit(1)
+		scrypt_parameters = ((2 ** arguments.scrypt_n), arguments.scrypt_r, arguments.scrypt_p)
+
+	password = getpass.getpass("database master password: ")
+
+	def report(records):
+		print("\rmigrated " + str(records) + " records...", end = "", file = sys.stderr, flush = True)
+
+	try:
+		result = migrate(arguments.source, output, password, engine = engine, scrypt_parameters = scrypt_parameters, workers = arguments.workers, batch_size = arguments.batch_size, report = report, shards = arguments.shards)
+	except AssertionError as exception:
+		print(file = sys.stderr)
+		print("error: " + str(exception))
+		sys.exit(1)
+
+	print(file = sys.stderr)
+	print("migrated " + str(result["records"]) + " records and " + str(result["streams"]) + " streams into '" + output + "' in " + str(round(result["seconds"], 2)) + "s")
+
+	if arguments.replace:
+		backup = arguments.source + ".bak"
+		storagelib.move_store(arguments.source, backup)
+		storagelib.move_store(output, arguments.source)
+		print("'" + arguments.source + "' is now the migrated database; the original was kept as '" + backup + "'")
+
+if __name__ == "__main__":
+	main()
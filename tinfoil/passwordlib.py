@@ -1,11 +1,17 @@
+import os
+import math
 import string
 import random
+import functools
 
 LETTERS = [c for c in string.ascii_letters]
 DIGITS = [c for c in string.digits]
 SPECIAL_CHARACTERS = [c for c in string.punctuation]
 SPACES = [" "]
 
+MINIMUM_ACCEPTANCE = 1 / 1000 # policies that fewer random passwords than this satisfy are refused, rather than retried for ever
+BUFFER_MARGIN = 1.1 # random bytes drawn beyond the expected need, so one buffer almost always suffices
+
 def generate_password(length = 20, digits = True, special_characters = True, spaces = True):
 	character_space = LETTERS[:]
 	if digits:
@@ -20,3 +26,91 @@ def generate_password(length = 20, digits = True, special_characters = True, spa
 		result += random.SystemRandom().choice(character_space)
 
 	return result
+
+class PasswordPolicy:
+	"""The character space and length of generated passwords, and the fewest characters of each kind they must hold
+
+Passwords are drawn uniformly from those that satisfy the policy, so entropy_bits() is exact"""
+
+	def __init__(self, length = 20, digits = True, special_characters = True, spaces = True, min_lowercase = 0, min_uppercase = 0, min_digits = 0, min_special = 0):
+		if length < 1:
+			raise AssertionError("password length must be a positive integer!")
+		if (min_digits and not digits) or (min_special and not special_characters):
+			raise AssertionError("a policy cannot require characters it leaves out!")
+		if (min_lowercase + min_uppercase + min_digits + min_special) > length:
+			raise AssertionError("a policy cannot require more characters than the password length!")
+
+		self.length = length
+		self.classes = [(string.ascii_lowercase, min_lowercase), (string.ascii_uppercase, min_uppercase)] # (characters, minimum)
+		if digits:
+			self.classes.append((string.digits, min_digits))
+		if special_characters:
+			self.classes.append((string.punctuation, min_special))
+		if spaces:
+			self.classes.append((" ", 0))
+		self.alphabet = "".join(characters for characters, minimum in self.classes) # the same characters as generate_password's
+
+		self._required = [(characters.encode("ascii"), minimum) for characters, minimum in self.classes if minimum]
+		if self.acceptance() < MINIMUM_ACCEPTANCE:
+			raise AssertionError("too few passwords of length " + str(length) + " satisfy this policy!")
+
+	def count(self):
+		"""Return the number of passwords that satisfy the policy"""
+		ways = [1] + ([0] * self.length) # ways[n]: strings of n characters from the classes so far, meeting their minimums
+		for characters, minimum in self.classes:
+			merged = [0] * (self.length + 1)
+			for n, count in enumerate(ways):
+				if count:
+					for k in range(minimum, self.length - n + 1): # k characters of this class, interleaved among the n
+						merged[n + k] += count * math.comb(n + k, k) * (len(characters) ** k)
+			ways = merged
+		return ways[self.length]
+
+	def entropy_bits(self):
+		return math.log2(self.count())
+
+	def acceptance(self):
+		"""Return the fraction of uniformly random strings over the alphabet that satisfy the policy"""
+		return self.count() / (len(self.alphabet) ** self.length)
+
+	def accepts(self, password):
+		"""Check a password given as ASCII bytes against the policy's minimums"""
+		for characters, minimum in self._required:
+			if (len(password) - len(password.translate(None, characters))) < minimum:
+				return False
+		return True
+
+@functools.lru_cache(maxsize = None)
+def _byte_mapping(alphabet):
+	"""Return (table, rejected) for bytes.translate, mapping random bytes uniformly onto the alphabet
+
+Bytes from the largest multiple of the alphabet's size up are deleted, so every remaining residue is equally likely"""
+	size = len(alphabet)
+	limit = 256 - (256 % size)
+	table = bytes(ord(alphabet[byte % size]) for byte in range(256))
+	return table, bytes(range(limit, 256))
+
+def generate_passwords(count, policy = None):
+	"""Generate count passwords satisfying the policy (by default, a PasswordPolicy()) from a single buffer of random bytes
+
+Bytes are mapped onto the alphabet by rejection sampling, and passwords missing a required kind of character are discarded whole,
+so each password is drawn uniformly from those that satisfy the policy; another buffer is drawn only if the first falls short"""
+	if policy is None:
+		policy = PasswordPolicy()
+
+	table, rejected = _byte_mapping(policy.alphabet)
+	bytes_per_character = 256 / (256 - len(rejected))
+	acceptance = policy.acceptance()
+
+	passwords = []
+	while len(passwords) < count:
+		needed = (count - len(passwords)) * policy.length
+		characters = os.urandom(int(needed * bytes_per_character * BUFFER_MARGIN / acceptance) + 64).translate(table, rejected)
+		for offset in range(0, len(characters) - policy.length + 1, policy.length):
+			candidate = characters[offset:(offset + policy.length)]
+			if policy.accepts(candidate):
+				passwords.append(candidate.decode("ascii"))
+				if len(passwords) == count:
+					break
+
+	return passwords
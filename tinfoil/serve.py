@@ -0,0 +1,570 @@
+#!/bin/python3
+
+import os
+import sys
+import hmac
+import json
+import queue
+import signal
+import socket
+import secrets
+import argparse
+import ipaddress
+import threading
+import http.server
+import socketserver
+import urllib.parse
+import concurrent.futures
+
+from . import agent, cachelib, cryptolib, servelib, tinfoillib
+from .tinfoillib import TinfoilDB
+from .inputlib import PASSWORD_FD_ENVIRONMENT_VARIABLE, read_secret
+
+DEFAULT_DATABASE = "tinfoil.db"
+DEFAULT_WORKERS = 1
+
+BATCH_LIMIT = 256 # requests taken off the queue together
+POOL_MINIMUM_BATCH = 64 # fewer gets than this are decrypted on the batching thread, since handing them to a worker costs more than it saves
+SOCKET_WRITE_BUFFER_SIZE = 64 * 1024 # responses are flushed once no more are ready, so a pipelined batch goes back in few writes
+LISTEN_BACKLOG = 128 # connections waiting to be accepted; beyond this, new clients are refused
+
+_worker = None # (version, record crypter) in each worker process, set by _initialize_worker
+
+def _initialize_worker(record_keys):
+	global _worker
+	_worker = (record_keys[0], tinfoillib.make_record_crypter(*record_keys))
+
+def _open_records(rows):
+	"""Authenticate and decrypt (position, hashed_key, encrypted_value, iv, hmac_signature) rows,
+returning (position, value) pairs, where value is None for a record that failed authentication"""
+	version, crypter = _worker
+
+	opened = []
+	for position, hashed_key, encrypted_value, iv, hmac_signature in rows:
+		plaintext = crypter.open(iv, encrypted_value, hmac_signature, associated_data = tinfoillib.record_associated_data(version, hashed_key))
+		if plaintext is None:
+			opened.append((position, None))
+		else:
+			opened.append((position, tinfoillib.decode_record_plaintext(version, plaintext)[1].decode("utf-8")))
+	return opened
+
+class _Request:
+	"""One request waiting for the batching thread to answer it"""
+
+	__slots__ = ("op", "key", "value", "response", "done")
+
+	def __init__(self, op, key = None, value = None):
+		self.op = op
+		self.key = key
+		self.value = value
+		self.response = None
+		self.done = threading.Event()
+
+	def finish(self, result = None, error = None):
+		if error is None:
+			self.response = {"ok": True, "result": result}
+		else:
+			self.response = {"ok": False, "error": error}
+		self.done.set()
+
+	def wait(self):
+		"""Return the response, as a protocol dict, once the request is answered"""
+		self.done.wait()
+		return self.response
+
+def _failed_request(error):
+	request = _Request(None)
+	request.finish(error = error)
+	return request
+
+class RequestBatcher:
+	"""Answers requests from every connection on a single thread, which opens and owns the database
+
+Whatever requests are queued when the thread comes to them are taken together, up to BATCH_LIMIT, so batches grow with the load;
+each run of gets, checks or sets among them is answered with one retrieve_records, check_records or store_records call,
+in the order they were queued, so a connection always reads its own writes"""
+
+	def __init__(self, open_database, workers = DEFAULT_WORKERS):
+		self.database = None
+		self.workers = workers
+		self.requests = 0
+		self.batches = 0
+		self._open_database = open_database # called on the batching thread, returning an unlocked TinfoilDB
+		self._executor = None
+		self._queue = queue.SimpleQueue()
+		self._started = threading.Event()
+		self._error = None
+
+		self._thread = threading.Thread(target = self._run, name = "tinfoil-serve-batcher")
+		self._thread.start()
+		self._started.wait()
+		if self._error is not None:
+			self._thread.join()
+			raise self._error
+
+	def submit(self, request):
+		"""Queue a decoded request, returning a _Request whose wait() gives the response"""
+		if not isinstance(request, dict):
+			return _failed_request("requests must be JSON objects!")
+
+		operation = request.get("op")
+		if operation not in servelib.OPERATIONS:
+			return _failed_request("unknown operation '" + str(operation) + "'!")
+		if operation == "ping":
+			answered = _Request(operation)
+			answered.finish(True)
+			return answered
+
+		key = request.get("key")
+		value = request.get("value")
+		if not isinstance(key, str):
+			return _failed_request("the key must be a string!")
+		if (operation == "set") and not isinstance(value, str):
+			return _failed_request("the value must be a string!")
+
+		queued = _Request(operation, key, value)
+		self._queue.put(queued)
+		return queued
+
+	def stop(self):
+		"""Answer the requests already queued, then wipe the keys and close the database"""
+		self._queue.put(None)
+		self._thread.join()
+
+	def _run(self):
+		try:
+			self.database = self._open_database()
+			if self.workers > 1:
+				self._executor = concurrent.futures.ProcessPoolExecutor(max_workers = self.workers, initializer = _initialize_worker, initargs = (self.database.get_record_keys(), ))
+		except Exception as exception:
+			self._error = exception
+			self._started.set()
+			return
+		self._started.set()
+
+		try:
+			while True:
+				request = self._queue.get()
+				if request is None:
+					break
+
+				batch = [request]
+				while len(batch) < BATCH_LIMIT:
+					try:
+						request = self._queue.get_nowait()
+					except queue.Empty:
+						break
+					if request is None:
+						self._queue.put(None) # stop once this batch is answered
+						break
+					batch.append(request)
+
+				self._answer(batch)
+		finally:
+			self._close()
+
+	def _answer(self, batch):
+		self.requests += len(batch)
+		self.batches += 1
+
+		start = 0
+		while start < len(batch):
+			end = start + 1
+			while (end < len(batch)) and (batch[end].op == batch[start].op):
+				end += 1
+
+			run = batch[start:end]
+			try:
+				self._answer_run(run)
+			except Exception as exception:
+				print("warning: answering a run of " + str(len(run)) + " " + run[0].op + " requests one at a time after " + type(exception).__name__ + ": " + str(exception), file = sys.stderr)
+				for request in run: # such as a record that fails authentication; answered one at a time, only its own request fails
+					if not request.done.is_set():
+						self._answer_alone(request)
+			start = end
+
+	def _answer_run(self, run):
+		operation = run[0].op
+		keys = [request.key for request in run]
+
+		if operation == "get":
+			results, failed = self._retrieve(keys)
+			for request in run:
+				if request.key in failed:
+					request.finish(error = "authentication failed for record with key '" + request.key + "'!")
+				else:
+					request.finish(results[request.key])
+
+		elif operation == "check":
+			results = self.database.check_records(keys)
+			for request in run:
+				request.finish(results[request.key])
+
+		else:
+			mapping = {}
+			for request in run:
+				mapping.setdefault(request.key, request.value)
+			results = self.database.store_records(mapping)
+
+			stored = set()
+			for request in run:
+				request.finish(results[request.key] and (request.key not in stored)) # a later set of the same key finds the first one's record
+				stored.add(request.key)
+
+	def _answer_alone(self, request):
+		try:
+			if request.op == "get":
+				result = self.database.retrieve_record(request.key)
+			elif request.op == "check":
+				result = self.database.check_record(request.key)
+			else:
+				result = self.database.store_record(request.key, request.value)
+		except Exception as exception:
+			request.finish(error = str(exception))
+			return
+		request.finish(result)
+
+	def _retrieve(self, keys):
+		"""Return (dict of key -> value or None, set of keys whose records failed authentication)"""
+		if (self._executor is None) or (len(keys) < POOL_MINIMUM_BATCH):
+			return self.database.retrieve_records(keys), set() # a record failing authentication raises, and the run is answered one at a time
+
+		# one query on this thread, then the records are authenticated and decrypted in slices across the worker processes
+		# the database's cache, if any, is bypassed
+		keys = list(dict.fromkeys(keys))
+		lookup_key = self.database.get_lookup_key()
+		hashed_keys = [tinfoillib.hash_key(lookup_key, key) for key in keys]
+		found = self.database.storage.get_many(hashed_keys)
+		rows = [(position, hashed_key) + tuple(bytes(field) for field in found[hashed_key]) for position, hashed_key in enumerate(hashed_keys) if hashed_key in found] # copied, since the log engine returns memoryviews, which cannot be pickled
+
+		results = dict.fromkeys(keys)
+		failed = set()
+		if rows:
+			slice_size = -(-len(rows) // self.workers) # rounded up, so there is one slice per worker
+			slices = [rows[start:(start + slice_size)] for start in range(0, len(rows), slice_size)]
+			for opened in self._executor.map(_open_records, slices):
+				for position, value in opened:
+					if value is None:
+						failed.add(keys[position])
+					results[keys[position]] = value
+		return results, failed
+
+	def _close(self):
+		if self._executor is not None:
+			self._executor.shutdown(cancel_futures = True)
+		if self.database is not None:
+			for key in (self.database.master_aes_key, self.database.master_hmac_key):
+				if isinstance(key, bytearray):
+					cachelib.wipe(key)
+			self.database.clear_master_keys()
+			self.database.close()
+
+class _SocketRequestHandler(socketserver.StreamRequestHandler):
+	"""Reads JSON line requests from one connection and queues each as it arrives, while a second thread writes the responses back in order,
+so a client can pipeline many requests and have them batched together"""
+
+	wbufsize = SOCKET_WRITE_BUFFER_SIZE
+
+	def handle(self):
+		uid = agent.peer_uid(self.connection)
+		if (uid is not None) and (uid != os.getuid()):
+			return # only the server's own user may talk to it
+
+		pending = queue.SimpleQueue()
+		writer = threading.Thread(target = self._write_responses, args = (pending, ))
+		writer.start()
+		try:
+			while True:
+				line = self.rfile.readline(servelib.MAX_REQUEST_SIZE + 1)
+				if not line:
+					break
+				if len(line) > servelib.MAX_REQUEST_SIZE:
+					pending.put(_failed_request("request too large!"))
+					break
+
+				try:
+					request = json.loads(line)
+				except ValueError as exception:
+					pending.put(_failed_request("malformed request: " + str(exception)))
+					continue
+				pending.put(self.server.batcher.submit(request))
+		finally:
+			pending.put(None)
+			writer.join()
+
+	def _write_responses(self, pending):
+		connected = True
+		while True:
+			request = pending.get()
+			if request is None:
+				break
+
+			response = request.wait()
+			if not connected:
+				continue # the client has gone; its requests are still answered, so the batching thread never waits on them
+			try:
+				self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+				if pending.empty():
+					self.wfile.flush()
+			except OSError:
+				connected = False
+
+		if connected:
+			try:
+				self.wfile.flush()
+			except OSError:
+				pass
+
+class SocketServer(socketserver.ThreadingUnixStreamServer):
+	"""Serves a RequestBatcher over a Unix domain socket that only its own user can connect to, with a thread per connection"""
+
+	daemon_threads = True
+	request_queue_size = LISTEN_BACKLOG
+
+	def __init__(self, socket_path, batcher):
+		self.batcher = batcher
+
+		agent.prepare_runtime_path(socket_path)
+		old_umask = os.umask(0o177) # the socket is created 0600
+		try:
+			super().__init__(socket_path, _SocketRequestHandler)
+		finally:
+			os.umask(old_umask)
+		self.socket_path = socket_path
+
+	def server_close(self):
+		super().server_close()
+		if os.path.exists(self.socket_path):
+			os.unlink(self.socket_path)
+
+class _HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1" # connections are kept alive between requests
+	server_version = "tinfoil-serve"
+	disable_nagle_algorithm = True # headers and body are written separately; otherwise each response waits for the client's delayed acknowledgement
+
+	def log_message(self, format, *args):
+		pass # request paths hold key names, so nothing is logged
+
+	def _respond(self, status, body = b"", content_type = "text/plain; charset=utf-8"):
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.send_header("Cache-Control", "no-store")
+		self.end_headers()
+		if self.command != "HEAD":
+			self.wfile.write(body)
+
+	def _refuse(self, status, message):
+		self.close_connection = True # the request's body may not have been read, so the connection cannot be reused
+		self._respond(status, (message + "\n").encode("utf-8"))
+
+	def _authorized(self):
+		supplied = self.headers.get("Authorization", "").encode("utf-8")
+		if hmac.compare_digest(supplied, ("Bearer " + self.server.token).encode("utf-8")):
+			return True
+		self._refuse(401, "missing or incorrect access token")
+		return False
+
+	def _read_body(self):
+		try:
+			length = int(self.headers.get("Content-Length", "0"))
+		except ValueError:
+			length = -1
+		if (length < 0) or (length > servelib.MAX_REQUEST_SIZE):
+			self._refuse(413, "request body missing a valid length, or too large")
+			return None
+		return self.rfile.read(length)
+
+	def _record_key(self):
+		path = urllib.parse.urlsplit(self.path).path
+		if not path.startswith(servelib.RECORDS_PATH):
+			self._refuse(400, "unknown path")
+			return None
+		return urllib.parse.unquote(path[len(servelib.RECORDS_PATH):])
+
+	def _record_request(self, operation):
+		if not self._authorized():
+			return
+		key = self._record_key()
+		if key is None:
+			return
+
+		request = {"op": operation, "key": key}
+		if operation == "set":
+			body = self._read_body()
+			if body is None:
+				return
+			try:
+				request["value"] = body.decode("utf-8")
+			except UnicodeDecodeError:
+				self._respond(400, b"values must be UTF-8 text\n")
+				return
+
+		response = self.server.batcher.submit(request).wait()
+		if not response["ok"]:
+			self._respond(500, (response["error"] + "\n").encode("utf-8"))
+		elif operation == "get":
+			if response["result"] is None:
+				self._respond(404)
+			else:
+				self._respond(200, response["result"].encode("utf-8"))
+		elif operation == "check":
+			self._respond(200 if response["result"] else 404)
+		else:
+			self._respond(201 if response["result"] else 409)
+
+	def do_GET(self):
+		self._record_request("get")
+
+	def do_HEAD(self):
+		self._record_request("check")
+
+	def do_PUT(self):
+		self._record_request("set")
+
+	def do_POST(self):
+		if not self._authorized():
+			return
+		if urllib.parse.urlsplit(self.path).path != servelib.BATCH_PATH:
+			self._refuse(400, "unknown path")
+			return
+		body = self._read_body()
+		if body is None:
+			return
+
+		try:
+			requests = json.loads(body)
+		except ValueError as exception:
+			self._respond(400, ("malformed request: " + str(exception) + "\n").encode("utf-8"))
+			return
+		if not isinstance(requests, list):
+			self._respond(400, b"batches must be JSON lists of requests\n")
+			return
+
+		queued = [self.server.batcher.submit(request) for request in requests] # all queued before any is waited on, so they are answered together
+		self._respond(200, json.dumps([request.wait() for request in queued]).encode("utf-8"), content_type = "application/json")
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+	"""Serves a RequestBatcher over HTTP on a loopback address, to clients presenting the access token"""
+
+	daemon_threads = True
+	request_queue_size = LISTEN_BACKLOG
+
+	def __init__(self, address, batcher, token):
+		host = ipaddress.ip_address(address[0])
+		if not host.is_loopback:
+			raise AssertionError("tinfoil-serve only listens on loopback addresses!")
+		if host.version == 6:
+			self.address_family = socket.AF_INET6
+
+		self.batcher = batcher
+		self.token = token
+		super().__init__(address, _HTTPRequestHandler)
+
+def write_token_file(path, token):
+	"""Write the HTTP access token to a new file that only its owner can read"""
+	agent.prepare_runtime_path(path)
+	descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+	with os.fdopen(descriptor, "w") as f:
+		f.write(token + "\n")
+
+def parse_arguments(arguments = None):
+	parser = argparse.ArgumentParser(prog = "tinfoil-serve", description = "unlock a tinfoil database once and answer get, check and set requests from local programs, batching concurrent requests together")
+	parser.add_argument("-d", "--database", default = DEFAULT_DATABASE, help = "database location (default: " + DEFAULT_DATABASE + ")")
+	parser.add_argument("-a", "--socket", default = None, help = "socket path (default: $" + servelib.SOCKET_ENVIRONMENT_VARIABLE + ", or " + servelib.default_socket_path() + ")")
+	parser.add_argument("--no-socket", action = "store_true", help = "do not serve the Unix socket; requires --http")
+	parser.add_argument("--http", action = "store_true", help = "also serve HTTP on a loopback address, to clients presenting the access token")
+	parser.add_argument("--http-host", default = servelib.DEFAULT_HTTP_HOST, help = "loopback address to serve HTTP on (default: " + servelib.DEFAULT_HTTP_HOST + ")")
+	parser.add_argument("--http-port", type = int, default = servelib.DEFAULT_HTTP_PORT, help = "port to serve HTTP on (default: " + str(servelib.DEFAULT_HTTP_PORT) + ")")
+	parser.add_argument("--token-file", default = None, help = "file the HTTP access token is written to (default: $" + servelib.TOKEN_FILE_ENVIRONMENT_VARIABLE + ", or " + servelib.default_token_file() + ")")
+	parser.add_argument("-w", "--workers", type = int, default = DEFAULT_WORKERS, help = "processes to decrypt large batches of gets in (default: " + str(DEFAULT_WORKERS) + ", decrypt on the batching thread)")
+	parser.add_argument("--password-fd", type = int, default = None, metavar = "FD", help = "read the master password from the next line of this open file descriptor (default: $" + PASSWORD_FD_ENVIRONMENT_VARIABLE + ", or prompt)")
+	parser.add_argument("--cache-size", type = int, default = 0, help = "decrypted values to keep in memory, so fetching them again is faster (default: 0, no cache)")
+	parser.add_argument("--cache-ttl", type = int, default = cachelib.DEFAULT_CACHE_TTL, help = "seconds a decrypted value is kept (default: " + str(cachelib.DEFAULT_CACHE_TTL) + ")")
+
+	parsed = parser.parse_args(arguments)
+	if parsed.no_socket and not parsed.http:
+		parser.error("--no-socket leaves nothing to serve without --http")
+	if (parsed.password_fd is None) and os.environ.get(PASSWORD_FD_ENVIRONMENT_VARIABLE):
+		try:
+			parsed.password_fd = int(os.environ[PASSWORD_FD_ENVIRONMENT_VARIABLE])
+		except ValueError:
+			parser.error(PASSWORD_FD_ENVIRONMENT_VARIABLE + " must be a file descriptor number")
+	return parsed
+
+def main():
+	arguments = parse_arguments()
+	socket_path = arguments.socket or os.environ.get(servelib.SOCKET_ENVIRONMENT_VARIABLE) or servelib.default_socket_path()
+	token_file = arguments.token_file or os.environ.get(servelib.TOKEN_FILE_ENVIRONMENT_VARIABLE) or servelib.default_token_file()
+
+	database = TinfoilDB(arguments.database)
+	if not database.check_database_initialized():
+		print("error: database is not initialized! run 'tinfoil' to set it up first", file = sys.stderr)
+		sys.exit(1)
+
+	while True:
+		password = read_secret(arguments.password_fd, "database master password: ")
+		if password:
+			master_key = cryptolib.do_scrypt_parallel(password = password, **database.get_kdf_parameters())
+			if database.set_derived_master_key(master_key):
+				break
+		if arguments.password_fd is not None:
+			print("error: incorrect master password!", file = sys.stderr)
+			sys.exit(1)
+		print("incorrect master password!")
+		print()
+
+	database.close()
+
+	if not agent.protect_process_memory():
+		print("warning: could not lock server memory; keys may be swapped to disk", file = sys.stderr)
+
+	def open_database():
+		served = TinfoilDB(arguments.database, session = True, cache_size = arguments.cache_size, cache_ttl = arguments.cache_ttl)
+		served.set_derived_master_key(master_key)
+		served.master_aes_key = bytearray(served.master_aes_key) # mutable copies, so they can be wiped on exit
+		served.master_hmac_key = bytearray(served.master_hmac_key)
+		return served
+
+	batcher = RequestBatcher(open_database, workers = arguments.workers)
+	del master_key
+
+	stop = threading.Event()
+	signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+	servers = []
+	def serve(server):
+		servers.append(server) # started straight away, since shutdown() waits for serve_forever() to stop
+		threading.Thread(target = server.serve_forever, daemon = True).start()
+
+	token_written = False
+	try:
+		if not arguments.no_socket:
+			serve(SocketServer(socket_path, batcher))
+			print(servelib.SOCKET_ENVIRONMENT_VARIABLE + "=" + socket_path + "; export " + servelib.SOCKET_ENVIRONMENT_VARIABLE + ";")
+		if arguments.http:
+			token = secrets.token_urlsafe(32)
+			write_token_file(token_file, token)
+			token_written = True
+			serve(HTTPServer((arguments.http_host, arguments.http_port), batcher, token))
+			print(servelib.TOKEN_FILE_ENVIRONMENT_VARIABLE + "=" + token_file + "; export " + servelib.TOKEN_FILE_ENVIRONMENT_VARIABLE + ";")
+			print("# serving HTTP on " + arguments.http_host + ":" + str(arguments.http_port))
+		sys.stdout.flush()
+
+		try:
+			while not stop.wait(1):
+				pass
+		except KeyboardInterrupt:
+			pass
+	finally:
+		for server in servers:
+			server.shutdown()
+			server.server_close()
+		if token_written and os.path.exists(token_file):
+			os.unlink(token_file)
+		batcher.stop()
+
+	print("answered " + str(batcher.requests) + " requests in " + str(batcher.batches) + " batches", file = sys.stderr)
+
+if __name__ == "__main__":
+	main()
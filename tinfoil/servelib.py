@@ -0,0 +1,197 @@
+import os
+import json
+import socket
+import threading
+import http.client
+import urllib.parse
+
+from . import agent
+
+SOCKET_ENVIRONMENT_VARIABLE = "TINFOIL_SERVE_SOCK"
+TOKEN_FILE_ENVIRONMENT_VARIABLE = "TINFOIL_SERVE_TOKEN_FILE"
+
+DEFAULT_HTTP_HOST = "127.0.0.1"
+DEFAULT_HTTP_PORT = 8237
+
+CLIENT_TIMEOUT = 30 # seconds
+MAX_REQUEST_SIZE = 1024 * 1024 # bytes in one request line or HTTP body
+
+OPERATIONS = ("ping", "get", "check", "set")
+
+# over HTTP, a record is read with GET, checked with HEAD and stored with PUT at RECORDS_PATH + its percent-encoded key;
+# POSTing a JSON list of {"op": ..., "key": ..., "value": ...} requests to BATCH_PATH returns a list of {"ok": ..., "result"/"error": ...} responses
+RECORDS_PATH = "/records/"
+BATCH_PATH = "/batch"
+
+def default_socket_path():
+	return agent.runtime_path("tinfoil-serve.sock")
+
+def default_token_file():
+	return agent.runtime_path("tinfoil-serve.token")
+
+def record_path(key):
+	return RECORDS_PATH + urllib.parse.quote(key, safe = "")
+
+def _result(response):
+	if not response["ok"]:
+		raise AssertionError("tinfoil-serve error: " + response["error"])
+	return response["result"]
+
+class ServeClient:
+	"""Talks to tinfoil-serve over its Unix socket; mirrors the TinfoilDB record methods so it can stand in for an unlocked database
+
+The connection is kept open between requests, and the batch methods send all of their requests before reading any response,
+so the server can answer them with a single query; a client may be shared between threads, which take turns on the connection"""
+
+	def __init__(self, socket_path = None):
+		if socket_path is None:
+			socket_path = os.environ.get(SOCKET_ENVIRONMENT_VARIABLE) or default_socket_path()
+		self.socket_path = socket_path
+		self._connection = None
+		self._stream = None
+		self._lock = threading.Lock()
+
+	def _connect(self):
+		if self._connection is None:
+			connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			connection.settimeout(CLIENT_TIMEOUT)
+			try:
+				connection.connect(self.socket_path)
+			except OSError:
+				connection.close()
+				raise
+			self._connection = connection
+			self._stream = connection.makefile("rwb")
+		return self._stream
+
+	def _exchange(self, requests):
+		"""Send requests, then read one response for each, in order"""
+		with self._lock:
+			stream = self._connect()
+			try:
+				stream.write(b"".join(json.dumps(request).encode("utf-8") + b"\n" for request in requests))
+				stream.flush()
+
+				responses = []
+				for _ in requests:
+					line = stream.readline()
+					if not line:
+						raise AssertionError("tinfoil-serve closed the connection!")
+					responses.append(json.loads(line))
+			except (OSError, AssertionError):
+				self._disconnect() # a connection left midway through a response cannot be reused
+				raise
+		return responses
+
+	def _request(self, **request):
+		return _result(self._exchange([request])[0])
+
+	def ping(self):
+		return self._request(op = "ping")
+
+	def retrieve_record(self, key):
+		return self._request(op = "get", key = key)
+
+	def check_record(self, key):
+		return self._request(op = "check", key = key)
+
+	def store_record(self, key, value):
+		return self._request(op = "set", key = key, value = value)
+
+	def retrieve_records(self, keys):
+		"""Retrieve many records at once, returning a dict mapping each key to its value, or None if no record exists for it"""
+		keys = list(keys)
+		return {key: _result(response) for key, response in zip(keys, self._exchange([{"op": "get", "key": key} for key in keys]))}
+
+	def check_records(self, keys):
+		keys = list(keys)
+		return {key: _result(response) for key, response in zip(keys, self._exchange([{"op": "check", "key": key} for key in keys]))}
+
+	def store_records(self, mapping):
+		"""Store many key/value pairs at once, returning a dict mapping each key to True if it was stored, or False if a record already existed for it"""
+		return {key: _result(response) for key, response in zip(mapping, self._exchange([{"op": "set", "key": key, "value": value} for key, value in mapping.items()]))}
+
+	def _disconnect(self):
+		if self._connection is not None:
+			self._stream.close()
+			self._connection.close()
+			self._connection = None
+			self._stream = None
+
+	def close(self):
+		with self._lock:
+			self._disconnect()
+
+class HTTPServeClient:
+	"""Talks to tinfoil-serve over loopback HTTP, with the same methods as ServeClient
+
+Every request carries the server's access token, read from token_file (by default, TINFOIL_SERVE_TOKEN_FILE or the server's default) unless given"""
+
+	def __init__(self, port = DEFAULT_HTTP_PORT, host = DEFAULT_HTTP_HOST, token = None, token_file = None):
+		if token is None:
+			if token_file is None:
+				token_file = os.environ.get(TOKEN_FILE_ENVIRONMENT_VARIABLE) or default_token_file()
+			with open(token_file, "r") as f:
+				token = f.read().strip()
+
+		self.host = host
+		self.port = port
+		self._headers = {"Authorization": "Bearer " + token}
+		self._connection = None
+		self._lock = threading.Lock()
+
+	def _send(self, method, path, body = None, headers = None):
+		"""Return (status, body) for one HTTP request, over a kept-alive connection"""
+		with self._lock:
+			if self._connection is None:
+				self._connection = http.client.HTTPConnection(self.host, self.port, timeout = CLIENT_TIMEOUT)
+			try:
+				self._connection.request(method, path, body = body, headers = dict(self._headers, **(headers or {})))
+				response = self._connection.getresponse()
+				content = response.read()
+			except (OSError, http.client.HTTPException):
+				self._connection.close()
+				self._connection = None
+				raise
+
+		if response.status == 401:
+			raise AssertionError("tinfoil-serve refused the access token!")
+		if response.status >= 400 and response.status not in (404, 409):
+			raise AssertionError("tinfoil-serve error: " + content.decode("utf-8", "replace"))
+		return response.status, content
+
+	def _batch(self, requests):
+		status, content = self._send("POST", BATCH_PATH, body = json.dumps(requests).encode("utf-8"), headers = {"Content-Type": "application/json"})
+		return json.loads(content)
+
+	def ping(self):
+		return _result(self._batch([{"op": "ping"}])[0])
+
+	def retrieve_record(self, key):
+		status, content = self._send("GET", record_path(key))
+		return content.decode("utf-8") if status == 200 else None
+
+	def check_record(self, key):
+		status, content = self._send("HEAD", record_path(key))
+		return (status == 200)
+
+	def store_record(self, key, value):
+		status, content = self._send("PUT", record_path(key), body = value.encode("utf-8"), headers = {"Content-Type": "text/plain; charset=utf-8"})
+		return (status == 201)
+
+	def retrieve_records(self, keys):
+		keys = list(keys)
+		return {key: _result(response) for key, response in zip(keys, self._batch([{"op": "get", "key": key} for key in keys]))}
+
+	def check_records(self, keys):
+		keys = list(keys)
+		return {key: _result(response) for key, response in zip(keys, self._batch([{"op": "check", "key": key} for key in keys]))}
+
+	def store_records(self, mapping):
+		return {key: _result(response) for key, response in zip(mapping, self._batch([{"op": "set", "key": key, "value": value} for key, value in mapping.items()]))}
+
+	def close(self):
+		with self._lock:
+			if self._connection is not None:
+				self._connection.close()
+				self._connection = None
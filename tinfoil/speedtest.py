@@ -1,19 +1,34 @@
 #!/bin/python3
 
-import time
-import math
 import os
+import sys
+import math
+import json
+import time
+import argparse
+import resource
+import statistics
+import multiprocessing
 
-import scrypt
-
-from . import inputlib
+from . import cryptolib, inputlib
 
 DEFAULT_MAX_RAM = 6
 DEFAULT_MAX_TIME = 5
 
 MINIMUM_N = 14
+MAXIMUM_N = 23 # matches the range accepted by 'tinfoil' at setup
 
 DEFAULT_R = 8
+R_VALUES = (8, 16)
+
+DEFAULT_SAMPLES = 3
+PROBE_SAMPLES = 3
+
+VERIFIED_CANDIDATES = 2 # (r, p) pairs measured near the budget, after ranking every pair by extrapolation
+
+CONFIDENCE_STDEVS = 2 # a setting fits if (mean + 2 * stdev) stays within the time budget
+
+DEFAULT_CALIBRATION_FILE = "tinfoil-spd.json"
 
 def is_positive_integer(number):
 	return (number > 0)
@@ -40,39 +55,197 @@ def ask_parameters():
 
 	return (max_ram, max_time)
 
+def get_max_N(max_ram, r = DEFAULT_R, concurrent_lanes = 1):
+	# https://stackoverflow.com/a/30308723 -- each running lane holds 128 * r * N bytes
+	return math.floor(math.log2((max_ram * (10 ** 9)) // (128 * r * concurrent_lanes)))
 
-def get_max_N(max_ram):
-	# https://stackoverflow.com/a/30308723
-	return math.floor(math.log2((max_ram * (10 ** 9)) // (128 * DEFAULT_R)))
-
-def main():
-	max_ram, max_time = ask_parameters()
+def default_p_values():
+	cores = os.cpu_count() or 1
+	return tuple(2 ** i for i in range(cores.bit_length()) if (2 ** i) <= cores)
 
+def _timed_scrypt(n, r, p, connection):
+	"""Run in a child process: derive once and report (elapsed seconds, peak RSS growth in bytes)"""
 	password = os.urandom(40) # 40 character placeholder password
-	salt = os.urandom(8) # standard 8-byte salt
+	salt = os.urandom(16)
+
+	baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	start = time.perf_counter()
+	cryptolib.do_scrypt_parallel(password = password, salt = salt, n = n, r = r, p = p, key_length = 32)
+	elapsed = time.perf_counter() - start
+
+	own_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss
+	lane_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss # parallel lanes run in worker processes
+	concurrent_lanes = min(p, os.cpu_count() or 1)
+
+	rss_unit = 1 if sys.platform == "darwin" else 1024 # ru_maxrss is bytes on macOS, KiB elsewhere
+	connection.send((elapsed, max(own_growth, lane_peak * concurrent_lanes) * rss_unit))
+	connection.close()
+
+def measure(n_exponent, r, p, samples = DEFAULT_SAMPLES):
+	"""Time one scrypt setting over several fresh processes, so every sample starts cold and peak RSS is attributable"""
+	timings = []
+	peak_rss = 0
+	for _ in range(samples):
+		receiver, sender = multiprocessing.Pipe(duplex = False)
+		process = multiprocessing.Process(target = _timed_scrypt, args = ((2 ** n_exponent), r, p, sender))
+		process.start()
+		sender.close()
+		elapsed, rss = receiver.recv()
+		process.join()
+
+		timings.append(elapsed)
+		peak_rss = max(peak_rss, rss)
+
+	mean = statistics.mean(timings)
+	variance = statistics.variance(timings) if len(timings) > 1 else 0.0
+	return {
+		"log2_n": n_exponent,
+		"n": 2 ** n_exponent,
+		"r": r,
+		"p": p,
+		"samples": timings,
+		"mean": mean,
+		"variance": variance,
+		"stdev": math.sqrt(variance),
+		"peak_rss_bytes": peak_rss,
+	}
+
+def fits(measurement, max_ram_bytes, max_time):
+	upper_time = measurement["mean"] + (CONFIDENCE_STDEVS * measurement["stdev"])
+	return (upper_time <= max_time) and (measurement["peak_rss_bytes"] <= max_ram_bytes)
+
+def strength(measurement):
+	"""Rank settings by memory hardness (N * r) first, then by total work (N * r * p)"""
+	memory = measurement["n"] * measurement["r"]
+	return (memory, memory * measurement["p"])
+
+def _search_exponent(r, p, probe, max_ram, max_time, samples, report):
+	"""Extrapolate the largest N from a cheap probe, then bisect near the budget with real measurements"""
+	max_ram_bytes = max_ram * (10 ** 9)
+	limit = min(MAXIMUM_N, get_max_N(max_ram, r, concurrent_lanes = min(p, os.cpu_count() or 1)))
+	predicted = MINIMUM_N + math.floor(math.log2(max_time / probe["mean"]))
+
+	low = max(MINIMUM_N, min(limit, predicted - 2)) # a quarter of the predicted time; expected to fit
+	high = min(limit, predicted + 1)
+
+	best = probe
+	if low > MINIMUM_N:
+		measurement = measure(low, r, p, samples)
+		report(measurement)
+		if fits(measurement, max_ram_bytes, max_time):
+			best = measurement
+		else: # the extrapolation was optimistic; fall back to the full range below it
+			high = low - 1
+			low = MINIMUM_N
+
+	while low < high:
+		middle = (low + high + 1) // 2
+		measurement = measure(middle, r, p, samples)
+		report(measurement)
+		if fits(measurement, max_ram_bytes, max_time):
+			best = measurement
+			low = middle
+		else:
+			high = middle - 1
+
+	return best
+
+def calibrate(max_ram, max_time, r_values = R_VALUES, p_values = None, samples = DEFAULT_SAMPLES, report = None):
+	"""Find the strongest (N, r, p) whose unlock fits within max_time seconds and max_ram GB
+
+Returns a JSON-serializable dict, or None if even N = 2^MINIMUM_N exceeds the budget"""
+	if p_values is None:
+		p_values = default_p_values()
+	if report is None:
+		report = lambda measurement: None
+
+	max_ram_bytes = max_ram * (10 ** 9)
+
+	# cheap probes for every (r, p) pair, ranked by the strength their extrapolated N would give
+	ranked = []
+	for r in r_values:
+		for p in p_values:
+			probe = measure(MINIMUM_N, r, p, PROBE_SAMPLES)
+			report(probe)
+			if not fits(probe, max_ram_bytes, max_time):
+				continue
+
+			limit = min(MAXIMUM_N, get_max_N(max_ram, r, concurrent_lanes = min(p, os.cpu_count() or 1)))
+			predicted = min(limit, MINIMUM_N + math.floor(math.log2(max_time / probe["mean"])))
+			estimate = {"n": 2 ** predicted, "r": r, "p": p}
+			ranked.append((strength(estimate), probe))
+
+	if not ranked:
+		return None
+
+	ranked.sort(key = lambda item: item[0], reverse = True)
+
+	candidates = []
+	for _, probe in ranked[:VERIFIED_CANDIDATES]:
+		candidates.append(_search_exponent(probe["r"], probe["p"], probe, max_ram, max_time, samples, report))
+
+	best = max(candidates, key = strength)
+	return {
+		"log2_n": best["log2_n"],
+		"n": best["n"],
+		"r": best["r"],
+		"p": best["p"],
+		"time": {"mean": best["mean"], "variance": best["variance"], "stdev": best["stdev"], "samples": best["samples"]},
+		"peak_rss_bytes": best["peak_rss_bytes"],
+		"max_ram_bytes": max_ram_bytes,
+		"max_time": max_time,
+		"cores": os.cpu_count(),
+		"candidates": candidates,
+	}
+
+def load_calibration(path = DEFAULT_CALIBRATION_FILE):
+	"""Load a result written by 'tinfoil-spd', or None if there is none at the given path"""
+	if not os.path.exists(path):
+		return None
+	with open(path, "r", encoding = "utf-8") as f:
+		return json.load(f)
+
+def parse_arguments(arguments = None):
+	parser = argparse.ArgumentParser(prog = "tinfoil-spd", description = "determine the strongest scrypt parameters for this machine")
+	parser.add_argument("--max-ram", type = int, default = None, help = "maximum RAM usage in GB")
+	parser.add_argument("--max-time", type = int, default = None, help = "maximum wait time in seconds")
+	parser.add_argument("--samples", type = int, default = DEFAULT_SAMPLES, help = "timed runs per candidate setting (default: " + str(DEFAULT_SAMPLES) + ")")
+	parser.add_argument("-o", "--output", default = DEFAULT_CALIBRATION_FILE, help = "where to write the JSON result, or '-' for stdout (default: " + DEFAULT_CALIBRATION_FILE + ")")
+	return parser.parse_args(arguments)
+
+def _print_measurement(measurement):
+	print("N = " + str(measurement["log2_n"]) + "; r = " + str(measurement["r"]) + "; p = " + str(measurement["p"]) + "; time = " + str(round(measurement["mean"], 2)) + "s +/- " + str(round(measurement["stdev"], 3)) + "s; peak RSS = " + str(round(measurement["peak_rss_bytes"] / (10 ** 6))) + "MB")
 
-	max_n = get_max_N(max_ram)
-	print("checking N values from " + str(MINIMUM_N) + " through " + str(max_n) + "...")
-	for n in range(MINIMUM_N, max_n):
-		n_exponent = 2 ** n
-		start = time.time()
-		scrypt.hash(password = password, salt = salt, N = n_exponent, r = DEFAULT_R, p = 1, buflen = 32)
-		end = time.time()
-		elapsed = round((end - start), 2)
+def main():
+	arguments = parse_arguments()
+	to_stdout = (arguments.output == "-")
 
-		if elapsed > max_time:
-			optimal_n = (n - 1)
+	if (arguments.max_ram is None) or (arguments.max_time is None):
+		max_ram, max_time = ask_parameters()
+	else:
+		max_ram, max_time = arguments.max_ram, arguments.max_time
 
+	if not to_stdout:
+		print("calibrating from N = " + str(MINIMUM_N) + " (r in " + str(list(R_VALUES)) + ", p in " + str(list(default_p_values())) + ")...")
+	result = calibrate(max_ram, max_time, samples = arguments.samples, report = (None if to_stdout else _print_measurement))
+
+	if result is None:
+		if not to_stdout:
 			print()
-			if optimal_n >= MINIMUM_N:
-				print("result: optimal N = '" + str(optimal_n) + "'")
-			else:
-				print("error: no valid values for N! please increase RAM or time allowance!")
-			print()
+			print("error: no valid values for N! please increase RAM or time allowance!")
+		sys.exit(1)
 
-			break
-		else:
-			print("N = " + str(n) + "; time = " + str(elapsed) + "s")
+	if to_stdout:
+		print(json.dumps(result, indent = 4))
+		return
+
+	with open(arguments.output, "w", encoding = "utf-8") as f:
+		json.dump(result, f, indent = 4)
+
+	print()
+	print("result: optimal N = '" + str(result["log2_n"]) + "', r = '" + str(result["r"]) + "', p = '" + str(result["p"]) + "'")
+	print("calibration saved to '" + arguments.output + "'; 'tinfoil' will offer it during database setup")
+	print()
 
 if __name__ == "__main__":
 	main()
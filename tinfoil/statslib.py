@@ -0,0 +1,255 @@
+import json
+import time
+import functools
+import threading
+import contextlib
+
+from . import cryptolib, storagelib, tinfoillib
+
+ENVIRONMENT_VARIABLE = "TINFOIL_STATS" # set to 1 to enable instrumentation as tinfoil starts
+
+# durations are counted in log-linear buckets: 8 per power of two nanoseconds, so percentiles are within 12.5%
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 2 ** SUB_BUCKET_BITS
+HISTOGRAM_BUCKETS = SUB_BUCKETS * 62 # up to 2 ** 63 nanoseconds
+
+# the phases, in display order; each is timed around the functions below, and phases nest (an operation's time includes its queries)
+PHASES = ("kdf", "hash", "hmac", "hmac_verify", "encrypt", "decrypt", "query", "commit")
+
+CRYPTO_FUNCTIONS = (
+	("do_scrypt", "kdf"),
+	("do_scrypt_parallel", "kdf"),
+	("do_sha512_hash", "hash"),
+	("do_keyed_hash", "hash"),
+	("do_hmac", "hmac"),
+	("verify_hmac", "hmac_verify"),
+	("aes_encrypt_bytes", "encrypt"),
+	("aes_decrypt_bytes", "decrypt"),
+	("aead_encrypt_bytes", "encrypt"),
+	("aead_decrypt_bytes", "decrypt"),
+)
+
+CRYPTER_METHODS = (
+	(cryptolib.RecordCrypter, "_verify", "hmac_verify"),
+	(cryptolib.RecordCrypter, "seal", "encrypt"),
+	(cryptolib.RecordCrypter, "open", "decrypt"),
+	(cryptolib.AEADRecordCrypter, "seal", "encrypt"),
+	(cryptolib.AEADRecordCrypter, "open", "decrypt"),
+)
+
+# generators such as scan() and iterate_stream() are not timed, since their work happens as they are consumed
+STORAGE_QUERIES = ("is_initialized", "load_parameters", "contains", "get", "get_many", "find_existing", "load_checkpoint", "stream_keys", "has_streams", "contains_stream", "has_index", "names", "find_names")
+STORAGE_COMMITS = ("create", "update_parameters", "insert", "delete", "insert_stream", "delete_stream")
+
+# TinfoilDB operations are timed as a whole, under their own names
+OPERATIONS = ("set_master_keys", "set_derived_master_key", "store_record", "check_record", "retrieve_record", "delete_record", "store_records", "retrieve_records", "check_records", "delete_records",
+	"list_keys", "find_keys", "rebuild_index", "verify_all", "store_stream", "retrieve_stream", "check_stream", "delete_stream", "change_master_password", "reparameterize")
+
+class Histogram:
+	"""Counts durations in nanoseconds; recording one is a bit_length() and a few additions, whatever the number recorded"""
+
+	__slots__ = ("count", "total", "maximum", "buckets")
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		self.count = 0
+		self.total = 0
+		self.maximum = 0
+		self.buckets = [0] * HISTOGRAM_BUCKETS
+
+	def record(self, nanoseconds):
+		if nanoseconds < SUB_BUCKETS:
+			index = max(nanoseconds, 0)
+		else:
+			shift = nanoseconds.bit_length() - (SUB_BUCKET_BITS + 1)
+			index = ((shift + 1) * SUB_BUCKETS) + ((nanoseconds >> shift) - SUB_BUCKETS)
+
+		self.count += 1
+		self.total += nanoseconds
+		if nanoseconds > self.maximum:
+			self.maximum = nanoseconds
+		self.buckets[min(index, HISTOGRAM_BUCKETS - 1)] += 1
+
+	@staticmethod
+	def bucket_bounds(index):
+		"""Return the [lower, upper) nanoseconds counted by a bucket"""
+		if index < SUB_BUCKETS:
+			return index, index + 1
+		shift = (index // SUB_BUCKETS) - 1
+		mantissa = SUB_BUCKETS + (index % SUB_BUCKETS)
+		return mantissa << shift, (mantissa + 1) << shift
+
+	def percentile(self, fraction):
+		"""Return the duration in nanoseconds below which the given fraction of the recorded durations fall, to within a bucket"""
+		if self.count == 0:
+			return 0
+		rank = max(1, int(round(fraction * self.count)))
+		seen = 0
+		for index, count in enumerate(self.buckets):
+			seen += count
+			if seen >= rank:
+				lower, upper = self.bucket_bounds(index)
+				return min((lower + upper) / 2, self.maximum)
+		return self.maximum
+
+	def to_dict(self):
+		return {
+			"count": self.count,
+			"total_us": self.total / 1000,
+			"mean_us": (self.total / self.count / 1000) if self.count else 0,
+			"p50_us": self.percentile(0.50) / 1000,
+			"p99_us": self.percentile(0.99) / 1000,
+			"max_us": self.maximum / 1000,
+			"buckets": [list(self.bucket_bounds(index)) + [count] for index, count in enumerate(self.buckets) if count], # [lower_ns, upper_ns, count]
+		}
+
+# phases that an instrumented function can enter again from inside itself, such as do_scrypt inside do_scrypt_parallel, or a log insert() opening a transaction
+# only their wrappers track what is running on each thread, so the inner call is not counted twice
+NESTING_PHASES = ("kdf", "commit")
+
+_histograms = {} # histograms are never replaced, only cleared, so each wrapper holds on to its own
+_lock = threading.Lock() # held only while a duration is added
+_active = threading.local()
+_patched = [] # (owner, attribute, original) for each function replaced by enable()
+
+def histogram(phase):
+	"""Return the histogram a phase or operation is recorded in"""
+	with _lock:
+		if phase not in _histograms:
+			_histograms[phase] = Histogram()
+		return _histograms[phase]
+
+def record(phase, nanoseconds):
+	"""Add one duration to the histogram of a phase, such as one timed outside the instrumented functions"""
+	target = histogram(phase)
+	with _lock:
+		target.record(nanoseconds)
+
+def _active_phases():
+	phases = getattr(_active, "phases", None)
+	if phases is None:
+		phases = _active.phases = set()
+	return phases
+
+def _timed(phase, function):
+	target = histogram(phase)
+	perf_counter_ns = time.perf_counter_ns
+
+	if phase not in NESTING_PHASES:
+		@functools.wraps(function)
+		def timed(*args, **kwargs):
+			start = perf_counter_ns()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				elapsed = perf_counter_ns() - start
+				with _lock:
+					target.record(elapsed)
+		return timed
+
+	@functools.wraps(function)
+	def timed_once(*args, **kwargs):
+		phases = _active_phases()
+		if phase in phases:
+			return function(*args, **kwargs)
+
+		phases.add(phase)
+		start = perf_counter_ns()
+		try:
+			return function(*args, **kwargs)
+		finally:
+			record(phase, perf_counter_ns() - start)
+			phases.discard(phase)
+	return timed_once
+
+def _timed_transaction(transaction):
+	"""Time what transaction() does once the block inside it is done, which is the commit"""
+	@functools.wraps(transaction)
+	@contextlib.contextmanager
+	def timed(self):
+		phases = _active_phases()
+		if "commit" in phases: # a transaction opened by insert() or delete(), which are already timed
+			with transaction(self):
+				yield
+			return
+
+		start = None
+		try:
+			with transaction(self):
+				yield
+				phases.add("commit")
+				start = time.perf_counter_ns()
+		finally:
+			if start is not None:
+				record("commit", time.perf_counter_ns() - start)
+				phases.discard("commit")
+	return timed
+
+def _storage_classes(base = storagelib.RecordStorage):
+	for subclass in base.__subclasses__():
+		yield subclass
+		yield from _storage_classes(subclass)
+
+def _patch(owner, attribute, replacement):
+	_patched.append((owner, attribute, getattr(owner, attribute)))
+	setattr(owner, attribute, replacement)
+
+def is_enabled():
+	return bool(_patched)
+
+def enable():
+	"""Start timing the instrumented functions, by replacing them with timed wrappers
+
+Nothing is timed, and no wrapper is called, until this runs; disable() puts the original functions back"""
+	if is_enabled():
+		return
+
+	for name, phase in CRYPTO_FUNCTIONS:
+		_patch(cryptolib, name, _timed(phase, getattr(cryptolib, name)))
+	for owner, name, phase in CRYPTER_METHODS:
+		_patch(owner, name, _timed(phase, owner.__dict__[name]))
+
+	for storage_class in _storage_classes():
+		for names, phase in ((STORAGE_QUERIES, "query"), (STORAGE_COMMITS, "commit")):
+			for name in names:
+				if name in storage_class.__dict__: # inherited methods are timed through the class that defines them
+					_patch(storage_class, name, _timed(phase, storage_class.__dict__[name]))
+		if "transaction" in storage_class.__dict__:
+			_patch(storage_class, "transaction", _timed_transaction(storage_class.__dict__["transaction"]))
+
+	for name in OPERATIONS:
+		_patch(tinfoillib.TinfoilDB, name, _timed(name, tinfoillib.TinfoilDB.__dict__[name]))
+
+def disable():
+	"""Stop timing, putting back the original functions; what was recorded is kept until reset()"""
+	while _patched:
+		owner, attribute, original = _patched.pop()
+		setattr(owner, attribute, original)
+
+def reset():
+	with _lock:
+		for target in _histograms.values():
+			target.clear()
+
+def snapshot():
+	"""Return a dict of phase or operation name -> histogram summary (see Histogram.to_dict), for everything recorded so far"""
+	with _lock:
+		return {name: target.to_dict() for name, target in _histograms.items() if target.count}
+
+def ordered_names(names):
+	"""Sort phase and operation names for display: the phases in PHASES order, then the operations"""
+	return sorted(names, key = lambda name: ((PHASES.index(name), "") if name in PHASES else (len(PHASES), name)))
+
+def dump(fileobj):
+	"""Write everything recorded so far to a text file object as JSON"""
+	json.dump({"enabled": is_enabled(), "timestamp": time.time(), "phases": snapshot()}, fileobj, indent = 4)
+
+def format_table(stats):
+	"""Return the lines of a text table summarizing a snapshot()"""
+	lines = ["phase".ljust(24) + "count".rjust(10) + "total ms".rjust(12) + "mean us".rjust(12) + "p50 us".rjust(12) + "p99 us".rjust(12) + "max us".rjust(12)]
+	for name in ordered_names(stats):
+		summary = stats[name]
+		lines.append(name.ljust(24) + str(summary["count"]).rjust(10) + format(summary["total_us"] / 1000, ".1f").rjust(12) + "".join(format(summary[field], ".1f").rjust(12) for field in ("mean_us", "p50_us", "p99_us", "max_us")))
+	return lines
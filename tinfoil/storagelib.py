@@ -0,0 +1,1660 @@
+import os
+import json
+import mmap
+import time
+import pathlib
+import glob
+import fcntl
+import queue
+import struct
+import sqlite3
+import threading
+import contextlib
+import collections
+
+ENGINE_SQLITE = "sqlite"
+ENGINE_LOG = "log"
+ENGINE_SHARDED = "sharded"
+
+STATEMENT_CACHE_SIZE = 64
+
+BATCH_SIZE = 500 # keep 'IN (...)' queries below SQLite's bound parameter limit
+
+SQL_JOURNAL_WAL = "PRAGMA journal_mode = WAL"
+SQL_SYNCHRONOUS_NORMAL = "PRAGMA synchronous = NORMAL"
+SQL_CHECK_INITIALIZED = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND (name = ? OR name = ?)"
+SQL_CREATE_ENTRIES = "CREATE TABLE IF NOT EXISTS tinfoil_entries(hashed_key TEXT UNIQUE NOT NULL, encrypted_value TEXT NOT NULL, iv TEXT NOT NULL, hmac_signature TEXT NOT NULL)"
+SQL_CREATE_STREAMS = "CREATE TABLE IF NOT EXISTS tinfoil_streams(hashed_key TEXT NOT NULL, chunk_index INTEGER NOT NULL, encrypted_chunk TEXT NOT NULL, iv TEXT NOT NULL, hmac_signature TEXT NOT NULL, PRIMARY KEY (hashed_key, chunk_index))"
+SQL_SELECT_PARAMETERS = "SELECT * FROM tinfoil_parameters"
+SQL_INSERT_ENTRY = "INSERT INTO tinfoil_entries VALUES(?, ?, ?, ?)"
+SQL_COUNT_ENTRY = "SELECT count(*) FROM tinfoil_entries WHERE hashed_key = ?"
+SQL_SELECT_ENTRY = "SELECT encrypted_value, iv, hmac_signature FROM tinfoil_entries WHERE hashed_key = ?"
+SQL_DELETE_ENTRY = "DELETE FROM tinfoil_entries WHERE hashed_key = ?"
+SQL_CHECK_STREAMS = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'tinfoil_streams'"
+SQL_INSERT_STREAM_CHUNK = "INSERT INTO tinfoil_streams VALUES(?, ?, ?, ?, ?)"
+SQL_COUNT_STREAM = "SELECT count(*) FROM tinfoil_streams WHERE hashed_key = ? AND chunk_index = 0"
+SQL_SELECT_STREAM_CHUNKS = "SELECT chunk_index, encrypted_chunk, iv, hmac_signature FROM tinfoil_streams WHERE hashed_key = ? ORDER BY chunk_index"
+SQL_DELETE_STREAM = "DELETE FROM tinfoil_streams WHERE hashed_key = ?"
+SQL_SELECT_STREAM_KEYS = "SELECT DISTINCT hashed_key FROM tinfoil_streams"
+SQL_SCAN_ENTRIES = "SELECT rowid, hashed_key, encrypted_value, iv, hmac_signature FROM tinfoil_entries WHERE rowid > ? ORDER BY rowid"
+SQL_CREATE_CHECKPOINTS = "CREATE TABLE IF NOT EXISTS tinfoil_checkpoints(name TEXT PRIMARY KEY NOT NULL, position INTEGER NOT NULL)"
+SQL_CHECK_CHECKPOINTS = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'tinfoil_checkpoints'"
+SQL_SELECT_CHECKPOINT = "SELECT position FROM tinfoil_checkpoints WHERE name = ?"
+SQL_REPLACE_CHECKPOINT = "INSERT OR REPLACE INTO tinfoil_checkpoints VALUES(?, ?)"
+SQL_DELETE_CHECKPOINT = "DELETE FROM tinfoil_checkpoints WHERE name = ?"
+# the key index holds each record's sealed key name, and blind tokens derived from the name that point to it by a small integer id
+# each name also keeps its own tokens, concatenated, so they can be deleted without a second index over tinfoil_tokens
+SQL_CREATE_NAMES = "CREATE TABLE IF NOT EXISTS tinfoil_names(id INTEGER PRIMARY KEY, hashed_key BLOB UNIQUE NOT NULL, encrypted_name BLOB NOT NULL, iv BLOB NOT NULL, hmac_signature BLOB NOT NULL, tokens BLOB NOT NULL)"
+SQL_CREATE_TOKENS = "CREATE TABLE IF NOT EXISTS tinfoil_tokens(token BLOB NOT NULL, name_id INTEGER NOT NULL, PRIMARY KEY (token, name_id)) WITHOUT ROWID"
+SQL_CHECK_INDEX = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'tinfoil_names'"
+SQL_REPLACE_NAME = "INSERT OR REPLACE INTO tinfoil_names VALUES(?, ?, ?, ?, ?, ?)"
+SQL_SELECT_LAST_NAME_ID = "SELECT coalesce(max(id), 0) FROM tinfoil_names"
+SQL_INSERT_TOKEN = "INSERT OR IGNORE INTO tinfoil_tokens VALUES(?, ?)"
+SQL_DELETE_TOKEN = "DELETE FROM tinfoil_tokens WHERE token = ? AND name_id = ?"
+SQL_DELETE_NAME_BY_ID = "DELETE FROM tinfoil_names WHERE id = ?"
+SQL_CLEAR_INDEX = ("DELETE FROM tinfoil_names", "DELETE FROM tinfoil_tokens")
+# joined with the records, so index rows left behind by a client that predates the index are never returned
+SQL_SELECT_NAMES = "SELECT n.hashed_key, n.encrypted_name, n.iv, n.hmac_signature FROM tinfoil_names n JOIN tinfoil_entries e ON e.hashed_key = n.hashed_key"
+# the compact layout keeps each record in one row of a table clustered on its hashed key, so the key is stored once instead of in both a table and a UNIQUE index
+# the nonce, ciphertext and tag are concatenated into one BLOB behind a short header, and every column has BLOB affinity
+SQL_CREATE_RECORDS = "CREATE TABLE IF NOT EXISTS tinfoil_records(hashed_key BLOB PRIMARY KEY NOT NULL, sealed_value BLOB NOT NULL) WITHOUT ROWID"
+SQL_CREATE_COMPACT_STREAMS = "CREATE TABLE IF NOT EXISTS tinfoil_streams(hashed_key BLOB NOT NULL, chunk_index INTEGER NOT NULL, encrypted_chunk BLOB NOT NULL, iv BLOB NOT NULL, hmac_signature BLOB NOT NULL, PRIMARY KEY (hashed_key, chunk_index)) WITHOUT ROWID"
+SQL_INSERT_RECORD = "INSERT INTO tinfoil_records VALUES(?, ?)"
+SQL_COUNT_RECORD = "SELECT count(*) FROM tinfoil_records WHERE hashed_key = ?"
+SQL_SELECT_RECORD = "SELECT sealed_value FROM tinfoil_records WHERE hashed_key = ?"
+SQL_DELETE_RECORD = "DELETE FROM tinfoil_records WHERE hashed_key = ?"
+SQL_SCAN_RECORDS = "SELECT hashed_key, sealed_value FROM tinfoil_records WHERE hashed_key > ? ORDER BY hashed_key"
+SQL_SELECT_RECORD_NAMES = "SELECT n.hashed_key, n.encrypted_name, n.iv, n.hmac_signature FROM tinfoil_names n JOIN tinfoil_records e ON e.hashed_key = n.hashed_key"
+SQL_CHECK_ENTRIES = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'tinfoil_entries'"
+
+# a sharded database keeps its parameters, shard count and checkpoints in a main SQLite file, and its records, streams and key index in shard files beside it
+SQL_CREATE_SHARDS = "CREATE TABLE IF NOT EXISTS tinfoil_shards(shard_count INTEGER NOT NULL)"
+SQL_INSERT_SHARD_COUNT = "INSERT INTO tinfoil_shards VALUES(?)"
+SQL_SELECT_SHARD_COUNT = "SELECT shard_count FROM tinfoil_shards"
+SQL_CHECK_SHARDS = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'tinfoil_shards'"
+SEALED_VALUE_HEADER = struct.Struct(">BB") # iv and tag lengths; the ciphertext sits between them
+
+TOKEN_SIZE = 8
+
+DEFAULT_SCAN_BATCH_SIZE = 1000
+SCAN_START = 0 # a position before every record, for checkpoints that need a value before the first batch; every engine's scan() takes it as after, as it does None
+
+DEFAULT_READERS = 4 # read-only connections of a PooledSQLiteStorage
+GROUP_COMMIT_LIMIT = 256 # queued writes committed together at most
+
+DEFAULT_SHARD_COUNT = 8 # files a new sharded database splits its records across
+MAX_SHARD_COUNT = 256 # a scan position starts with the shard number, as one byte
+SHARD_SUFFIX = ".shard-%03d"
+SCAN_READ_AHEAD_SHARDS = 4 # shards a sharded scan reads at once, each on its own thread and connection
+SCAN_READ_AHEAD_BATCHES = 2 # batches each of those threads keeps ready
+
+DEFAULT_COPY_PAGES_PER_STEP = 256 # 1 MiB with the default 4 KiB pages; a live session only waits for at most one step
+DEFAULT_COPY_PAUSE = 0.005 # seconds between steps, leaving room for a live session to take the lock
+LOG_COPY_SIZE = 1024 * 1024
+COPY_LOCK_TIMEOUT = 60 # seconds a sharded copy keeps trying to hold every file's write lock at once
+COPY_LOCK_WAIT = 1 # seconds it waits for each lock before letting go of the others; less than the 5 a writer waits, so a writer is never the one to give up
+COPY_LOCK_RETRY_PAUSE = 0.01
+
+# a log store is a header followed by length-prefixed entries, only ever appended to
+# entries take effect when the commit entry that follows them is read, so a write torn by a crash is ignored (and truncated by the next writer)
+LOG_MAGIC = b"TINFOIL-LOG\x00"
+LOG_FORMAT_VERSION = 1
+LOG_HEADER = struct.Struct(">12sH") # magic, format version
+LOG_ENTRY_HEADER = struct.Struct(">BI") # entry kind, payload length
+LOG_RECORD_HEADER = struct.Struct(">BBB") # hashed key, iv and tag lengths; the ciphertext fills the rest of the payload
+
+LOG_ENTRY_PARAMETERS = 1
+LOG_ENTRY_RECORD = 2
+LOG_ENTRY_TOMBSTONE = 3
+LOG_ENTRY_COMMIT = 4
+LOG_ENTRY_CHECKPOINT = 5
+
+def _batches(items, size = BATCH_SIZE):
+	for i in range(0, len(items), size):
+		yield items[i:(i + size)]
+
+def _create_parameters(cursor, parameters):
+	"""Create the tinfoil_parameters table of a SQLite database, holding the given dict of parameters as its one row"""
+	fields = list(parameters)
+	columns = [field + (" INTEGER" if isinstance(parameters[field], int) else " TEXT") + " NOT NULL" for field in fields] # each database version has its own parameter columns
+	cursor.execute("CREATE TABLE IF NOT EXISTS tinfoil_parameters(" + ", ".join(columns) + ")")
+	cursor.execute("INSERT INTO tinfoil_parameters(" + ", ".join(fields) + ") VALUES(" + ", ".join("?" * len(fields)) + ")", [parameters[field] for field in fields])
+
+class RecordStorage:
+	"""Where a TinfoilDB keeps its parameters and sealed records
+
+Engines only ever see hashed keys and sealed values; all cryptography stays in TinfoilDB
+Sealed values are returned as (encrypted_value, iv, hmac_signature), as bytes or any other bytes-like object"""
+
+	supports_streams = False
+	supports_index = False
+	connection = None # the underlying sqlite3 connection, for engines that have one
+
+	def __init__(self, location, session = False, wal = False):
+		raise NotImplementedError()
+
+	def is_initialized(self):
+		raise NotImplementedError()
+
+	def create(self, parameters):
+		"""Create an empty store holding the given dict of database parameters"""
+		raise NotImplementedError()
+
+	def load_parameters(self):
+		"""Return the dict of database parameters passed to create()"""
+		raise NotImplementedError()
+
+	def update_parameters(self, parameters):
+		"""Atomically replace the values of some database parameters, given as a dict"""
+		raise NotImplementedError()
+
+	def contains(self, hashed_key):
+		raise NotImplementedError()
+
+	def get(self, hashed_key):
+		"""Return the sealed value stored under a hashed key, or None"""
+		raise NotImplementedError()
+
+	def get_many(self, hashed_keys):
+		"""Return a dict mapping each hashed key that has a record to its sealed value"""
+		raise NotImplementedError()
+
+	def insert(self, hashed_key, encrypted_value, iv, hmac_signature):
+		"""Store and commit one sealed value, or return False if the hashed key is already in use"""
+		raise NotImplementedError()
+
+	def delete(self, hashed_key):
+		raise NotImplementedError()
+
+	def transaction(self):
+		"""Context manager holding the write lock; the writes below are committed together when it exits, or not at all"""
+		raise NotImplementedError()
+
+	def find_existing(self, hashed_keys):
+		"""Return the set of the given hashed keys that have a record"""
+		raise NotImplementedError()
+
+	def insert_many(self, rows):
+		"""Queue (hashed_key, encrypted_value, iv, hmac_signature) rows for insertion; only valid inside transaction()"""
+		raise NotImplementedError()
+
+	def delete_many(self, hashed_keys):
+		"""Queue deletion of the given hashed keys; only valid inside transaction()"""
+		raise NotImplementedError()
+
+	def scan(self, after = None, batch_size = DEFAULT_SCAN_BATCH_SIZE):
+		"""Yield lists of (position, hashed_key, encrypted_value, iv, hmac_signature) for every record, in increasing position order
+
+Positions are engine-specific integers or bytes; passing the last one seen as 'after' resumes the scan past it, and None or SCAN_START scans from the start
+Only one batch is held in memory at a time, and values are always bytes"""
+		raise NotImplementedError()
+
+	def load_checkpoint(self, name):
+		"""Return the position saved under name, or None"""
+		raise NotImplementedError()
+
+	def save_checkpoint(self, name, position):
+		"""Queue saving a position under name, or clearing it if position is None; only valid inside transaction()"""
+		raise NotImplementedError()
+
+	def close(self):
+		raise NotImplementedError()
+
+class SQLiteStorage(RecordStorage):
+	"""Records in the tinfoil_entries table of a SQLite database, with streams in tinfoil_streams
+
+In session mode all queries run through a single reused cursor
+If wal is set, the database is switched to WAL journaling with synchronous=NORMAL
+If read_only is set, the database is opened read-only; if shared is set, the connection may be used from any thread, by one thread at a time"""
+
+	supports_streams = True
+	supports_index = True
+
+	records_table = "tinfoil_entries"
+	sql_create_records = SQL_CREATE_ENTRIES
+	sql_create_streams = SQL_CREATE_STREAMS
+	sql_count_record = SQL_COUNT_ENTRY
+	sql_delete_record = SQL_DELETE_ENTRY
+	sql_select_names = SQL_SELECT_NAMES
+
+	def __init__(self, location, session = False, wal = False, read_only = False, shared = False):
+		if read_only:
+			self.connection = sqlite3.connect(pathlib.Path(location).absolute().as_uri() + "?mode=ro", uri = True, cached_statements = STATEMENT_CACHE_SIZE, check_same_thread = not shared)
+		else:
+			self.connection = sqlite3.connect(location, cached_statements = STATEMENT_CACHE_SIZE, check_same_thread = not shared)
+
+		if wal:
+			self.connection.execute(SQL_JOURNAL_WAL)
+			self.connection.execute(SQL_SYNCHRONOUS_NORMAL)
+
+		self.session = session
+		self._session_cursor = self.connection.cursor() if session else None
+
+	def _cursor(self):
+		if self.session:
+			return self._session_cursor
+		return self.connection.cursor()
+
+	def _release_cursor(self, cursor):
+		if not self.session: # the session cursor lives until close()
+			cursor.close()
+
+	def is_initialized(self):
+		cursor = self._cursor()
+
+		cursor.execute(SQL_CHECK_INITIALIZED, ("tinfoil_parameters", self.records_table))
+		result = cursor.fetchone()[0]
+
+		self._release_cursor(cursor)
+		return (result == 2)
+
+	def create(self, parameters):
+		cursor = self.connection.cursor()
+		_create_parameters(cursor, parameters)
+		self._create_tables(cursor)
+		cursor.close()
+		self.connection.commit()
+
+	def _create_tables(self, cursor):
+		for table in (self.sql_create_records, self.sql_create_streams, SQL_CREATE_NAMES, SQL_CREATE_TOKENS):
+			cursor.execute(table)
+
+	def load_parameters(self):
+		cursor = self._cursor()
+
+		cursor.execute(SQL_SELECT_PARAMETERS)
+		rows = cursor.fetchall()
+		fields = [column[0] for column in cursor.description]
+		self._release_cursor(cursor)
+
+		if len(rows) != 1:
+			raise AssertionError("there must only be 1 row in the tinfoil_parameters table! (found: " + str(len(rows)) + ")")
+
+		return dict(zip(fields, rows[0]))
+
+	def update_parameters(self, parameters):
+		fields = list(parameters)
+		cursor = self.connection.cursor()
+		try:
+			cursor.execute("UPDATE tinfoil_parameters SET " + ", ".join(field + " = ?" for field in fields), [parameters[field] for field in fields])
+			self.connection.commit()
+		except:
+			self.connection.rollback()
+			raise
+		finally:
+			cursor.close()
+
+	def contains(self, hashed_key):
+		cursor = self._cursor()
+
+		cursor.execute(self.sql_count_record, (hashed_key, ))
+		result = cursor.fetchone()[0]
+
+		self._release_cursor(cursor)
+		return (result > 0)
+
+	def get(self, hashed_key):
+		cursor = self._cursor()
+
+		cursor.execute(SQL_SELECT_ENTRY, (hashed_key, ))
+		result = cursor.fetchone()
+
+		self._release_cursor(cursor)
+		return result
+
+	def get_many(self, hashed_keys):
+		cursor = self._cursor()
+		found = {}
+		for batch in _batches(list(set(hashed_keys))):
+			placeholders = ", ".join("?" * len(batch))
+			cursor.execute("SELECT hashed_key, encrypted_value, iv, hmac_signature FROM tinfoil_entries WHERE hashed_key IN (" + placeholders + ")", batch)
+			for hashed_key, encrypted_value, iv, hmac_signature in cursor.fetchall():
+				found[hashed_key] = (encrypted_value, iv, hmac_signature)
+		self._release_cursor(cursor)
+		return found
+
+	def insert(self, hashed_key, encrypted_value, iv, hmac_signature):
+		cursor = self._cursor()
+
+		try:
+			cursor.execute(SQL_INSERT_ENTRY, (hashed_key, encrypted_value, iv, hmac_signature))
+		except sqlite3.IntegrityError:
+			self.connection.rollback()
+			return False
+		finally:
+			self._release_cursor(cursor)
+
+		self.connection.commit()
+		return True
+
+	def delete(self, hashed_key):
+		cursor = self._cursor()
+		cursor.execute(self.sql_delete_record, (hashed_key, ))
+		if self.has_index():
+			self._delete_names(cursor, [hashed_key])
+
+		self._release_cursor(cursor)
+		self.connection.commit()
+
+	@contextlib.contextmanager
+	def transaction(self):
+		cursor = self._cursor()
+		try:
+			cursor.execute("BEGIN IMMEDIATE") # hold the write lock, so conflict checks made inside stay accurate
+			yield
+			self.connection.commit()
+		except:
+			self.connection.rollback()
+			raise
+		finally:
+			self._release_cursor(cursor)
+
+	def find_existing(self, hashed_keys):
+		cursor = self._cursor()
+		existing = set()
+		for batch in _batches(list(hashed_keys)):
+			placeholders = ", ".join("?" * len(batch))
+			cursor.execute("SELECT hashed_key FROM " + self.records_table + " WHERE hashed_key IN (" + placeholders + ")", batch)
+			existing.update(row[0] for row in cursor.fetchall())
+		self._release_cursor(cursor)
+		return existing
+
+	def insert_many(self, rows):
+		cursor = self._cursor()
+		cursor.executemany(SQL_INSERT_ENTRY, rows)
+		self._release_cursor(cursor)
+
+	def delete_many(self, hashed_keys):
+		cursor = self._cursor()
+		hashed_keys = list(hashed_keys)
+		cursor.executemany(self.sql_delete_record, [(hashed_key, ) for hashed_key in hashed_keys])
+		if self.has_index():
+			self._delete_names(cursor, hashed_keys)
+		self._release_cursor(cursor)
+
+	def scan(self, after = None, batch_size = DEFAULT_SCAN_BATCH_SIZE):
+		cursor = self.connection.cursor() # not the session cursor: rows are consumed lazily while it stays in use
+		try:
+			cursor.execute(SQL_SCAN_ENTRIES, ((after or SCAN_START), ))
+			while True:
+				rows = cursor.fetchmany(batch_size)
+				if not rows:
+					break
+				yield rows
+		finally:
+			cursor.close()
+
+	def load_checkpoint(self, name):
+		cursor = self._cursor()
+		try:
+			cursor.execute(SQL_CHECK_CHECKPOINTS)
+			if cursor.fetchone()[0] == 0:
+				return None
+			cursor.execute(SQL_SELECT_CHECKPOINT, (name, ))
+			result = cursor.fetchone()
+		finally:
+			self._release_cursor(cursor)
+		return result[0] if result is not None else None
+
+	def save_checkpoint(self, name, position):
+		cursor = self._cursor()
+		cursor.execute(SQL_CREATE_CHECKPOINTS)
+		if position is None:
+			cursor.execute(SQL_DELETE_CHECKPOINT, (name, ))
+		else:
+			cursor.execute(SQL_REPLACE_CHECKPOINT, (name, position))
+		self._release_cursor(cursor)
+
+	def stream_keys(self):
+		"""Return the hashed keys of every stored stream"""
+		if not self.has_streams():
+			return []
+		cursor = self._cursor()
+		cursor.execute(SQL_SELECT_STREAM_KEYS)
+		result = [row[0] for row in cursor.fetchall()]
+		self._release_cursor(cursor)
+		return result
+
+	def has_streams(self):
+		cursor = self._cursor()
+		cursor.execute(SQL_CHECK_STREAMS)
+		result = cursor.fetchone()[0]
+		self._release_cursor(cursor)
+		return (result == 1)
+
+	def contains_stream(self, hashed_key):
+		cursor = self._cursor()
+
+		cursor.execute(SQL_COUNT_STREAM, (hashed_key, ))
+		result = cursor.fetchone()[0]
+
+		self._release_cursor(cursor)
+		return (result > 0)
+
+	def insert_stream(self, hashed_key, chunks):
+		"""Store (chunk_index, encrypted_chunk, iv, hmac_signature) tuples from an iterable in one transaction, consuming it lazily
+
+Returns False without consuming anything if a stream is already stored under the hashed key"""
+		cursor = self._cursor()
+		try:
+			cursor.execute(self.sql_create_streams) # databases created before streams existed gain the table on first use
+			cursor.execute("BEGIN IMMEDIATE")
+			cursor.execute(SQL_COUNT_STREAM, (hashed_key, ))
+			if cursor.fetchone()[0] > 0:
+				self.connection.rollback()
+				return False
+
+			cursor.executemany(SQL_INSERT_STREAM_CHUNK, (((hashed_key, ) + chunk) for chunk in chunks))
+			self.connection.commit()
+		except:
+			self.connection.rollback()
+			raise
+		finally:
+			self._release_cursor(cursor)
+
+		return True
+
+	def iterate_stream(self, hashed_key):
+		"""Yield the (chunk_index, encrypted_chunk, iv, hmac_signature) rows of a stream in order, fetching them lazily"""
+		cursor = self.connection.cursor() # not the session cursor: rows are consumed lazily while it stays in use
+		try:
+			cursor.execute(SQL_SELECT_STREAM_CHUNKS, (hashed_key, ))
+			for row in cursor:
+				yield row
+		finally:
+			cursor.close()
+
+	def delete_stream(self, hashed_key):
+		cursor = self._cursor()
+		cursor.execute(SQL_DELETE_STREAM, (hashed_key, ))
+
+		self._release_cursor(cursor)
+		self.connection.commit()
+
+	def has_index(self):
+		cursor = self._cursor()
+		cursor.execute(SQL_CHECK_INDEX)
+		result = cursor.fetchone()[0]
+		self._release_cursor(cursor)
+		return (result == 1)
+
+	def _delete_names(self, cursor, hashed_keys):
+		tokens = []
+		names = []
+		for batch in _batches(list(hashed_keys)):
+			cursor.execute("SELECT id, tokens FROM tinfoil_names WHERE hashed_key IN (" + ", ".join("?" * len(batch)) + ")", batch)
+			for name_id, name_tokens in cursor.fetchall():
+				names.append((name_id, ))
+				tokens.extend((name_tokens[i:(i + TOKEN_SIZE)], name_id) for i in range(0, len(name_tokens), TOKEN_SIZE))
+		cursor.executemany(SQL_DELETE_TOKEN, tokens)
+		cursor.executemany(SQL_DELETE_NAME_BY_ID, names)
+
+	def insert_names(self, rows):
+		"""Queue (hashed_key, encrypted_name, iv, hmac_signature, tokens) rows for the key index, replacing what it held for those keys; only valid inside transaction()
+
+tokens is a list of TOKEN_SIZE-byte blind tokens"""
+		cursor = self._cursor()
+		for statement in (SQL_CREATE_NAMES, SQL_CREATE_TOKENS): # databases created before the index existed gain it on first use
+			cursor.execute(statement)
+		rows = list(rows)
+		self._delete_names(cursor, [row[0] for row in rows])
+
+		cursor.execute(SQL_SELECT_LAST_NAME_ID)
+		name_id = cursor.fetchone()[0]
+		names = []
+		tokens = []
+		for hashed_key, encrypted_name, iv, hmac_signature, name_tokens in rows:
+			name_id += 1
+			names.append((name_id, hashed_key, encrypted_name, iv, hmac_signature, b"".join(name_tokens)))
+			tokens.extend((token, name_id) for token in name_tokens)
+		tokens.sort() # inserting in key order keeps the token b-tree's pages in cache
+
+		cursor.executemany(SQL_REPLACE_NAME, names) # ids are handed out above, since the write lock is held
+		cursor.executemany(SQL_INSERT_TOKEN, tokens)
+		self._release_cursor(cursor)
+
+	def clear_index(self):
+		"""Queue removal of everything in the key index; only valid inside transaction()"""
+		if not self.has_index():
+			return
+		cursor = self._cursor()
+		for statement in SQL_CLEAR_INDEX:
+			cursor.execute(statement)
+		self._release_cursor(cursor)
+
+	def names(self):
+		"""Return (hashed_key, encrypted_name, iv, hmac_signature) for every record in the key index"""
+		if not self.has_index():
+			return []
+		cursor = self._cursor()
+		cursor.execute(self.sql_select_names)
+		result = cursor.fetchall()
+		self._release_cursor(cursor)
+		return result
+
+	def find_names(self, tokens):
+		"""Return (hashed_key, encrypted_name, iv, hmac_signature) for every record in the key index that has all of the given blind tokens"""
+		if not self.has_index():
+			return []
+		tokens = list(set(tokens))[:BATCH_SIZE]
+		cursor = self._cursor()
+		cursor.execute(self.sql_select_names + " WHERE n.id IN (SELECT name_id FROM tinfoil_tokens WHERE token IN (" + ", ".join("?" * len(tokens)) + ") GROUP BY name_id HAVING count(*) = ?)", tokens + [len(tokens)])
+		result = cursor.fetchall()
+		self._release_cursor(cursor)
+		return result
+
+	def close(self):
+		if self._session_cursor is not None:
+			self._session_cursor.close()
+			self._session_cursor = None
+		self.connection.close()
+
+def _pack_sealed_value(encrypted_value, iv, hmac_signature):
+	return b"".join((SEALED_VALUE_HEADER.pack(len(iv), len(hmac_signature)), iv, encrypted_value, hmac_signature))
+
+def _unpack_sealed_value(sealed_value):
+	"""Split a packed sealed value into (encrypted_value, iv, hmac_signature) slices of it"""
+	iv_length, tag_length = SEALED_VALUE_HEADER.unpack_from(sealed_value)
+	ciphertext_start = SEALED_VALUE_HEADER.size + iv_length
+	tag_start = len(sealed_value) - tag_length
+	return sealed_value[ciphertext_start:tag_start], sealed_value[SEALED_VALUE_HEADER.size:ciphertext_start], sealed_value[tag_start:]
+
+class CompactSQLiteStorage(SQLiteStorage):
+	"""Records in the tinfoil_records table of a SQLite database: a WITHOUT ROWID table clustered on the hashed key, with each sealed value in one BLOB
+
+New SQLite databases use this layout; databases created with tinfoil_entries keep theirs, and move to this one through tinfoil-migrate
+Scan positions are the hashed keys themselves"""
+
+	records_table = "tinfoil_records"
+	sql_create_records = SQL_CREATE_RECORDS
+	sql_create_streams = SQL_CREATE_COMPACT_STREAMS
+	sql_count_record = SQL_COUNT_RECORD
+	sql_delete_record = SQL_DELETE_RECORD
+	sql_select_names = SQL_SELECT_RECORD_NAMES
+
+	def get(self, hashed_key):
+		cursor = self._cursor()
+
+		cursor.execute(SQL_SELECT_RECORD, (hashed_key, ))
+		result = cursor.fetchone()
+
+		self._release_cursor(cursor)
+		return _unpack_sealed_value(result[0]) if result is not None else None
+
+	def get_many(self, hashed_keys):
+		cursor = self._cursor()
+		found = {}
+		for batch in _batches(list(set(hashed_keys))):
+			placeholders = ", ".join("?" * len(batch))
+			cursor.execute("SELECT hashed_key, sealed_value FROM tinfoil_records WHERE hashed_key IN (" + placeholders + ")", batch)
+			for hashed_key, sealed_value in cursor.fetchall():
+				found[hashed_key] = _unpack_sealed_value(sealed_value)
+		self._release_cursor(cursor)
+		return found
+
+	def insert(self, hashed_key, encrypted_value, iv, hmac_signature):
+		cursor = self._cursor()
+
+		try:
+			cursor.execute(SQL_INSERT_RECORD, (hashed_key, _pack_sealed_value(encrypted_value, iv, hmac_signature)))
+		except sqlite3.IntegrityError:
+			self.connection.rollback()
+			return False
+		finally:
+			self._release_cursor(cursor)
+
+		self.connection.commit()
+		return True
+
+	def insert_many(self, rows):
+		cursor = self._cursor()
+		cursor.executemany(SQL_INSERT_RECORD, ((hashed_key, _pack_sealed_value(encrypted_value, iv, hmac_signature)) for hashed_key, encrypted_value, iv, hmac_signature in rows))
+		self._release_cursor(cursor)
+
+	def scan(self, after = None, batch_size = DEFAULT_SCAN_BATCH_SIZE):
+		cursor = self.connection.cursor() # not the session cursor: rows are consumed lazily while it stays in use
+		try:
+			cursor.execute(SQL_SCAN_RECORDS, ((after or b""), )) # SCAN_START is no hashed key, so it is not compared with them
+			while True:
+				rows = cursor.fetchmany(batch_size)
+				if not rows:
+					break
+				yield [(hashed_key, hashed_key) + _unpack_sealed_value(sealed_value) for hashed_key, sealed_value in rows]
+		finally:
+			cursor.close()
+
+def shard_path(location, shard):
+	"""Return the file a shard of the sharded database at location is kept in"""
+	return location + (SHARD_SUFFIX % shard)
+
+def shard_of(hashed_key, shard_count):
+	"""Return the shard a hashed key belongs to, from the first 4 bytes of the key, which are uniformly distributed"""
+	return int.from_bytes(bytes(hashed_key[:4]), "big") % shard_count
+
+class _ShardReader:
+	"""Scans one shard on a background thread, on a read-only connection of its own, keeping up to SCAN_READ_AHEAD_BATCHES batches ready
+
+Positions are prefixed with the shard number, so they keep increasing from one shard to the next"""
+
+	def __init__(self, engine, location, shard, after, batch_size):
+		self._batches = queue.Queue(SCAN_READ_AHEAD_BATCHES)
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target = self._run, args = (engine, location, shard, after, batch_size), name = "tinfoil-shard-reader", daemon = True)
+		self._thread.start()
+
+	def _run(self, engine, location, shard, after, batch_size):
+		prefix = bytes((shard, ))
+		try:
+			storage = engine(location, read_only = True)
+			try:
+				for rows in storage.scan(after = after, batch_size = batch_size):
+					if not self._put([((prefix + row[0]), ) + row[1:] for row in rows]):
+						return
+			finally:
+				storage.close()
+			self._put(None)
+		except BaseException as exception:
+			self._put(exception)
+
+	def _put(self, item):
+		"""Hand over a batch, the end of the scan (None) or an exception, returning False if the scan was abandoned first"""
+		while not self._stopped.is_set():
+			try:
+				self._batches.put(item, timeout = 0.1)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def __iter__(self):
+		while True:
+			item = self._batches.get()
+			if item is None:
+				return
+			if isinstance(item, BaseException):
+				raise item
+			yield item
+
+	def stop(self):
+		self._stopped.set()
+		self._thread.join()
+
+class ShardedSQLiteStorage(SQLiteStorage):
+	"""Records split across shard files by hashed key, beside a main SQLite database that holds the parameters, the shard count and checkpoints
+
+Each shard is a CompactSQLiteStorage database holding its records, their streams and their key index rows, so a record and its index row always share a shard
+Connections writing to different shards, such as one TinfoilDB per thread or process, only wait for each other when they touch the same shard
+Inside transaction(), each shard is locked when it is first used and committed when the transaction ends; batch methods lock shards in ascending order,
+so transactions cannot deadlock, but a crash while one commits can leave some of its shards committed and others not;
+copy_store() holds every shard's write lock while it copies them, so a copy never sees such a transaction half committed
+Scan positions are the shard number followed by the hashed key; scan() reads several shards at once on background threads
+shards sets the shard count of a new database (DEFAULT_SHARD_COUNT if not given); an existing one keeps its own"""
+
+	shard_engine = CompactSQLiteStorage
+
+	def __init__(self, location, session = False, wal = False, read_only = False, shared = False, shards = None):
+		if location == ":memory:":
+			raise AssertionError("sharded databases must be files!")
+		super().__init__(location, session = session, wal = wal, read_only = read_only, shared = shared)
+
+		cursor = self._cursor()
+		cursor.execute(SQL_CHECK_SHARDS)
+		if cursor.fetchone()[0] == 1:
+			cursor.execute(SQL_SELECT_SHARD_COUNT)
+			shards = cursor.fetchone()[0]
+		self._release_cursor(cursor)
+
+		self.shard_count = shards or DEFAULT_SHARD_COUNT
+		if not (1 <= self.shard_count <= MAX_SHARD_COUNT):
+			raise AssertionError("a sharded database must have between 1 and " + str(MAX_SHARD_COUNT) + " shards!")
+
+		self.location = location
+		self._shards = [self.shard_engine(shard_path(location, shard), session = session, wal = wal, read_only = read_only, shared = shared) for shard in range(self.shard_count)]
+		self._locked = None # the shards locked by the open transaction, in the order they were locked, or None outside one
+
+	def _shard(self, shard):
+		"""Return a shard's storage, first locking it if a transaction is open"""
+		storage = self._shards[shard]
+		if (self._locked is not None) and (storage not in self._locked):
+			storage.connection.execute("BEGIN IMMEDIATE")
+			self._locked.append(storage)
+		return storage
+
+	def _route(self, hashed_keys):
+		"""Return (shard storage, hashed keys) pairs for the shards holding the given hashed keys, in ascending shard order"""
+		grouped = {}
+		for hashed_key in hashed_keys:
+			grouped.setdefault(shard_of(hashed_key, self.shard_count), []).append(hashed_key)
+		return [(self._shard(shard), grouped[shard]) for shard in sorted(grouped)]
+
+	def _route_rows(self, rows):
+		grouped = {}
+		for row in rows:
+			grouped.setdefault(shard_of(row[0], self.shard_count), []).append(row)
+		return [(self._shard(shard), grouped[shard]) for shard in sorted(grouped)]
+
+	def _for_key(self, hashed_key):
+		return self._shard(shard_of(hashed_key, self.shard_count))
+
+	def is_initialized(self):
+		cursor = self._cursor()
+		cursor.execute(SQL_CHECK_INITIALIZED, ("tinfoil_parameters", "tinfoil_shards"))
+		result = cursor.fetchone()[0]
+		self._release_cursor(cursor)
+		return (result == 2)
+
+	def create(self, parameters):
+		for storage in self._shards: # the main database is written last, so an interrupted create leaves it uninitialized
+			cursor = storage.connection.cursor()
+			storage._create_tables(cursor)
+			cursor.close()
+			storage.connection.commit()
+
+		cursor = self.connection.cursor()
+		_create_parameters(cursor, parameters)
+		cursor.execute(SQL_CREATE_SHARDS)
+		cursor.execute(SQL_INSERT_SHARD_COUNT, (self.shard_count, ))
+		cursor.close()
+		self.connection.commit()
+
+	def contains(self, hashed_key):
+		return self._for_key(hashed_key).contains(hashed_key)
+
+	def get(self, hashed_key):
+		return self._for_key(hashed_key).get(hashed_key)
+
+	def get_many(self, hashed_keys):
+		found = {}
+		for storage, shard_keys in self._route(hashed_keys):
+			found.update(storage.get_many(shard_keys))
+		return found
+
+	def insert(self, hashed_key, encrypted_value, iv, hmac_signature):
+		return self._for_key(hashed_key).insert(hashed_key, encrypted_value, iv, hmac_signature)
+
+	def delete(self, hashed_key):
+		self._for_key(hashed_key).delete(hashed_key)
+
+	@contextlib.contextmanager
+	def transaction(self):
+		self._locked = []
+		try:
+			yield
+			for storage in self._locked: # the main database, locked by save_checkpoint(), is always last
+				storage.connection.commit()
+		except:
+			for storage in self._locked:
+				storage.connection.rollback()
+			raise
+		finally:
+			self._locked = None
+
+	def find_existing(self, hashed_keys):
+		existing = set()
+		for storage, shard_keys in self._route(hashed_keys):
+			existing.update(storage.find_existing(shard_keys))
+		return existing
+
+	def insert_many(self, rows):
+		for storage, shard_rows in self._route_rows(rows):
+			storage.insert_many(shard_rows)
+
+	def delete_many(self, hashed_keys):
+		for storage, shard_keys in self._route(hashed_keys):
+			storage.delete_many(shard_keys)
+
+	def scan(self, after = None, batch_size = DEFAULT_SCAN_BATCH_SIZE):
+		first = 0
+		first_after = None
+		if after: # not None or SCAN_START
+			first = after[0]
+			first_after = bytes(after[1:])
+
+		if self._locked is not None: # read on this transaction's own connections, so its writes are seen
+			for shard in range(first, self.shard_count):
+				prefix = bytes((shard, ))
+				for rows in self._shard(shard).scan(after = (first_after if shard == first else None), batch_size = batch_size):
+					yield [((prefix + row[0]), ) + row[1:] for row in rows]
+			return
+
+		pending = iter(range(first, self.shard_count))
+		readers = collections.deque()
+		def read_next():
+			shard = next(pending, None)
+			if shard is not None:
+				readers.append(_ShardReader(self.shard_engine, shard_path(self.location, shard), shard, (first_after if shard == first else None), batch_size))
+
+		try:
+			for _ in range(SCAN_READ_AHEAD_SHARDS):
+				read_next()
+			while readers:
+				yield from readers[0]
+				readers.popleft().stop()
+				read_next()
+		finally:
+			for reader in readers:
+				reader.stop()
+
+	def save_checkpoint(self, name, position):
+		if (self._locked is not None) and (self not in self._locked):
+			self.connection.execute("BEGIN IMMEDIATE")
+			self._locked.append(self)
+		super().save_checkpoint(name, position)
+
+	def stream_keys(self):
+		return [hashed_key for storage in self._shards for hashed_key in storage.stream_keys()]
+
+	def has_streams(self):
+		return any(storage.has_streams() for storage in self._shards)
+
+	def contains_stream(self, hashed_key):
+		return self._for_key(hashed_key).contains_stream(hashed_key)
+
+	def insert_stream(self, hashed_key, chunks):
+		return self._for_key(hashed_key).insert_stream(hashed_key, chunks)
+
+	def iterate_stream(self, hashed_key):
+		return self._for_key(hashed_key).iterate_stream(hashed_key)
+
+	def delete_stream(self, hashed_key):
+		self._for_key(hashed_key).delete_stream(hashed_key)
+
+	def has_index(self):
+		return all(storage.has_index() for storage in self._shards)
+
+	def insert_names(self, rows):
+		for storage, shard_rows in self._route_rows(rows):
+			storage.insert_names(shard_rows)
+
+	def clear_index(self):
+		for shard in range(self.shard_count):
+			self._shard(shard).clear_index()
+
+	def names(self):
+		return [row for storage in self._shards for row in storage.names()]
+
+	def find_names(self, tokens):
+		return [row for storage in self._shards for row in storage.find_names(tokens)]
+
+	def close(self):
+		for storage in self._shards:
+			storage.close()
+		super().close()
+
+class _WriteJob:
+	__slots__ = ("function", "grouped", "result", "error", "turn", "done")
+
+	def __init__(self, function, grouped):
+		self.function = function
+		self.grouped = grouped
+		self.result = None
+		self.error = None
+		self.turn = threading.Event() # set once the job starts on the writer thread, or has failed without starting
+		self.done = threading.Event()
+
+	def finish(self):
+		self.turn.set()
+		self.done.set()
+
+class _ThreadState(threading.local):
+	writer = None # the writer's storage, while this thread is inside transaction()
+
+class PooledSQLiteStorage(RecordStorage):
+	"""A SQLite store that any number of threads may share
+
+Lookups borrow one of a pool of read-only connections, so they run in parallel under WAL journaling
+Writes are queued for a single writer thread, which commits every write queued behind the first in one transaction, each in its own savepoint;
+a write that fails is rolled back alone, and each write returns once its transaction is committed
+Inside transaction(), the calling thread works on the writer's connection while the writer thread waits for it to finish"""
+
+	supports_streams = True
+	supports_index = True
+
+	def __init__(self, location, engine = None, readers = DEFAULT_READERS):
+		if engine is None:
+			engine = resolve_engine(location, ENGINE_SQLITE)
+		if (not issubclass(engine, SQLiteStorage)) or (location == ":memory:"):
+			raise AssertionError("only SQLite database files can be shared between threads!")
+		if issubclass(engine, ShardedSQLiteStorage):
+			raise AssertionError("sharded databases cannot be shared between threads; open one per thread, and writes to different shards run at once")
+		if readers < 1:
+			raise AssertionError("at least one reader connection is needed!")
+
+		self.engine = engine
+		self.records_table = engine.records_table
+		self._jobs = queue.SimpleQueue()
+		self._state = _ThreadState()
+		self._closed = False
+		self.commits = 0 # group transactions committed, and the writes they held, counted by the writer thread
+		self.grouped_writes = 0
+
+		# the writer opens the database first, so that a new one exists (in WAL mode) before the read-only connections open it
+		self._writer = None
+		self._writer_error = None
+		ready = threading.Event()
+		self._writer_thread = threading.Thread(target = self._run_writer, args = (location, ready), name = "tinfoil-writer", daemon = True)
+		self._writer_thread.start()
+		ready.wait()
+		if self._writer is None:
+			raise self._writer_error
+
+		self._readers = queue.SimpleQueue()
+		self._reader_count = readers
+		for _ in range(readers):
+			self._readers.put(engine(location, session = True, read_only = True, shared = True))
+
+	def _run_writer(self, location, ready):
+		try:
+			self._writer = self.engine(location, session = True, wal = True, shared = True)
+		except Exception as exception:
+			self._writer_error = exception
+			return
+		finally:
+			ready.set()
+
+		pending = self._jobs.get()
+		while pending is not None:
+			if not pending.grouped:
+				self._run_alone(pending)
+				pending = self._jobs.get()
+				continue
+
+			group = [pending]
+			pending = None
+			while len(group) < GROUP_COMMIT_LIMIT:
+				try:
+					job = self._jobs.get_nowait()
+				except queue.Empty:
+					break
+				if (job is None) or (not job.grouped): # run once the group is committed
+					pending = job
+					break
+				group.append(job)
+
+			self._commit_group(group)
+			if pending is None:
+				pending = self._jobs.get()
+
+		self._writer.close()
+
+	def _run_alone(self, job):
+		"""Run a write that commits by itself, such as create() or insert_stream(), outside any group"""
+		try:
+			job.result = job.function(self._writer)
+		except BaseException as exception:
+			job.error = exception
+		job.finish()
+
+	def _commit_group(self, group):
+		connection = self._writer.connection
+		try:
+			connection.execute("BEGIN IMMEDIATE")
+			for job in group:
+				connection.execute("SAVEPOINT tinfoil_write")
+				try:
+					job.result = job.function(self._writer)
+				except BaseException as exception:
+					job.error = exception
+					connection.execute("ROLLBACK TO tinfoil_write")
+				connection.execute("RELEASE tinfoil_write")
+			connection.commit()
+			self.commits += 1
+			self.grouped_writes += len(group)
+		except BaseException as exception:
+			if connection.in_transaction:
+				connection.rollback()
+			for job in group:
+				if job.error is None:
+					job.error = exception
+		finally:
+			for job in group:
+				job.finish()
+
+	def _submit(self, function, grouped = True):
+		if self._closed:
+			raise AssertionError("storage is closed!")
+		job = _WriteJob(function, grouped)
+		self._jobs.put(job)
+		job.done.wait()
+		if job.error is not None:
+			raise job.error
+		return job.result
+
+	def _write(self, function):
+		"""Run function(writer storage) as part of the current transaction, or else queue it to be committed with the next group"""
+		writer = self._state.writer
+		if writer is not None:
+			return function(writer)
+		return self._submit(function)
+
+	def _write_alone(self, function):
+		if self._state.writer is not None:
+			raise AssertionError("this write commits by itself, and cannot run inside a transaction!")
+		return self._submit(function, grouped = False)
+
+	def _read(self, name, *args):
+		writer = self._state.writer
+		if writer is not None: # reads inside a transaction see its own writes
+			return getattr(writer, name)(*args)
+
+		reader = self._readers.get()
+		try:
+			return getattr(reader, name)(*args)
+		finally:
+			self._readers.put(reader)
+
+	def _iterate(self, name, *args):
+		writer = self._state.writer
+		if writer is not None:
+			yield from getattr(writer, name)(*args)
+			return
+
+		reader = self._readers.get() # held until the generator is exhausted or closed
+		try:
+			yield from getattr(reader, name)(*args)
+		finally:
+			self._readers.put(reader)
+
+	@contextlib.contextmanager
+	def transaction(self):
+		if self._state.writer is not None: # already inside one; its writes are committed with it
+			yield
+			return
+
+		if self._closed:
+			raise AssertionError("storage is closed!")
+
+		finished = threading.Event()
+		failure = []
+		def hand_over(writer):
+			job.turn.set()
+			finished.wait()
+			if failure:
+				raise failure[0] # rolls back to the savepoint
+
+		job = _WriteJob(hand_over, True)
+		self._jobs.put(job)
+		job.turn.wait()
+		if job.done.is_set(): # the group failed before this job's turn
+			raise job.error
+
+		self._state.writer = self._writer
+		try:
+			yield
+		except BaseException as exception:
+			failure.append(exception)
+			raise
+		finally:
+			self._state.writer = None
+			finished.set()
+			job.done.wait()
+
+		if job.error is not None:
+			raise job.error
+
+	def is_initialized(self):
+		return self._read("is_initialized")
+
+	def create(self, parameters):
+		self._write_alone(lambda writer: writer.create(parameters))
+
+	def load_parameters(self):
+		return self._read("load_parameters")
+
+	def update_parameters(self, parameters):
+		self._write_alone(lambda writer: writer.update_parameters(parameters))
+
+	def contains(self, hashed_key):
+		return self._read("contains", hashed_key)
+
+	def get(self, hashed_key):
+		return self._read("get", hashed_key)
+
+	def get_many(self, hashed_keys):
+		return self._read("get_many", hashed_keys)
+
+	def insert(self, hashed_key, encrypted_value, iv, hmac_signature):
+		def insert_one(writer):
+			if writer.find_existing([hashed_key]):
+				return False
+			writer.insert_many([(hashed_key, encrypted_value, iv, hmac_signature)])
+			return True
+		return self._write(insert_one)
+
+	def delete(self, hashed_key):
+		self._write(lambda writer: writer.delete_many([hashed_key]))
+
+	def find_existing(self, hashed_keys):
+		return self._read("find_existing", hashed_keys)
+
+	def insert_many(self, rows):
+		self._write(lambda writer: writer.insert_many(rows))
+
+	def delete_many(self, hashed_keys):
+		self._write(lambda writer: writer.delete_many(hashed_keys))
+
+	def scan(self, after = None, batch_size = DEFAULT_SCAN_BATCH_SIZE):
+		return self._iterate("scan", after, batch_size)
+
+	def load_checkpoint(self, name):
+		return self._read("load_checkpoint", name)
+
+	def save_checkpoint(self, name, position):
+		self._write(lambda writer: writer.save_checkpoint(name, position))
+
+	def stream_keys(self):
+		return self._read("stream_keys")
+
+	def has_streams(self):
+		return self._read("has_streams")
+
+	def contains_stream(self, hashed_key):
+		return self._read("contains_stream", hashed_key)
+
+	def insert_stream(self, hashed_key, chunks):
+		"""As SQLiteStorage.insert_stream; the chunks are consumed on the writer thread"""
+		return self._write_alone(lambda writer: writer.insert_stream(hashed_key, chunks))
+
+	def iterate_stream(self, hashed_key):
+		return self._iterate("iterate_stream", hashed_key)
+
+	def delete_stream(self, hashed_key):
+		self._write_alone(lambda writer: writer.delete_stream(hashed_key))
+
+	def has_index(self):
+		return self._read("has_index")
+
+	def insert_names(self, rows):
+		self._write(lambda writer: writer.insert_names(rows))
+
+	def clear_index(self):
+		self._write(lambda writer: writer.clear_index())
+
+	def names(self):
+		return self._read("names")
+
+	def find_names(self, tokens):
+		return self._read("find_names", tokens)
+
+	def close(self):
+		"""Stop the writer once the writes queued before this are done, and close every connection; readers still borrowed are left to the garbage collector"""
+		if self._closed:
+			return
+		self._closed = True
+		self._jobs.put(None)
+		self._writer_thread.join()
+
+		for _ in range(self._reader_count):
+			try:
+				self._readers.get_nowait().close()
+			except queue.Empty:
+				break
+
+def _log_entry(kind, payload):
+	return LOG_ENTRY_HEADER.pack(kind, len(payload)) + payload
+
+def _log_record_entry(hashed_key, encrypted_value, iv, hmac_signature):
+	header = LOG_RECORD_HEADER.pack(len(hashed_key), len(iv), len(hmac_signature))
+	return _log_entry(LOG_ENTRY_RECORD, b"".join((header, hashed_key, iv, encrypted_value, hmac_signature)))
+
+def encode_parameters(parameters):
+	"""Serialize a dict of database parameters to bytes, for storing them outside a SQLite table"""
+	return json.dumps({name: ({"hex": value.hex()} if isinstance(value, bytes) else value) for name, value in parameters.items()}).encode("utf-8")
+
+def decode_parameters(payload):
+	return {name: (bytes.fromhex(value["hex"]) if isinstance(value, dict) else value) for name, value in json.loads(payload.decode("utf-8")).items()}
+
+def _log_checkpoint_entry(name, position):
+	return _log_entry(LOG_ENTRY_CHECKPOINT, encode_parameters({"name": name, "position": position})) # positions scanned from a compact SQLite store are bytes
+
+class LogStorage(RecordStorage):
+	"""Records in an append-only log file, read through mmap with an in-memory index of hashed key -> entry offset
+
+The index is rebuilt by one sequential scan at open, and picks up entries appended by other processes before each operation
+Deletes append tombstones, so the file only shrinks through compact_log()
+Sealed values are returned as memoryview slices of the mapping, so nothing is copied on the way to the crypto layer
+session and wal are accepted for interface compatibility; the log always keeps its index and parameters in memory"""
+
+	def __init__(self, location, session = False, wal = False):
+		self.location = location
+		self._descriptor = os.open(location, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+		self._map = None
+		self._view = None
+		self._size = 0 # file size at the last scan
+		self._end = 0 # end of the last committed entry
+		self._index = {}
+		self._parameters = None
+		self._checkpoints = {}
+		self._pending = None # encoded entries of the open transaction
+		self._pending_keys = set() # hashed keys inserted by the open transaction
+
+		try:
+			self._refresh()
+		except:
+			os.close(self._descriptor)
+			raise
+
+	def _refresh(self):
+		size = os.fstat(self._descriptor).st_size
+		if size == self._size:
+			return
+
+		# the old mapping is left for the garbage collector, since slices returned by get() may still refer to it
+		self._map = mmap.mmap(self._descriptor, size, access = mmap.ACCESS_READ) if size > 0 else None
+		self._view = memoryview(self._map) if size > 0 else None
+		self._size = size
+		self._scan()
+
+	def _scan(self):
+		view = self._view
+		position = self._end
+		if position == 0:
+			if self._size < LOG_HEADER.size:
+				return
+			magic, format_version = LOG_HEADER.unpack_from(view, 0)
+			if magic != LOG_MAGIC:
+				raise AssertionError("'" + str(self.location) + "' is not a tinfoil log!")
+			if format_version != LOG_FORMAT_VERSION:
+				raise AssertionError("log format version mismatch! expected '" + str(LOG_FORMAT_VERSION) + "', got '" + str(format_version) + "'")
+			position = LOG_HEADER.size
+
+		pending = []
+		while (position + LOG_ENTRY_HEADER.size) <= self._size:
+			kind, length = LOG_ENTRY_HEADER.unpack_from(view, position)
+			end = position + LOG_ENTRY_HEADER.size + length
+			if end > self._size:
+				break # torn by a crash or still being written
+
+			if kind == LOG_ENTRY_COMMIT:
+				for entry in pending:
+					self._apply(*entry)
+				pending = []
+				self._end = end
+			elif kind in (LOG_ENTRY_PARAMETERS, LOG_ENTRY_RECORD, LOG_ENTRY_TOMBSTONE, LOG_ENTRY_CHECKPOINT):
+				pending.append((kind, position, length))
+			else:
+				raise AssertionError("unknown log entry kind '" + str(kind) + "' at offset " + str(position) + "!")
+			position = end
+
+	def _apply(self, kind, position, length):
+		start = position + LOG_ENTRY_HEADER.size
+		payload = self._view[start:(start + length)]
+		if kind == LOG_ENTRY_RECORD:
+			key_length = payload[0]
+			self._index[bytes(payload[LOG_RECORD_HEADER.size:(LOG_RECORD_HEADER.size + key_length)])] = position
+		elif kind == LOG_ENTRY_TOMBSTONE:
+			self._index.pop(bytes(payload), None)
+		elif kind == LOG_ENTRY_CHECKPOINT:
+			checkpoint = decode_parameters(bytes(payload))
+			if checkpoint["position"] is None:
+				self._checkpoints.pop(checkpoint["name"], None)
+			else:
+				self._checkpoints[checkpoint["name"]] = checkpoint["position"]
+		else:
+			self._parameters = decode_parameters(bytes(payload))
+
+	def _read_record(self, position):
+		view = self._view
+		length = LOG_ENTRY_HEADER.unpack_from(view, position)[1]
+		start = position + LOG_ENTRY_HEADER.size
+		end = start + length
+
+		key_length, iv_length, tag_length = LOG_RECORD_HEADER.unpack_from(view, start)
+		iv_start = start + LOG_RECORD_HEADER.size + key_length
+		ciphertext_start = iv_start + iv_length
+		tag_start = end - tag_length
+		return view[ciphertext_start:tag_start], view[iv_start:ciphertext_start], view[tag_start:end]
+
+	def _append(self, data):
+		written = 0
+		while written < len(data):
+			written += os.write(self._descriptor, data[written:])
+		os.fsync(self._descriptor)
+
+	@contextlib.contextmanager
+	def transaction(self):
+		if self._pending is not None:
+			raise AssertionError("a log transaction is already open!")
+
+		fcntl.flock(self._descriptor, fcntl.LOCK_EX)
+		try:
+			self._refresh()
+			if self._size > self._end: # drop a torn write; no reader ever indexes past the last commit
+				os.ftruncate(self._descriptor, self._end)
+				self._size = self._end
+
+			self._pending = []
+			yield
+			if self._pending:
+				if self._end == 0:
+					self._pending.insert(0, LOG_HEADER.pack(LOG_MAGIC, LOG_FORMAT_VERSION))
+				self._pending.append(_log_entry(LOG_ENTRY_COMMIT, b""))
+				self._append(b"".join(self._pending))
+				self._refresh()
+		finally:
+			self._pending = None
+			self._pending_keys.clear()
+			fcntl.flock(self._descriptor, fcntl.LOCK_UN)
+
+	def _queue(self, entry):
+		if self._pending is None:
+			raise AssertionError("log writes must happen inside a transaction!")
+		self._pending.append(entry)
+
+	def is_initialized(self):
+		self._refresh()
+		return (self._parameters is not None)
+
+	def create(self, parameters):
+		with self.transaction():
+			if self._parameters is not None:
+				raise AssertionError("log is already initialized!")
+			self._queue(_log_entry(LOG_ENTRY_PARAMETERS, encode_parameters(parameters)))
+
+	def load_parameters(self):
+		self._refresh()
+		if self._parameters is None:
+			raise AssertionError("log holds no database parameters!")
+		return dict(self._parameters)
+
+	def update_parameters(self, parameters):
+		"""Append the updated parameters; the entry they replace stays in the file until compact_log()"""
+		with self.transaction():
+			if self._parameters is None:
+				raise AssertionError("log holds no database parameters!")
+			self._queue(_log_entry(LOG_ENTRY_PARAMETERS, encode_parameters(dict(self._parameters, **parameters))))
+
+	def contains(self, hashed_key):
+		self._refresh()
+		return (hashed_key in self._index)
+
+	def get(self, hashed_key):
+		self._refresh()
+		position = self._index.get(hashed_key)
+		if position is None:
+			return None
+		return self._read_record(position)
+
+	def get_many(self, hashed_keys):
+		self._refresh()
+		return {hashed_key: self._read_record(self._index[hashed_key]) for hashed_key in set(hashed_keys) if hashed_key in self._index}
+
+	def insert(self, hashed_key, encrypted_value, iv, hmac_signature):
+		with self.transaction():
+			if hashed_key in self._index:
+				return False
+			self.insert_many([(hashed_key, encrypted_value, iv, hmac_signature)])
+		return True
+
+	def delete(self, hashed_key):
+		with self.transaction():
+			self.delete_many([hashed_key])
+
+	def find_existing(self, hashed_keys):
+		self._refresh() # also called outside transactions, such as by check_records()
+		return {hashed_key for hashed_key in hashed_keys if hashed_key in self._index}
+
+	def insert_many(self, rows):
+		for hashed_key, encrypted_value, iv, hmac_signature in rows:
+			self._queue(_log_record_entry(hashed_key, encrypted_value, iv, hmac_signature))
+			self._pending_keys.add(hashed_key)
+
+	def delete_many(self, hashed_keys):
+		for hashed_key in hashed_keys:
+			if (hashed_key in self._index) or (hashed_key in self._pending_keys): # the index only holds committed keys
+				self._queue(_log_entry(LOG_ENTRY_TOMBSTONE, hashed_key))
+
+	def scan(self, after = None, batch_size = DEFAULT_SCAN_BATCH_SIZE):
+		self._refresh()
+		positions = [position for position in self._index.values() if (not after) or (position > after)] # a snapshot; later appends are not visited
+		positions.sort()
+		for i in range(0, len(positions), batch_size):
+			batch = []
+			for position in positions[i:(i + batch_size)]:
+				encrypted_value, iv, hmac_signature = self._read_record(position)
+				key_start = position + LOG_ENTRY_HEADER.size + LOG_RECORD_HEADER.size
+				key_length = self._view[position + LOG_ENTRY_HEADER.size]
+				batch.append((position, bytes(self._view[key_start:(key_start + key_length)]), bytes(encrypted_value), bytes(iv), bytes(hmac_signature)))
+			yield batch
+
+	def load_checkpoint(self, name):
+		self._refresh()
+		return self._checkpoints.get(name)
+
+	def save_checkpoint(self, name, position):
+		self._queue(_log_checkpoint_entry(name, position))
+
+	def close(self):
+		self._view = None
+		if self._map is not None:
+			try:
+				self._map.close()
+			except BufferError:
+				pass # a caller still holds a slice; the mapping is released along with it
+			self._map = None
+		os.close(self._descriptor)
+
+ENGINES = {
+	ENGINE_SQLITE: CompactSQLiteStorage,
+	ENGINE_LOG: LogStorage,
+	ENGINE_SHARDED: ShardedSQLiteStorage,
+}
+
+def detect_engine(location):
+	"""Name the engine that created the store at location, defaulting to SQLite for new or in-memory databases"""
+	try:
+		with open(location, "rb") as f:
+			magic = f.read(len(LOG_MAGIC))
+	except OSError:
+		return ENGINE_SQLITE
+	if magic == LOG_MAGIC:
+		return ENGINE_LOG
+	return ENGINE_SHARDED if (_sqlite_layout(location) is ShardedSQLiteStorage) else ENGINE_SQLITE
+
+def _sqlite_layout(location):
+	"""Return the SQLite storage class matching the tables of the database at location, or None for a new database"""
+	if (location == ":memory:") or (not os.path.isfile(location)) or (os.path.getsize(location) == 0):
+		return None
+	connection = sqlite3.connect(pathlib.Path(location).absolute().as_uri() + "?mode=ro", uri = True)
+	try:
+		sharded = (connection.execute(SQL_CHECK_SHARDS).fetchone()[0] == 1)
+		legacy = (connection.execute(SQL_CHECK_ENTRIES).fetchone()[0] == 1)
+	finally:
+		connection.close()
+	if sharded:
+		return ShardedSQLiteStorage
+	return SQLiteStorage if legacy else CompactSQLiteStorage
+
+def resolve_engine(location, engine = None):
+	"""Return the RecordStorage subclass for an engine name (or subclass), detecting it from the file at location if none is given
+
+The SQLite engine opens databases created before the compact layout with SQLiteStorage, and sharded databases with ShardedSQLiteStorage"""
+	if engine is None:
+		engine = detect_engine(location)
+	if isinstance(engine, str):
+		if engine not in ENGINES:
+			raise AssertionError("unknown storage engine '" + engine + "'!")
+		engine = ENGINES[engine]
+	if engine in (CompactSQLiteStorage, ShardedSQLiteStorage):
+		layout = _sqlite_layout(location)
+		if (engine is ShardedSQLiteStorage) and (layout not in (None, ShardedSQLiteStorage)):
+			raise AssertionError("'" + location + "' is not a sharded database! tinfoil-migrate can copy it into one")
+		engine = layout or engine
+	return engine
+
+def open_storage(location, engine = None, session = False, wal = False, readers = 0, shards = None):
+	"""Open a store with the named engine (or a RecordStorage subclass), detecting the engine from the file if none is given
+
+If readers is set, a SQLite store is opened as a PooledSQLiteStorage with that many read-only connections, which threads may share
+shards is the shard count of a new sharded database (see ShardedSQLiteStorage)"""
+	engine = resolve_engine(location, engine)
+	if readers:
+		return PooledSQLiteStorage(location, engine, readers = readers)
+	if issubclass(engine, ShardedSQLiteStorage):
+		return engine(location, session = session, wal = wal, shards = shards)
+	return engine(location, session = session, wal = wal)
+
+def _shard_count(location):
+	connection = sqlite3.connect(pathlib.Path(location).absolute().as_uri() + "?mode=ro", uri = True)
+	try:
+		return connection.execute(SQL_SELECT_SHARD_COUNT).fetchone()[0]
+	finally:
+		connection.close()
+
+def store_files(location):
+	"""Return the files a store is kept in: the file at location, then the shard files of a sharded database"""
+	if detect_engine(location) != ENGINE_SHARDED:
+		return [location]
+	return [location] + [shard_path(location, shard) for shard in range(_shard_count(location))]
+
+def move_store(location, destination):
+	"""Rename a closed store's files to those of a store at destination, its shards first"""
+	files = store_files(location)
+	for shard, path in enumerate(files[1:]):
+		os.replace(path, shard_path(destination, shard))
+	os.replace(location, destination)
+
+def remove_store(location):
+	"""Remove whatever is left of a SQLite or log store, such as by an interrupted copy: its files, shard files and SQLite journals"""
+	paths = [location] + sorted(glob.glob(glob.escape(location) + SHARD_SUFFIX.replace("%03d", "[0-9][0-9][0-9]")))
+	for path in paths:
+		for suffix in ("", "-journal", "-wal", "-shm"):
+			if os.path.exists(path + suffix):
+				os.remove(path + suffix)
+
+def compact_log(location):
+	"""Rewrite a log store with only its live records and latest parameters, returning (old size, new size) in bytes
+
+Offline only: the file is replaced, so nothing else may have the log open while it runs"""
+	storage = LogStorage(location)
+	try:
+		fcntl.flock(storage._descriptor, fcntl.LOCK_EX)
+		storage._refresh()
+		if storage._parameters is None:
+			raise AssertionError("log holds no database parameters!")
+
+		old_size = storage._size
+		view = storage._view
+		temporary_location = location + ".compact"
+
+		try:
+			with open(temporary_location, "wb") as f:
+				f.write(LOG_HEADER.pack(LOG_MAGIC, LOG_FORMAT_VERSION))
+				f.write(_log_entry(LOG_ENTRY_PARAMETERS, encode_parameters(storage._parameters)))
+				for position in storage._index.values():
+					length = LOG_ENTRY_HEADER.unpack_from(view, position)[1]
+					f.write(view[position:(position + LOG_ENTRY_HEADER.size + length)])
+				for name, position in storage._checkpoints.items():
+					f.write(_log_checkpoint_entry(name, position))
+				f.write(_log_entry(LOG_ENTRY_COMMIT, b""))
+				f.flush()
+				os.fsync(f.fileno())
+			os.chmod(temporary_location, 0o600)
+			os.replace(temporary_location, location)
+		except:
+			if os.path.exists(temporary_location):
+				os.remove(temporary_location)
+			raise
+
+		directory = os.open(os.path.dirname(os.path.abspath(location)), os.O_RDONLY)
+		try:
+			os.fsync(directory) # make the rename itself durable
+		finally:
+			os.close(directory)
+	finally:
+		storage.close()
+
+	return old_size, os.path.getsize(location)
+
+def _copy_sqlite(location, target, pages_per_step, pause, report):
+	source = sqlite3.connect(pathlib.Path(location).absolute().as_uri() + "?mode=ro", uri = True)
+	destination = sqlite3.connect(target)
+	try:
+		def progress(status, remaining, total):
+			report(total - remaining, total)
+			time.sleep(pause)
+
+		# the source is only locked while each step runs; a write from another connection restarts the copy
+		source.backup(destination, pages = pages_per_step, progress = progress)
+	finally:
+		destination.close()
+		source.close()
+
+def _lock_sqlite(paths):
+	"""Open a connection to each SQLite file and take the write lock of every one, returning the connections once all are held
+
+Locks are taken in order, waiting up to COPY_LOCK_WAIT for each; if one stays busy, the ones already taken are released before trying again,
+so a writer that holds it and waits on one of them is not kept waiting long"""
+	connections = []
+	try:
+		for path in paths:
+			connections.append(sqlite3.connect(pathlib.Path(path).absolute().as_uri() + "?mode=rw", uri = True, timeout = COPY_LOCK_WAIT, isolation_level = None))
+
+		deadline = time.monotonic() + COPY_LOCK_TIMEOUT
+		while True:
+			locked = []
+			try:
+				for connection in connections:
+					connection.execute("BEGIN IMMEDIATE")
+					locked.append(connection)
+				return connections
+			except sqlite3.OperationalError as exception:
+				for connection in locked:
+					connection.execute("ROLLBACK")
+				if time.monotonic() >= deadline:
+					raise AssertionError("cannot lock '" + paths[len(locked)] + "' for a consistent copy: " + str(exception))
+				time.sleep(COPY_LOCK_RETRY_PAUSE)
+	except:
+		for connection in connections:
+			connection.close()
+		raise
+
+def _copy_log(location, target, pause, report):
+	storage = LogStorage(location)
+	try:
+		fcntl.flock(storage._descriptor, fcntl.LOCK_SH) # waits out an open transaction, so the committed end is final
+		try:
+			storage._refresh()
+			end = storage._end
+			view = storage._view
+		finally:
+			fcntl.flock(storage._descriptor, fcntl.LOCK_UN)
+
+		# nothing before the last commit is ever rewritten in place, so it is copied without the lock
+		with open(target, "wb") as f:
+			for offset in range(0, end, LOG_COPY_SIZE):
+				f.write(view[offset:min(offset + LOG_COPY_SIZE, end)])
+				report(min(offset + LOG_COPY_SIZE, end), end)
+				time.sleep(pause)
+			f.flush()
+			os.fsync(f.fileno())
+		view = None
+	finally:
+		storage.close()
+
+def copy_store(location, target, pages_per_step = DEFAULT_COPY_PAGES_PER_STEP, pause = DEFAULT_COPY_PAUSE, report = None):
+	"""Copy a store that may be open elsewhere to a new file at target, as it was at one committed point in time, returning the engine name
+
+SQLite databases are copied with the online backup API a few pages at a time; log stores are copied up to their last commit
+Neither holds a lock that a live session would wait on for more than one step
+A sharded database is copied while the write locks of the main file and every shard are held, since no transaction can be midway through
+committing its shards then; writers wait for the whole copy, which runs without pausing between steps"""
+	if report is None:
+		report = lambda done, total: None
+
+	engine = detect_engine(location)
+	if engine == ENGINE_LOG:
+		_copy_log(location, target, pause, report)
+	elif engine == ENGINE_SHARDED:
+		paths = store_files(location)
+		locks = _lock_sqlite(paths[1:] + paths[:1]) # the main file last, as transactions lock it
+		try:
+			for shard, path in enumerate(paths[1:]): # read on connections of their own, as the backup API will not read from one that is writing
+				_copy_sqlite(path, shard_path(target, shard), pages_per_step, 0, report)
+			_copy_sqlite(location, target, pages_per_step, 0, report)
+		finally:
+			for connection in locks:
+				connection.close() # also rolls back its empty transaction, releasing the lock
+	else:
+		_copy_sqlite(location, target, pages_per_step, pause, report)
+	return engine
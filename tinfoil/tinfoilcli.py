@@ -1,19 +1,23 @@
 #!/bin/python3
 
+import os
 import sys
 import cmd
 import getpass
+import argparse
 
-import pyperclip as clipboard
-
-from . import inputlib, passwordlib
-from .tinfoillib import TinfoilDB
+# modules that load cryptography, scrypt or the clipboard are imported where they are used,
+# so that 'tinfoil --help' and commands served by tinfoil-agent start without them
+from . import inputlib, storagelib
+from .inputlib import PASSWORD_FD_ENVIRONMENT_VARIABLE, read_secret
 
 DEFAULT_DATABASE = "tinfoil.db"
 DEFAULT_SCRYPT_N = 19
 DEFAULT_SCRYPT_R = 8
 DEFAULT_SCRYPT_P = 1
 
+DEFAULT_STORAGE_ENGINE = storagelib.ENGINE_SQLITE
+
 SCRYPT_N_MINIMUM = 14
 SCRYPT_N_MAXIMUM = 23
 
@@ -26,6 +30,11 @@ DEFAULT_PASSWORD_DIGITS = True
 DEFAULT_PASSWORD_SPECIAL_CHARACTERS = True
 DEFAULT_PASSWORD_SPACES = True
 
+CACHE_ENVIRONMENT_VARIABLE = "TINFOIL_CACHE_SIZE" # decrypted values the console keeps in memory; unset or 0 for none
+STATS_ENVIRONMENT_VARIABLE = "TINFOIL_STATS" # statslib.ENVIRONMENT_VARIABLE, repeated so statslib is only imported when timing is on
+
+AGENT_COMMANDS = ("get", "set", "del") # the one-shot commands tinfoil-agent can serve
+
 database = None
 
 def bool_to_y_n(value):
@@ -59,39 +68,91 @@ def ask_database_password():
 	else:
 		return user_input
 
-def ask_database_parameters():
-	print()
-	print("--- database first-time setup ---")
+def format_position(position):
+	"""Format a scan position for display: rowids and log offsets as numbers, hashed keys in hex"""
+	return position.hex() if isinstance(position, bytes) else str(position)
+
+def print_verify_result(result, file = sys.stdout):
+	for position in result["corrupt_records"]:
+		print("corrupt record at " + format_position(position), file = file)
+	for hashed_key in result["corrupt_streams"]:
+		print("corrupt stream " + hashed_key.hex(), file = file)
+	print("checked " + str(result["records"]) + " records and " + str(result["streams"]) + " streams in " + str(round(result["seconds"], 2)) + "s: " +
+		str(len(result["corrupt_records"])) + " corrupt records, " + str(len(result["corrupt_streams"])) + " corrupt streams", file = file)
+
+def copy_to_clipboard(value):
+	import pyperclip
+	pyperclip.copy(value)
+
+def is_valid_engine(string):
+	return (string in storagelib.ENGINES)
+
+def ask_storage_engine():
+	engine_input_args = ("storage engine (" + "/".join(storagelib.ENGINES) + ") [def: " + DEFAULT_STORAGE_ENGINE + "]: ", )
+	engine_input_kwargs = {"default": DEFAULT_STORAGE_ENGINE, "verification_function": is_valid_engine}
+	engine_error_message = "storage engine must be one of: " + ", ".join(storagelib.ENGINES)
+	engine = inputlib.do_input_loop(inputlib.ask_string, engine_input_args, engine_input_kwargs, error_message = engine_error_message)
 	print()
+	return engine
 
-	print("[master key work factor]")
-	print("larger values are more secure but slower")
-	print("please refer to 'tinfoil-spd' to determine an optimal value for your hardware")
-	print("it must be an integer between " + str(SCRYPT_N_MINIMUM) + " and " + str(SCRYPT_N_MAXIMUM) + " (inclusive); the default is " + str(DEFAULT_SCRYPT_N))
-	scrypt_n_input_args = ("scrypt work factor [def: " + str(DEFAULT_SCRYPT_N) + "]: ", )
-	scrypt_n_input_kwargs = {"default": DEFAULT_SCRYPT_N, "verification_function": is_valid_N}
-	scrypt_n_error_message = "work factor must be an integer between " + str(SCRYPT_N_MINIMUM) + " and " + str(SCRYPT_N_MAXIMUM) + "!"
-	scrypt_n = inputlib.do_input_loop(inputlib.ask_integer, scrypt_n_input_args, scrypt_n_input_kwargs, error_message = scrypt_n_error_message)
-	print()
+def ask_use_calibration(calibration):
+	"""Offer the parameters found by 'tinfoil-spd'; returns (N exponent, r, p), or None to enter them manually"""
+	scrypt_n, scrypt_r, scrypt_p = calibration["log2_n"], calibration["r"], calibration["p"]
+	if not (is_valid_N(scrypt_n) and is_valid_r(scrypt_r) and is_valid_p(scrypt_p)):
+		return None
 
-	print("[master key memory factor]")
-	print("this should be increased in the event of a major advance in RAM technology")
-	print("it may be any positive non-zero integer; the default is " + str(DEFAULT_SCRYPT_R))
-	scrypt_r_input_args = ("scrypt memory factor [def: " + str(DEFAULT_SCRYPT_R) + "]: ", )
-	scrypt_r_input_kwargs = {"default": DEFAULT_SCRYPT_R, "verification_function": is_valid_r}
-	scrypt_r_error_message = "memory factor must be a non-zero integer!"
-	scrypt_r = inputlib.do_input_loop(inputlib.ask_integer, scrypt_r_input_args, scrypt_r_input_kwargs, error_message = scrypt_r_error_message)
+	print("[calibrated parameters]")
+	print("'tinfoil-spd' found N = " + str(scrypt_n) + ", r = " + str(scrypt_r) + ", p = " + str(scrypt_p) + " (unlock takes ~" + str(round(calibration["time"]["mean"], 1)) + "s on this machine)")
+	use_input_args = ("use these parameters? " + bool_to_y_n(True) + ": ", )
+	use_input_kwargs = {"default": True}
+	use_error_message = "must be a 'y' for yes, or a 'n' for no"
+	use_calibration = inputlib.do_input_loop(inputlib.ask_boolean, use_input_args, use_input_kwargs, error_message = use_error_message)
 	print()
 
-	print("[master key paralellism factor]")
-	print("this should be increased in the event of a major advance in CPU technology")
-	print("it may be any positive non-zero integer; the default is " + str(DEFAULT_SCRYPT_P))
-	scrypt_p_input_args = ("scrypt parallelism factor [def: " + str(DEFAULT_SCRYPT_P) + "]: ", )
-	scrypt_p_input_kwargs = {"default": DEFAULT_SCRYPT_P, "verification_function": is_valid_p}
-	scrypt_p_error_message = "parallelism factor must be a non-zero integer!"
-	scrypt_p = inputlib.do_input_loop(inputlib.ask_integer, scrypt_p_input_args, scrypt_p_input_kwargs, error_message = scrypt_p_error_message)
+	if use_calibration:
+		return (scrypt_n, scrypt_r, scrypt_p)
+	return None
+
+def ask_database_parameters(calibration = None):
+	print()
+	print("--- database first-time setup ---")
 	print()
 
+	scrypt_parameters = None
+	if calibration is not None:
+		scrypt_parameters = ask_use_calibration(calibration)
+
+	if scrypt_parameters is not None:
+		scrypt_n, scrypt_r, scrypt_p = scrypt_parameters
+	else:
+		print("[master key work factor]")
+		print("larger values are more secure but slower")
+		print("please refer to 'tinfoil-spd' to determine an optimal value for your hardware")
+		print("it must be an integer between " + str(SCRYPT_N_MINIMUM) + " and " + str(SCRYPT_N_MAXIMUM) + " (inclusive); the default is " + str(DEFAULT_SCRYPT_N))
+		scrypt_n_input_args = ("scrypt work factor [def: " + str(DEFAULT_SCRYPT_N) + "]: ", )
+		scrypt_n_input_kwargs = {"default": DEFAULT_SCRYPT_N, "verification_function": is_valid_N}
+		scrypt_n_error_message = "work factor must be an integer between " + str(SCRYPT_N_MINIMUM) + " and " + str(SCRYPT_N_MAXIMUM) + "!"
+		scrypt_n = inputlib.do_input_loop(inputlib.ask_integer, scrypt_n_input_args, scrypt_n_input_kwargs, error_message = scrypt_n_error_message)
+		print()
+
+		print("[master key memory factor]")
+		print("this should be increased in the event of a major advance in RAM technology")
+		print("it may be any positive non-zero integer; the default is " + str(DEFAULT_SCRYPT_R))
+		scrypt_r_input_args = ("scrypt memory factor [def: " + str(DEFAULT_SCRYPT_R) + "]: ", )
+		scrypt_r_input_kwargs = {"default": DEFAULT_SCRYPT_R, "verification_function": is_valid_r}
+		scrypt_r_error_message = "memory factor must be a non-zero integer!"
+		scrypt_r = inputlib.do_input_loop(inputlib.ask_integer, scrypt_r_input_args, scrypt_r_input_kwargs, error_message = scrypt_r_error_message)
+		print()
+
+		print("[master key paralellism factor]")
+		print("this should be increased in the event of a major advance in CPU technology")
+		print("it may be any positive non-zero integer; the default is " + str(DEFAULT_SCRYPT_P))
+		scrypt_p_input_args = ("scrypt parallelism factor [def: " + str(DEFAULT_SCRYPT_P) + "]: ", )
+		scrypt_p_input_kwargs = {"default": DEFAULT_SCRYPT_P, "verification_function": is_valid_p}
+		scrypt_p_error_message = "parallelism factor must be a non-zero integer!"
+		scrypt_p = inputlib.do_input_loop(inputlib.ask_integer, scrypt_p_input_args, scrypt_p_input_kwargs, error_message = scrypt_p_error_message)
+		print()
+
 	print()
 
 	print("[master password]")
@@ -182,7 +243,7 @@ Usage: get <key> [--show]"""
 		if show_result:
 			print("result: '" + result + "'")
 		else:
-			clipboard.copy(result)
+			copy_to_clipboard(result)
 			print("result successfully copied to clipboard")
 
 		return True
@@ -202,6 +263,7 @@ Usage: set <key> [value]"""
 		if len(args) == 2:
 			value = args[1]
 		elif len(args) == 1:
+			from . import passwordlib
 			length, digits, special_characters, spaces = ask_password_parameters()
 			value = passwordlib.generate_password(length = length, digits = digits, special_characters = special_characters, spaces = spaces)
 
@@ -239,6 +301,304 @@ Usage: del <key>"""
 
 		return True
 
+	def do_ls(self, line):
+		"""List the keys of every record in the database
+Usage: ls"""
+		if line.split(): # the command takes no arguments
+			return False
+
+		if not hasattr(database, "list_keys"):
+			print("error: keys cannot be listed through tinfoil-agent!")
+			return True
+
+		try:
+			keys = database.list_keys()
+		except AssertionError as exception:
+			print("error: " + str(exception))
+			return True
+
+		for key in keys:
+			print(key)
+		print(str(len(keys)) + " keys")
+		return True
+
+	def do_find(self, line):
+		"""List the keys that have a word starting with the given text, ignoring case
+Usage: find <prefix>"""
+		args = line.split()
+
+		if len(args) != 1: # the command must have 1 argument
+			return False
+
+		if not hasattr(database, "find_keys"):
+			print("error: keys cannot be searched through tinfoil-agent!")
+			return True
+
+		try:
+			keys = database.find_keys(args[0])
+		except AssertionError as exception:
+			print("error: " + str(exception))
+			return True
+
+		for key in keys:
+			print(key)
+		print(str(len(keys)) + " matching keys")
+		return True
+
+	def do_reindex(self, line):
+		"""Rebuild the index used by 'ls' and 'find', such as for records stored by an older version of tinfoil
+Usage: reindex"""
+		if line.split(): # the command takes no arguments
+			return False
+
+		if not hasattr(database, "rebuild_index"):
+			print("error: the index cannot be rebuilt through tinfoil-agent!")
+			return True
+
+		try:
+			count = database.rebuild_index()
+		except AssertionError as exception:
+			print("error: " + str(exception))
+			return True
+
+		print("index rebuilt with " + str(count) + " keys")
+		return True
+
+	def do_verify(self, line):
+		"""Authenticate every record and stream, listing the position of each one that fails
+With --decrypt, records are also decrypted and their contents checked
+Usage: verify [--decrypt]"""
+		args = [arg.lower() for arg in line.split()]
+		if not set(args) <= {"--decrypt"}:
+			return False
+
+		if not hasattr(database, "verify_all"):
+			print("error: records cannot be verified through tinfoil-agent!")
+			return True
+
+		def report(records):
+			print("\rchecked " + str(records) + " records...", end = "", flush = True)
+
+		try:
+			result = database.verify_all(decrypt = ("--decrypt" in args), report = report)
+		except AssertionError as exception:
+			print()
+			print("error: " + str(exception))
+			return True
+
+		print()
+		print_verify_result(result)
+		return True
+
+	def do_passwd(self, line):
+		"""Change the database's master password; only the wrapped data key is rewritten, not the records
+Usage: passwd"""
+		if line.split(): # the command takes no arguments
+			return False
+
+		if not hasattr(database, "change_master_password"):
+			print("error: the master password cannot be changed through tinfoil-agent!")
+			return True
+
+		print("please enter the current master password")
+		password = ask_database_password()
+		print("please enter the new master password")
+		new_password = ask_database_password()
+		if new_password == None:
+			print("error: master password cannot be blank!")
+			return True
+		print("please re-enter the new master password")
+		if ask_database_password() != new_password:
+			print("error: passwords did not match -- no changes have been applied to the database!")
+			return True
+
+		try:
+			changed = (password != None) and database.change_master_password(password, new_password)
+		except AssertionError as exception:
+			print("error: " + str(exception))
+			return True
+
+		if changed:
+			print("master password successfully changed")
+		else:
+			print("error: incorrect master password -- no changes have been applied to the database!")
+		return True
+
+	def do_kdf(self, line):
+		"""Show the database's scrypt parameters, or re-wrap its data key with new ones (N is given as a power of 2)
+Usage: kdf [<N> <r> <p>]"""
+		args = line.split()
+
+		if not hasattr(database, "reparameterize"):
+			print("error: scrypt parameters cannot be changed through tinfoil-agent!")
+			return True
+
+		if len(args) == 0:
+			kdf_parameters = database.get_kdf_parameters()
+			print("N = " + str(kdf_parameters["n"].bit_length() - 1) + "; r = " + str(kdf_parameters["r"]) + "; p = " + str(kdf_parameters["p"]))
+			return True
+
+		if len(args) != 3: # the command must have 0 or 3 arguments
+			return False
+
+		try:
+			scrypt_n, scrypt_r, scrypt_p = (int(arg) for arg in args)
+		except ValueError:
+			return False
+
+		if not (is_valid_N(scrypt_n) and is_valid_r(scrypt_r) and is_valid_p(scrypt_p)):
+			print("error: N must be between " + str(SCRYPT_N_MINIMUM) + " and " + str(SCRYPT_N_MAXIMUM) + ", and r and p must be positive!")
+			return True
+
+		password = ask_database_password()
+		if password == None:
+			print("error: incorrect master password -- no changes have been applied to the database!")
+			return True
+
+		print("re-wrapping the data key...")
+		try:
+			changed = database.reparameterize(password, (2 ** scrypt_n), scrypt_r, scrypt_p)
+		except AssertionError as exception:
+			print("error: " + str(exception))
+			return True
+
+		if changed:
+			print("scrypt parameters successfully changed")
+		else:
+			print("error: incorrect master password -- no changes have been applied to the database!")
+		return True
+
+	def do_import(self, line):
+		"""Add the entries of a CSV or JSON file (tinfoil, KeePass or Bitwarden exports) or of an encrypted tinfoil export; existing keys are kept
+Usage: import <file>"""
+		args = line.split()
+
+		if len(args) != 1: # the command must have 1 argument
+			return False
+
+		if not hasattr(database, "storage"):
+			print("error: records cannot be imported through tinfoil-agent!")
+			return True
+
+		path = args[0]
+		if not os.path.isfile(path):
+			print("error: no file at '" + path + "'!")
+			return True
+
+		from . import transferlib
+		passphrase = None
+		if transferlib.is_encrypted_export(path):
+			passphrase = getpass.getpass("export passphrase: ")
+
+		def report(counts):
+			print("\rimported " + str(counts["imported"]) + " entries...", end = "", flush = True)
+
+		try:
+			counts = transferlib.import_file(database, path, passphrase = passphrase, report = report)
+		except (AssertionError, ValueError, UnicodeDecodeError) as exception:
+			print()
+			print("error: " + str(exception))
+			return True
+
+		print()
+		print("imported " + str(counts["imported"]) + " entries; " + str(counts["existing"]) + " keys already existed and " + str(counts["skipped"]) + " entries had no key or value")
+		return True
+
+	def do_export(self, line):
+		"""Write every record to a new file, encrypted under a separate passphrase unless --plaintext is given, as CSV or --json (JSON Lines)
+Records created before database version 4 do not store their key and are left out
+Usage: export <file> [--plaintext] [--json]"""
+		args = line.split()
+
+		if len(args) == 0:
+			return False
+
+		path = args[0]
+		options = [arg.lower() for arg in args[1:]]
+		if not set(options) <= {"--plaintext", "--json"}:
+			return False
+
+		if not hasattr(database, "storage"):
+			print("error: records cannot be exported through tinfoil-agent!")
+			return True
+
+		if os.path.exists(path):
+			print("error: '" + path + "' already exists!")
+			return True
+
+		passphrase = None
+		if "--plaintext" not in options:
+			passphrase = getpass.getpass("export passphrase: ")
+			if passphrase == "":
+				print("error: export passphrase cannot be blank!")
+				return True
+			if getpass.getpass("confirm export passphrase: ") != passphrase:
+				print("error: passphrases did not match -- nothing was exported!")
+				return True
+
+		def report(counts):
+			print("\rexported " + str(counts["exported"]) + " entries...", end = "", flush = True)
+
+		from . import transferlib
+		format = "json" if "--json" in options else "csv"
+		try:
+			counts = transferlib.export_file(database, path, passphrase = passphrase, format = format, report = report)
+		except AssertionError as exception:
+			print()
+			print("error: " + str(exception))
+			return True
+
+		print()
+		print("exported " + str(counts["exported"]) + " entries to '" + path + "'" + (" in plaintext" if passphrase is None else ""))
+		if counts["unnamed"]:
+			print(str(counts["unnamed"]) + " records from before database version 4 have no stored key and were left out")
+		return True
+
+	def do_stats(self, line):
+		"""Show the count and latency of each phase (kdf, hash, query, commit, ...) and database operation timed since stats were enabled
+Set TINFOIL_STATS=1 before starting tinfoil to time unlocking the database too
+The record cache's counters are shown too, if TINFOIL_CACHE_SIZE was set
+Usage: stats [on | off | reset | dump <file>]"""
+		args = line.split()
+
+		if (len(args) > 2) or ((len(args) == 2) != (args[:1] == ["dump"])) or (args[:1] not in ([], ["on"], ["off"], ["reset"], ["dump"])):
+			return False
+
+		if not hasattr(database, "storage"):
+			print("error: stats are kept by tinfoil-agent's process, and cannot be shown through it!")
+			return True
+
+		from . import statslib
+
+		if not args:
+			stats = statslib.snapshot()
+			if not stats:
+				print("nothing has been timed" + ("" if statslib.is_enabled() else "; enable timing with 'stats on'"))
+			else:
+				for table_line in statslib.format_table(stats):
+					print(table_line)
+
+			cache_stats = database.cache_stats()
+			if cache_stats is not None:
+				print("cache: " + str(cache_stats["hits"]) + " hits, " + str(cache_stats["misses"]) + " misses, " + str(cache_stats["evictions"]) + " evictions, " + str(cache_stats["expirations"]) + " expirations; " + str(cache_stats["entries"]) + " of " + str(cache_stats["capacity"]) + " entries held")
+		elif args[0] == "on":
+			statslib.enable()
+			print("timing enabled")
+		elif args[0] == "off":
+			statslib.disable()
+			print("timing disabled; what was recorded is kept until 'stats reset'")
+		elif args[0] == "reset":
+			statslib.reset()
+			print("recorded timings cleared")
+		else:
+			if os.path.exists(args[1]):
+				print("error: '" + args[1] + "' already exists!")
+				return True
+			with open(args[1], "x", encoding = "utf-8") as f:
+				statslib.dump(f)
+			print("timings written to '" + args[1] + "'")
+		return True
+
 	def do_exit(self, line):
 		"""Shut down the database and exit the program immediately
 Usage: exit"""
@@ -254,15 +614,248 @@ Usage: exit"""
 			self.default(line)
 		print()
 
+def _open_command_database(arguments):
+	"""Return the database a one-shot command runs against: tinfoil-agent, if one is running, can serve the command and serves the database named by -d (if given),
+or else the database file, unlocked with a master password read from --password-fd or prompted for"""
+	if (arguments.command in AGENT_COMMANDS) and not arguments.no_agent:
+		from . import agent
+		client = agent.connect_agent()
+		if (client is not None) and ((arguments.database is None) or (client.database_path == os.path.realpath(arguments.database))):
+			return client
+
+	from .tinfoillib import TinfoilDB
+	location = arguments.database or DEFAULT_DATABASE
+	if not os.path.exists(location):
+		raise AssertionError("no database at '" + location + "'! run 'tinfoil' without a command to set one up")
+
+	database = TinfoilDB(location)
+	if not database.check_database_initialized():
+		database.close()
+		raise AssertionError("database is not initialized! run 'tinfoil' without a command to set it up")
+
+	password = read_secret(arguments.password_fd, "database master password: ")
+	if (not password) or (not database.set_master_keys(password)):
+		database.close()
+		raise AssertionError("incorrect master password!")
+	return database
+
+def _read_value(key):
+	"""Read the value for 'set' from the next line of standard input, or ask for it if standard input is a terminal"""
+	descriptor = None if sys.stdin.isatty() else sys.stdin.fileno()
+	value = read_secret(descriptor, "value for '" + key + "': ")
+	if not value:
+		raise AssertionError("value cannot be blank!")
+	return value
+
+def _read_passphrase(arguments, confirm = False):
+	if arguments.passphrase_fd is not None:
+		return read_secret(arguments.passphrase_fd, None)
+
+	passphrase = getpass.getpass("export passphrase: ")
+	if confirm and passphrase and (getpass.getpass("confirm export passphrase: ") != passphrase):
+		raise AssertionError("passphrases did not match -- nothing was exported!")
+	return passphrase
+
+def command_get(database, arguments):
+	value = database.retrieve_record(arguments.key)
+	if value is None:
+		raise AssertionError("no record associated with that key!")
+
+	if arguments.clip:
+		copy_to_clipboard(value)
+	else:
+		print(value)
+
+def command_set(database, arguments):
+	if arguments.generate:
+		from . import passwordlib
+		value = passwordlib.generate_password(length = arguments.length, digits = not arguments.no_digits, special_characters = not arguments.no_special, spaces = not arguments.no_spaces)
+	else:
+		value = _read_value(arguments.key)
+
+	if not database.store_record(arguments.key, value):
+		raise AssertionError("value already exists for this key!")
+
+	if arguments.generate:
+		if arguments.clip:
+			copy_to_clipboard(value)
+		else:
+			print(value)
+
+def command_del(database, arguments):
+	if not database.check_record(arguments.key):
+		raise AssertionError("no record associated with that key!")
+	database.delete_record(arguments.key)
+
+def command_ls(database, arguments):
+	for key in database.list_keys():
+		print(key)
+
+def command_find(database, arguments):
+	for key in database.find_keys(arguments.prefix):
+		print(key)
+
+def command_import(database, arguments):
+	from . import transferlib
+	if not os.path.isfile(arguments.file):
+		raise AssertionError("no file at '" + arguments.file + "'!")
+
+	passphrase = None
+	if transferlib.is_encrypted_export(arguments.file):
+		passphrase = _read_passphrase(arguments)
+
+	try:
+		counts = transferlib.import_file(database, arguments.file, passphrase = passphrase)
+	except (ValueError, UnicodeDecodeError) as exception:
+		raise AssertionError(str(exception))
+	print("imported " + str(counts["imported"]) + " entries; " + str(counts["existing"]) + " keys already existed and " + str(counts["skipped"]) + " entries had no key or value")
+
+def command_export(database, arguments):
+	from . import transferlib
+	if os.path.exists(arguments.file):
+		raise AssertionError("'" + arguments.file + "' already exists!")
+
+	passphrase = None
+	if not arguments.plaintext:
+		passphrase = _read_passphrase(arguments, confirm = True)
+		if not passphrase:
+			raise AssertionError("export passphrase cannot be blank!")
+
+	counts = transferlib.export_file(database, arguments.file, passphrase = passphrase, format = ("json" if arguments.json else "csv"))
+	print("exported " + str(counts["exported"]) + " entries to '" + arguments.file + "'" + (" in plaintext" if passphrase is None else ""))
+	if counts["unnamed"]:
+		print(str(counts["unnamed"]) + " records from before database version 4 have no stored key and were left out")
+
+def command_verify(database, arguments):
+	result = database.verify_all(decrypt = arguments.decrypt, workers = arguments.workers)
+	print_verify_result(result)
+	if result["corrupt_records"] or result["corrupt_streams"]:
+		raise AssertionError("the database failed verification!")
+
+COMMANDS = {
+	"get": command_get,
+	"set": command_set,
+	"del": command_del,
+	"ls": command_ls,
+	"find": command_find,
+	"import": command_import,
+	"export": command_export,
+	"verify": command_verify,
+}
+
+def parse_arguments(arguments = None):
+	parser = argparse.ArgumentParser(prog = "tinfoil", description = "password manager; without a command, opens the interactive console",
+		epilog = "get, set and del use tinfoil-agent while TINFOIL_AGENT_SOCK is set, unless -d names another database; other commands read the master password from --password-fd, or prompt for it")
+	parser.add_argument("-d", "--database", default = None, help = "database location (default: the one tinfoil-agent serves, or else " + DEFAULT_DATABASE + ")")
+	parser.add_argument("--password-fd", type = int, default = None, metavar = "FD", help = "read the master password from the next line of this open file descriptor (default: $" + PASSWORD_FD_ENVIRONMENT_VARIABLE + ", or prompt)")
+	parser.add_argument("--no-agent", action = "store_true", help = "open the database file even if tinfoil-agent is running")
+	subparsers = parser.add_subparsers(dest = "command", metavar = "command", required = True)
+
+	get_parser = subparsers.add_parser("get", help = "print the value stored under a key")
+	get_parser.add_argument("key")
+	get_parser.add_argument("-c", "--clip", action = "store_true", help = "copy the value to the clipboard instead")
+
+	set_parser = subparsers.add_parser("set", help = "store a value, read from the next line of standard input, under a new key")
+	set_parser.add_argument("key")
+	set_parser.add_argument("-g", "--generate", action = "store_true", help = "store a randomly generated password instead, and print it")
+	set_parser.add_argument("-l", "--length", type = int, default = DEFAULT_PASSWORD_LENGTH, help = "length of a generated password (default: " + str(DEFAULT_PASSWORD_LENGTH) + ")")
+	set_parser.add_argument("--no-digits", action = "store_true", help = "leave digits out of a generated password")
+	set_parser.add_argument("--no-special", action = "store_true", help = "leave special characters out of a generated password")
+	set_parser.add_argument("--no-spaces", action = "store_true", help = "leave spaces out of a generated password")
+	set_parser.add_argument("-c", "--clip", action = "store_true", help = "copy a generated password to the clipboard instead of printing it")
+
+	del_parser = subparsers.add_parser("del", help = "delete the record stored under a key")
+	del_parser.add_argument("key")
+
+	subparsers.add_parser("ls", help = "list every key")
+
+	find_parser = subparsers.add_parser("find", help = "list the keys that have a word starting with the given text, ignoring case")
+	find_parser.add_argument("prefix")
+
+	import_parser = subparsers.add_parser("import", help = "add the entries of a CSV, JSON or encrypted tinfoil export file; existing keys are kept")
+	import_parser.add_argument("file")
+	import_parser.add_argument("--passphrase-fd", type = int, default = None, metavar = "FD", help = "read an encrypted export's passphrase from the next line of this open file descriptor (default: prompt)")
+
+	export_parser = subparsers.add_parser("export", help = "write every record to a new file, encrypted under a separate passphrase")
+	export_parser.add_argument("file")
+	export_parser.add_argument("--plaintext", action = "store_true", help = "write the file unencrypted")
+	export_parser.add_argument("--json", action = "store_true", help = "write JSON Lines instead of CSV")
+	export_parser.add_argument("--passphrase-fd", type = int, default = None, metavar = "FD", help = "read the passphrase from the next line of this open file descriptor (default: prompt twice)")
+
+	verify_parser = subparsers.add_parser("verify", help = "authenticate every record and stream, listing any that fail; exits with status 1 if one does")
+	verify_parser.add_argument("--decrypt", action = "store_true", help = "also decrypt each record and check its contents")
+	verify_parser.add_argument("-w", "--workers", type = int, default = None, help = "checking processes (default: one per core)")
+
+	parsed = parser.parse_args(arguments)
+	if (parsed.password_fd is None) and os.environ.get(PASSWORD_FD_ENVIRONMENT_VARIABLE):
+		try:
+			parsed.password_fd = int(os.environ[PASSWORD_FD_ENVIRONMENT_VARIABLE])
+		except ValueError:
+			parser.error(PASSWORD_FD_ENVIRONMENT_VARIABLE + " must be a file descriptor number")
+	return parsed
+
+def run_command(arguments):
+	"""Run one command given on the command line, without the console, and return the exit status"""
+	statslib = None
+	if os.environ.get(STATS_ENVIRONMENT_VARIABLE) == "1":
+		from . import statslib
+		statslib.enable()
+
+	database = None
+	try:
+		database = _open_command_database(arguments)
+		COMMANDS[arguments.command](database, arguments)
+	except AssertionError as exception:
+		print("error: " + str(exception), file = sys.stderr)
+		return 1
+	except KeyboardInterrupt:
+		print(file = sys.stderr)
+		return 130
+	finally:
+		if database is not None:
+			database.close()
+		if statslib is not None:
+			for table_line in statslib.format_table(statslib.snapshot()):
+				print(table_line, file = sys.stderr)
+	return 0
+
 def main():
+	global database
+
+	if len(sys.argv) > 1:
+		sys.exit(run_command(parse_arguments()))
+
+	if os.environ.get(STATS_ENVIRONMENT_VARIABLE) == "1":
+		from . import statslib
+		statslib.enable()
+
+	from . import agent
+	database = agent.connect_agent()
+	if database is not None:
+		print("using unlocked database from tinfoil-agent at '" + database.socket_path + "'")
+		print()
+		DatabaseConsole().cmdloop()
+		return
+
+	from . import speedtest
+	from .tinfoillib import TinfoilDB
 	database_prompt = "database location [def: " + DEFAULT_DATABASE + "]: "
 	database_file = inputlib.ask_string(database_prompt, default = DEFAULT_DATABASE)
 
-	global database
-	database = TinfoilDB(database_file)
+	engine = None # existing databases are opened with the engine that created them
+	if not os.path.exists(database_file):
+		engine = ask_storage_engine()
+
+	try:
+		cache_size = int(os.environ.get(CACHE_ENVIRONMENT_VARIABLE) or 0)
+	except ValueError:
+		print("error: " + CACHE_ENVIRONMENT_VARIABLE + " must be a number of entries!")
+		sys.exit(1)
+
+	database = TinfoilDB(database_file, engine = engine, cache_size = cache_size)
 
 	if not database.check_database_initialized():
-		scrypt_n, scrypt_r, scrypt_p, password = ask_database_parameters()
+		scrypt_n, scrypt_r, scrypt_p, password = ask_database_parameters(calibration = speedtest.load_calibration())
 
 		print("setting up database...")
 		database.initialize_database(password = password, scrypt_n = (2 ** scrypt_n), scrypt_r = scrypt_r, scrypt_p = scrypt_p, aes_key_size = AES_KEY_SIZE, hmac_key_size = HMAC_KEY_SIZE)
@@ -1,10 +1,16 @@
 import os
-import sqlite3
+import re
+import time
+import struct
 import binascii
+import functools
+import threading
+import unicodedata
 
-from . import cryptolib
+from . import cachelib, cryptolib, storagelib
 
-DATABASE_VERSION = 1
+DATABASE_VERSION = 5
+SUPPORTED_DATABASE_VERSIONS = (1, 2, 3, 4, 5)
 
 DEFAULT_SCRYPT_N = 2 ** 18
 DEFAULT_SCRYPT_R = 8
@@ -18,167 +24,878 @@ OPCODE = "jX40TyIOkUMMGYLePilPb8BwxSwkYiJ".encode("utf-8")
 
 SCRYPT_SALT_SIZE = 16
 
+DEFAULT_AEAD_ALGORITHM = cryptolib.AEAD_AES_GCM
+
+# version 1 records are AES-CBC encrypted then HMAC-SHA512 signed; version 2 records are sealed in one pass by an AEAD,
+# with the nonce in 'iv', the authentication tag in 'hmac_signature', and the hashed key bound as associated data
+# version 3 records are sealed as in version 2, but under a random data key that is stored wrapped by the scrypt-derived key,
+# so changing the master password or scrypt parameters only re-wraps that key
+# version 4 records are sealed as in version 3, with the key name stored ahead of the value inside the plaintext, so records can be listed and exported
+# version 5 records are sealed as in version 4, but stored under a 16-byte keyed hash of the key's SHA-512 digest instead of the digest itself,
+# so lookup keys take a quarter of the space, and key names can not be confirmed by hashing guesses without the data key
+PARAMETER_FIELDS = {
+	1: ("version", "scrypt_n", "scrypt_r", "scrypt_p", "scrypt_salt", "aes_key_size", "hmac_key_size", "opcode_plaintext", "opcode_iv", "opcode_encrypted", "opcode_hmac"),
+	2: ("version", "scrypt_n", "scrypt_r", "scrypt_p", "scrypt_salt", "aes_key_size", "hmac_key_size", "opcode_plaintext", "opcode_iv", "opcode_encrypted", "opcode_hmac", "aead_algorithm"),
+	3: ("version", "scrypt_n", "scrypt_r", "scrypt_p", "scrypt_salt", "aes_key_size", "aead_algorithm", "wrapped_key_nonce", "wrapped_key", "wrapped_key_tag"),
+	4: ("version", "scrypt_n", "scrypt_r", "scrypt_p", "scrypt_salt", "aes_key_size", "aead_algorithm", "wrapped_key_nonce", "wrapped_key", "wrapped_key_tag"),
+	5: ("version", "scrypt_n", "scrypt_r", "scrypt_p", "scrypt_salt", "aes_key_size", "aead_algorithm", "wrapped_key_nonce", "wrapped_key", "wrapped_key_tag"),
+}
+
+RECORD_NAME_HEADER = struct.Struct(">H") # length of the key name at the start of a version 4 record; 0 if the name is unknown
+
+DATA_KEY_DOMAIN = b"tinfoil-data-key" # associated data for the wrapped data key
+
+LOOKUP_DOMAIN = b"tinfoil-lookup" # derives the version 5 lookup key
+LOOKUP_KEY_SIZE = 256 // 8 # 256 bits = 32 bytes
+LOOKUP_HASH_SIZE = 128 // 8 # 128 bits; a collision is not expected before about 2 ** 64 keys
+
+DEFAULT_STREAM_CHUNK_SIZE = 64 * 1024 # 64 KiB of plaintext per tinfoil_streams row
+
+# each stream chunk authenticates its key, position, and whether it is the last chunk, so truncation, reordering and splicing are detected
+STREAM_DOMAIN = b"tinfoil-stream"
+STREAM_CHUNK_HEADER = struct.Struct(">QB") # chunk index, final flag
+
+# the key index seals each key name under the record key, and maps blind tokens to hashed keys so names can be searched without decrypting them all
+# each token is a keyed hash of one prefix of one word of the normalized name, under a key derived from the record key
+# equal tokens reveal that names share a prefix, but not what the prefix is
+INDEX_DOMAIN = b"tinfoil-index" # derives the blind index key
+NAME_DOMAIN = b"tinfoil-name" # associated data for sealed key names, along with the hashed key
+INDEX_KEY_SIZE = 256 // 8 # 256 bits = 32 bytes
+INDEX_TOKEN_SIZE = storagelib.TOKEN_SIZE # 64 bits; a collision only adds a name that is filtered out once decrypted
+INDEX_PREFIX_LENGTHS = (2, 3, 4, 5, 6, 7, 8, 12, 16) # queries are looked up by their longest indexed prefix, then filtered once the matches are decrypted
+INDEX_WORD = re.compile(r"[^\W_]+")
+
+def make_record_crypter(version, aes_key, hmac_key, aead_algorithm = None):
+	"""Build the reusable record crypter for the given database version"""
+	if version == 1:
+		return cryptolib.RecordCrypter(aes_key, hmac_key)
+	return cryptolib.AEADRecordCrypter(aes_key, aead_algorithm)
+
+def record_associated_data(version, hashed_key):
+	"""Return the associated data a record of the given database version is sealed with"""
+	if version == 1:
+		return None # version 1 records only authenticate the IV and ciphertext
+	return hashed_key
+
+def encode_record_plaintext(version, name, value):
+	"""Build the plaintext of a record from its key name (or None, if unknown) and its value, both bytes"""
+	if version < 4:
+		return value
+	if name is None:
+		name = b""
+	return RECORD_NAME_HEADER.pack(len(name)) + name + value
+
+def decode_record_plaintext(version, plaintext):
+	"""Split the plaintext of a record into (key name or None, value)"""
+	if version < 4:
+		return None, plaintext
+	name_length = RECORD_NAME_HEADER.unpack_from(plaintext)[0]
+	value_start = RECORD_NAME_HEADER.size + name_length
+	return (plaintext[RECORD_NAME_HEADER.size:value_start] or None), plaintext[value_start:]
+
+def derive_lookup_key(version, aes_key):
+	"""Return the key that version 5 hashed keys are derived with, or None for older versions"""
+	if version < 5:
+		return None
+	return cryptolib.do_hmac(aes_key, LOOKUP_DOMAIN)[:LOOKUP_KEY_SIZE]
+
+def lookup_hash(lookup_key, digest):
+	"""Shorten the SHA-512 digest of a key name into the hashed key a version 5 record is stored under"""
+	return cryptolib.do_keyed_hash(lookup_key, digest, LOOKUP_HASH_SIZE)
+
+def hash_key(lookup_key, key):
+	"""Return the hashed key a record is stored under: the SHA-512 digest of the key name, shortened by lookup_hash() if lookup_key is set"""
+	digest = cryptolib.do_sha512_hash(data = key)
+	if lookup_key is None:
+		return digest
+	return lookup_hash(lookup_key, digest)
+
+def derive_index_key(aes_key):
+	return cryptolib.do_hmac(aes_key, INDEX_DOMAIN)[:INDEX_KEY_SIZE]
+
+def normalize_name(name):
+	"""Fold case, compatibility forms and accents, so that 'École' matches 'ecole'"""
+	decomposed = unicodedata.normalize("NFKD", name.casefold())
+	return "".join(character for character in decomposed if not unicodedata.combining(character))
+
+def _strip_query(query):
+	"""Normalize a search query and drop anything before its first word"""
+	query = normalize_name(query)
+	first_word = INDEX_WORD.search(query)
+	return query[first_word.start():] if first_word is not None else query
+
+def index_tokens(index_key, name):
+	"""Return the blind tokens for the prefixes of every word in a key name, at each of INDEX_PREFIX_LENGTHS that fits in the word"""
+	prefixes = set()
+	for word in INDEX_WORD.findall(normalize_name(name)):
+		for length in INDEX_PREFIX_LENGTHS:
+			if length > len(word):
+				break
+			prefixes.add(word[:length])
+	return [cryptolib.do_keyed_hash(index_key, prefix.encode("utf-8"), INDEX_TOKEN_SIZE) for prefix in prefixes]
+
+def query_tokens(index_key, query):
+	"""Return the blind tokens every name matching a search query must have: one for the longest indexed prefix of each word of the query
+
+Words shorter than any indexed prefix add no token, so a query made only of them returns none"""
+	tokens = []
+	for word in INDEX_WORD.findall(_strip_query(query)):
+		lengths = [length for length in INDEX_PREFIX_LENGTHS if length <= len(word)]
+		if lengths:
+			tokens.append(cryptolib.do_keyed_hash(index_key, word[:lengths[-1]].encode("utf-8"), INDEX_TOKEN_SIZE))
+	return tokens
+
+def name_matches(name, query):
+	"""Whether a key name has a word that starts with the query, ignoring case"""
+	name = normalize_name(name)
+	query = _strip_query(query)
+	if not INDEX_WORD.match(query):
+		return name.startswith(query)
+	return any(name.startswith(query, word.start()) for word in INDEX_WORD.finditer(name))
+
+def make_index_row(crypter, index_key, hashed_key, name):
+	"""Build the key index row for a record: (hashed_key, encrypted_name, iv, hmac_signature, tokens)"""
+	iv, encrypted_name, hmac_signature = crypter.seal(name.encode("utf-8"), associated_data = (NAME_DOMAIN + hashed_key))
+	return (hashed_key, encrypted_name, iv, hmac_signature, index_tokens(index_key, name))
+
+def stream_chunk_associated_data(hashed_key, chunk_index, final):
+	return STREAM_DOMAIN + hashed_key + STREAM_CHUNK_HEADER.pack(chunk_index, final)
+
+def verify_record(version, crypter, lookup_key, hashed_key, encrypted_value, iv, hmac_signature, decrypt = False):
+	"""Return whether a record authenticates under its hashed key
+
+If decrypt is set, the record is also decrypted, and its padding and UTF-8 key name and value are checked;
+a stored key name must hash (under lookup_key, for version 5) to the hashed key the record is stored under"""
+	associated_data = record_associated_data(version, hashed_key)
+	if not decrypt:
+		return crypter.verify(iv, encrypted_value, hmac_signature, associated_data = associated_data)
+
+	plaintext = crypter.open(iv, encrypted_value, hmac_signature, associated_data = associated_data) # version 1 padding is checked here
+	if plaintext is None:
+		return False
+	try:
+		if (version >= 4) and (len(plaintext) < (RECORD_NAME_HEADER.size + RECORD_NAME_HEADER.unpack_from(plaintext)[0])):
+			return False # the name is cut short
+		name, value = decode_record_plaintext(version, plaintext)
+		value.decode("utf-8")
+		if name is not None:
+			name.decode("utf-8")
+	except (struct.error, UnicodeDecodeError):
+		return False
+	return (name is None) or (hash_key(lookup_key, name) == bytes(hashed_key))
+
+_verifier = None # (version, record crypter, lookup key, decrypt) in each worker of verify_all(), set by _initialize_verifier
+
+def _initialize_verifier(record_keys, decrypt):
+	global _verifier
+	version, aes_key = record_keys[:2]
+	_verifier = (version, make_record_crypter(*record_keys), derive_lookup_key(version, aes_key), decrypt)
+
+def _verify_batch(rows):
+	"""Return how many scanned rows were checked, and the positions of those that fail verification"""
+	version, crypter, lookup_key, decrypt = _verifier
+	return len(rows), [position for position, hashed_key, encrypted_value, iv, hmac_signature in rows if not verify_record(version, crypter, lookup_key, hashed_key, encrypted_value, iv, hmac_signature, decrypt = decrypt)]
+
+class _KeyStateLock:
+	"""Held shared by operations that use the master keys, and exclusively while they are set or cleared
+
+A thread waiting to hold it exclusively holds up new shared holders, so a busy server cannot keep the keys from being cleared;
+shared holds must therefore not nest"""
+
+	def __init__(self):
+		self._condition = threading.Condition(threading.Lock())
+		self._shared = 0
+		self._exclusive = False
+		self._waiting = 0 # threads waiting to hold it exclusively
+
+	def acquire_shared(self):
+		with self._condition:
+			while self._exclusive or self._waiting:
+				self._condition.wait()
+			self._shared += 1
+
+	def release_shared(self):
+		with self._condition:
+			self._shared -= 1
+			if self._shared == 0:
+				self._condition.notify_all()
+
+	def acquire_exclusive(self):
+		with self._condition:
+			self._waiting += 1
+			while self._exclusive or self._shared:
+				self._condition.wait()
+			self._waiting -= 1
+			self._exclusive = True
+
+	def release_exclusive(self):
+		with self._condition:
+			self._exclusive = False
+			self._condition.notify_all()
+
+def _using_keys(method):
+	"""In thread-safe mode, keep the master keys from being set or cleared while the method runs"""
+	@functools.wraps(method)
+	def locked(self, *args, **kwargs):
+		if self._key_lock is None:
+			return method(self, *args, **kwargs)
+		self._key_lock.acquire_shared()
+		try:
+			return method(self, *args, **kwargs)
+		finally:
+			self._key_lock.release_shared()
+	return locked
+
+def _changing_keys(method):
+	"""In thread-safe mode, wait for every operation using the master keys to finish before the method changes them"""
+	@functools.wraps(method)
+	def locked(self, *args, **kwargs):
+		if self._key_lock is None:
+			return method(self, *args, **kwargs)
+		self._key_lock.acquire_exclusive()
+		try:
+			return method(self, *args, **kwargs)
+		finally:
+			self._key_lock.release_exclusive()
+	return locked
+
 class TinfoilDB:
-	def __init__(self, database_location):
-		self.database = sqlite3.connect(database_location)
+	def __init__(self, database_location, session = False, wal = False, engine = None, cache_size = 0, cache_ttl = cachelib.DEFAULT_CACHE_TTL, readers = 0, shards = None):
+		"""Open the database at the given location
+
+engine names a storagelib engine ("sqlite", "log" or "sharded") or is a storagelib.RecordStorage subclass; by default it is detected from the file, and new databases use SQLite
+In session mode, the schema check and database parameters are loaded once at open and cached for the life of the connection, and all SQLite queries run through a single reused cursor
+If wal is set, a SQLite database is switched to WAL journaling with synchronous=NORMAL
+If cache_size is set, up to that many decrypted values are kept for cache_ttl seconds (None for no limit), so retrieving them again skips the query and decryption;
+writes through this object keep the cache current, but writes by other connections may be missed until the entry expires
+If readers is set, the database is thread-safe: lookups run in parallel on that many read-only connections under WAL, writes are committed in groups by a
+single writer thread (see storagelib.PooledSQLiteStorage), and session mode is implied; only SQLite database files can be opened this way
+shards is the number of shard files of a new sharded database (see storagelib.ShardedSQLiteStorage)"""
+		if readers:
+			session = True
+		self.storage = storagelib.open_storage(database_location, engine, session = session, wal = wal, readers = readers, shards = shards)
+		self.database = self.storage.connection # None unless the storage engine is SQLite
 		self.master_aes_key = None
 		self.master_hmac_key = None
+		self.version = None # the record format in use, known once the master keys are set
+		self.aead_algorithm = None
+		self._crypter = None
+		self._index_key = None
+		self._lookup_key = None
+		self._cache = cachelib.RecordCache(cache_size, cache_ttl) if cache_size else None
+		self._key_lock = _KeyStateLock() if readers else None
+
+		self.session = session
+		self._initialized = False
+		self._parameters = None
+
+		if session:
+			self._initialized = self.storage.is_initialized()
+			if self._initialized:
+				self._parameters = self._query_database_parameters()
 
 	def check_database_initialized(self):
-		cursor = self.database.cursor()
+		if self._initialized: # only ever cached in session mode
+			return True
 
-		cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND (name = ? OR name = ?)", ("tinfoil_parameters", "tinfoil_entries"))
-		result = cursor.fetchone()[0]
+		initialized = self.storage.is_initialized()
+		if self.session:
+			self._initialized = initialized
+		return initialized
 
-		cursor.close()
-		return (result == 2)
+	def initialize_database(self, password, scrypt_n = DEFAULT_SCRYPT_N, scrypt_r = DEFAULT_SCRYPT_R, scrypt_p = DEFAULT_SCRYPT_P, aes_key_size = DEFAULT_AES_KEY_SIZE, hmac_key_size = DEFAULT_HMAC_KEY_SIZE, aead_algorithm = DEFAULT_AEAD_ALGORITHM, data_key = None):
+		"""Create a new database whose records are sealed under a random data key of aes_key_size bytes, or under data_key if given
 
-	def initialize_database(self, password, scrypt_n = DEFAULT_SCRYPT_N, scrypt_r = DEFAULT_SCRYPT_R, scrypt_p = DEFAULT_SCRYPT_P, aes_key_size = DEFAULT_AES_KEY_SIZE, hmac_key_size = DEFAULT_HMAC_KEY_SIZE):
+hmac_key_size is only used by version 1 databases, and is accepted for compatibility"""
 		if self.check_database_initialized():
 			raise AssertionError("database is already initialized!")
+		if aead_algorithm not in cryptolib.AEAD_ALGORITHMS:
+			raise AssertionError("unknown AEAD algorithm '" + str(aead_algorithm) + "'!")
 
-		scrypt_salt = cryptolib.get_random_bytes(length = SCRYPT_SALT_SIZE)
-		master_key = cryptolib.do_scrypt(password = password, salt = scrypt_salt, n = scrypt_n, r = scrypt_r, p = scrypt_p, key_length = (aes_key_size + hmac_key_size))
-		master_aes_key = master_key[:aes_key_size]
-		master_hmac_key = master_key[aes_key_size:]
+		if data_key is None:
+			data_key = cryptolib.get_random_bytes(length = aes_key_size)
+		elif len(data_key) != aes_key_size:
+			raise AssertionError("the data key must be " + str(aes_key_size) + " bytes long!")
 
-		opcode_iv, opcode_encrypted = cryptolib.aes_encrypt_bytes(data = OPCODE, key = master_aes_key)
-		opcode_hmac = cryptolib.do_hmac(hmac_key = master_hmac_key, aes_encrypted_data = (opcode_iv + opcode_encrypted))
+		parameters = {"version": DATABASE_VERSION, "aes_key_size": aes_key_size, "aead_algorithm": aead_algorithm}
+		parameters.update(self._wrap_data_key(password, data_key, scrypt_n, scrypt_r, scrypt_p, aes_key_size, aead_algorithm))
+		self.storage.create({field: parameters[field] for field in PARAMETER_FIELDS[DATABASE_VERSION]})
 
-		cursor = self.database.cursor()
+		if self.session:
+			self._initialized = True
+			self._parameters = self._query_database_parameters()
 
-		tables = [
-		"CREATE TABLE IF NOT EXISTS tinfoil_parameters(version INTEGER NOT NULL, scrypt_n INTEGER NOT NULL, scrypt_r INTEGER NOT NULL, scrypt_p INTEGER NOT NULL, scrypt_salt TEXT NOT NULL, aes_key_size INTEGER NOT NULL, hmac_key_size INTEGER NOT NULL, opcode_plaintext TEXT NOT NULL, opcode_iv TEXT NOT NULL, opcode_encrypted TEXT NOT NULL, opcode_hmac TEXT NOT NULL)",
-		"CREATE TABLE IF NOT EXISTS tinfoil_entries(hashed_key TEXT UNIQUE NOT NULL, encrypted_value TEXT NOT NULL, iv TEXT NOT NULL, hmac_signature TEXT NOT NULL)"
-		]
+	def _wrap_data_key(self, password, data_key, scrypt_n, scrypt_r, scrypt_p, key_size, aead_algorithm):
+		"""Derive a fresh key-encryption key from the password and wrap the data key with it, returning the parameters to store"""
+		scrypt_salt = cryptolib.get_random_bytes(length = SCRYPT_SALT_SIZE)
+		wrapping_key = cryptolib.do_scrypt_parallel(password = password, salt = scrypt_salt, n = scrypt_n, r = scrypt_r, p = scrypt_p, key_length = key_size)
 
-		for table in tables:
-				cursor.execute(table)
+		wrapped_key_nonce, wrapped_key, wrapped_key_tag = cryptolib.aead_encrypt_bytes(data = data_key, key = wrapping_key, algorithm = aead_algorithm, associated_data = DATA_KEY_DOMAIN)
+		return {"scrypt_n": scrypt_n, "scrypt_r": scrypt_r, "scrypt_p": scrypt_p, "scrypt_salt": scrypt_salt, "wrapped_key_nonce": wrapped_key_nonce, "wrapped_key": wrapped_key, "wrapped_key_tag": wrapped_key_tag}
 
-		cursor.execute("INSERT INTO tinfoil_parameters VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (DATABASE_VERSION, scrypt_n, scrypt_r, scrypt_p, scrypt_salt, aes_key_size, hmac_key_size, OPCODE, opcode_iv, opcode_encrypted, opcode_hmac))
+	def _unwrap_data_key(self, parameters, master_key):
+		"""Return the data key of a version 3 database, or None if master_key was derived from the wrong password"""
+		return cryptolib.aead_decrypt_bytes(data = parameters["wrapped_key"], nonce = parameters["wrapped_key_nonce"], tag = parameters["wrapped_key_tag"], key = master_key, algorithm = parameters["aead_algorithm"], associated_data = DATA_KEY_DOMAIN)
 
-		cursor.close()
-		self.database.commit()
+	def _query_database_parameters(self):
+		parameters = self.storage.load_parameters()
 
-	def _load_database_parameters(self):
-		cursor = self.database.cursor()
+		version = parameters["version"]
+		if version not in SUPPORTED_DATABASE_VERSIONS:
+			raise AssertionError("database version mismatch! expected one of " + str(SUPPORTED_DATABASE_VERSIONS) + ", got '" + str(version) + "'")
 
-		cursor.execute("SELECT version, scrypt_n, scrypt_r, scrypt_p, scrypt_salt, aes_key_size, hmac_key_size, opcode_plaintext, opcode_iv, opcode_encrypted, opcode_hmac FROM tinfoil_parameters")
+		return {field: parameters[field] for field in PARAMETER_FIELDS[version]}
 
-		results = cursor.fetchall()
-		if len(results) != 1:
-			raise AssertionError("there must only be 1 row in the tinfoil_parameters table! (found: " + str(len(results)) + ")")
+	def _load_database_parameters(self):
+		if self._parameters is not None:
+			return self._parameters
 
-		cursor.close()
-		return results[0]
+		parameters = self._query_database_parameters()
+		if self.session:
+			self._parameters = parameters
+		return parameters
 
 	def check_master_keys_set(self):
 		return (self.master_aes_key != None) and (self.master_hmac_key != None)
 
+	@_using_keys
+	def get_record_keys(self):
+		"""Return (version, aes_key, hmac_key, aead_algorithm), enough to build this database's record crypter elsewhere, such as in a worker process"""
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+		return (self.version, self.master_aes_key, self.master_hmac_key, self.aead_algorithm)
+
+	@_using_keys
+	def get_index_key(self):
+		"""Return the key blind index tokens are derived with, for building index rows elsewhere, such as in a worker process"""
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+		return self._index_key
+
+	@_using_keys
+	def get_lookup_key(self):
+		"""Return the key hashed keys are derived with (None before version 5), for hashing keys elsewhere, such as in a worker process"""
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+		return self._lookup_key
+
+	def get_kdf_parameters(self):
+		"""Return the keyword arguments (besides the password) for deriving this database's master key with cryptolib.do_scrypt"""
+		parameters = self._load_database_parameters()
+		if parameters["version"] >= 3:
+			key_length = parameters["aes_key_size"] # the key-encryption key
+		else:
+			key_length = parameters["aes_key_size"] + parameters["hmac_key_size"]
+		return {"salt": parameters["scrypt_salt"], "n": parameters["scrypt_n"], "r": parameters["scrypt_r"], "p": parameters["scrypt_p"], "key_length": key_length}
+
 	def set_master_keys(self, password):
 		if self.check_master_keys_set():
 			raise AssertionError("master keys are already set!")
 
-		version, scrypt_n, scrypt_r, scrypt_p, scrypt_salt, aes_key_size, hmac_key_size, opcode_plaintext, opcode_iv, opcode_encrypted, opcode_hmac = self._load_database_parameters()
+		master_key = cryptolib.do_scrypt_parallel(password = password, **self.get_kdf_parameters())
+		return self.set_derived_master_key(master_key)
 
-		if version != DATABASE_VERSION:
-			raise AssertionError("database version mismatch! expected '" + str(DATABASE_VERSION) + "', got '" + str(version) + "'")
+	@_changing_keys
+	def set_derived_master_key(self, master_key):
+		"""Unlock the database with a master key that was derived separately (see get_kdf_parameters)"""
+		if self.check_master_keys_set():
+			raise AssertionError("master keys are already set!")
 
-		master_key = cryptolib.do_scrypt(password = password, salt = scrypt_salt, n = scrypt_n, r = scrypt_r, p = scrypt_p, key_length = (aes_key_size + hmac_key_size))
-		master_aes_key = master_key[:aes_key_size]
-		master_hmac_key = master_key[aes_key_size:]
+		parameters = self._load_database_parameters()
+		version = parameters["version"]
+		aead_algorithm = parameters.get("aead_algorithm")
 
-		hmac_valid = cryptolib.verify_hmac(hmac_key = master_hmac_key, aes_encrypted_data = (opcode_iv + opcode_encrypted), signature = opcode_hmac)
-		if not hmac_valid:
-			return False
+		if version >= 3:
+			master_aes_key = self._unwrap_data_key(parameters, master_key)
+			master_hmac_key = b"" # AEAD records need no separate signing key
+			success = (master_aes_key is not None)
+		else:
+			master_aes_key = master_key[:parameters["aes_key_size"]]
+			master_hmac_key = master_key[parameters["aes_key_size"]:]
+
+			if version == 1:
+				hmac_valid = cryptolib.verify_hmac(hmac_key = master_hmac_key, aes_encrypted_data = (parameters["opcode_iv"] + parameters["opcode_encrypted"]), signature = parameters["opcode_hmac"])
+				if not hmac_valid:
+					return False
+
+				decrypted_opcode = cryptolib.aes_decrypt_bytes(data = parameters["opcode_encrypted"], iv = parameters["opcode_iv"], key = master_aes_key) # todo: catch exception
+			else:
+				decrypted_opcode = cryptolib.aead_decrypt_bytes(data = parameters["opcode_encrypted"], nonce = parameters["opcode_iv"], tag = parameters["opcode_hmac"], key = master_aes_key, algorithm = aead_algorithm)
 
-		decrypted_opcode = cryptolib.aes_decrypt_bytes(data = opcode_encrypted, iv = opcode_iv, key = master_aes_key) # todo: catch exception
-		success = (decrypted_opcode == opcode_plaintext)
+			success = (decrypted_opcode == parameters["opcode_plaintext"])
 
 		if success:
 			self.master_aes_key = master_aes_key
 			self.master_hmac_key = master_hmac_key
+			self.version = version
+			self.aead_algorithm = aead_algorithm
+			self._crypter = make_record_crypter(version, master_aes_key, master_hmac_key, aead_algorithm)
+			self._index_key = derive_index_key(master_aes_key)
+			self._lookup_key = derive_lookup_key(version, master_aes_key)
 			return True
 		else:
 			return False
 
+	def _rewrap_data_key(self, password, new_password, scrypt_n, scrypt_r, scrypt_p):
+		parameters = self._load_database_parameters()
+		if parameters["version"] < 3:
+			raise AssertionError("database version " + str(parameters["version"]) + " has no data key to re-wrap; upgrade it with 'tinfoil-migrate' first!")
+
+		master_key = cryptolib.do_scrypt_parallel(password = password, **self.get_kdf_parameters())
+		data_key = self._unwrap_data_key(parameters, master_key)
+		if data_key is None:
+			return False
+
+		self.storage.update_parameters(self._wrap_data_key(new_password, data_key, scrypt_n, scrypt_r, scrypt_p, parameters["aes_key_size"], parameters["aead_algorithm"]))
+		self._parameters = self._query_database_parameters() if self.session else None
+		return True
+
+	def change_master_password(self, password, new_password):
+		"""Re-wrap the data key under a new master password, keeping the scrypt parameters; no record is touched
+
+Returns False if the current password is incorrect
+Anyone holding both an old copy of the database and its old password can still recover the data key"""
+		parameters = self._load_database_parameters()
+		return self._rewrap_data_key(password, new_password, parameters["scrypt_n"], parameters["scrypt_r"], parameters["scrypt_p"])
+
+	def reparameterize(self, password, scrypt_n, scrypt_r, scrypt_p):
+		"""Re-wrap the data key with new scrypt parameters under the same master password; no record is touched
+
+Returns False if the password is incorrect"""
+		return self._rewrap_data_key(password, password, scrypt_n, scrypt_r, scrypt_p)
+
+	@_changing_keys
+	def clear_master_keys(self):
+		"""Forget the master keys and any state derived from them, locking the database again"""
+		self.master_aes_key = None
+		self.master_hmac_key = None
+		self._crypter = None
+		self._index_key = None
+		self._lookup_key = None
+		if self._cache is not None:
+			self._cache.clear()
+
+	def cache_stats(self):
+		"""Return the record cache's hit, miss, eviction and expiration counters and its size (see cachelib.RecordCache.stats), or None if caching is off"""
+		if self._cache is None:
+			return None
+		return self._cache.stats()
+
+	def _hash_key(self, key):
+		if (self._lookup_key is None) and ((self.version or self._load_database_parameters()["version"]) >= 5):
+			raise AssertionError("master keys not yet set!") # version 5 keys are hashed under a key derived from the data key
+		return hash_key(self._lookup_key, key)
+
+	def _seal_record(self, hashed_key, plaintext):
+		"""Encrypt and authenticate a record value in this database's format, returning (encrypted_value, iv, hmac_signature)"""
+		iv, encrypted_value, hmac_signature = self._crypter.seal(plaintext, associated_data = self._record_associated_data(hashed_key))
+		return encrypted_value, iv, hmac_signature
+
+	def _open_record(self, key, hashed_key, encrypted_value, iv, hmac_signature):
+		"""Authenticate and decrypt a record sealed by _seal_record, raising AssertionError if it has been tampered with"""
+		decrypted_value = self._crypter.open(iv, encrypted_value, hmac_signature, associated_data = self._record_associated_data(hashed_key))
+		if decrypted_value is None:
+			raise AssertionError("authentication failed for record with key '" + key + "'!")
+		return decrypted_value
+
+	def _record_associated_data(self, hashed_key):
+		return record_associated_data(self.version, hashed_key)
+
+	def _invalidate_cached(self, hashed_keys):
+		if self._cache is not None:
+			for hashed_key in hashed_keys:
+				self._cache.invalidate(hashed_key)
+
+	@_using_keys
 	def store_record(self, key, value):
 		if not self.check_database_initialized():
 			raise AssertionError("database not yet initialized!")
 		if not self.check_master_keys_set():
 			raise AssertionError("master keys not yet set!")
 
-		cursor = self.database.cursor()
-
-		hashed_key = cryptolib.do_sha512_hash(data = key)
-		iv, encrypted_value = cryptolib.aes_encrypt_bytes(data = value.encode("utf-8"), key = self.master_aes_key)
-		hmac_signature = cryptolib.do_hmac(hmac_key = self.master_hmac_key, aes_encrypted_data = (iv + encrypted_value))
+		hashed_key = self._hash_key(key)
+		encrypted_value, iv, hmac_signature = self._seal_record(hashed_key, encode_record_plaintext(self.version, key.encode("utf-8"), value.encode("utf-8")))
+		if self._cache is not None:
+			self._cache.invalidate(hashed_key)
 
-		try:
-			cursor.execute("INSERT INTO tinfoil_entries VALUES(?, ?, ?, ?)", (hashed_key, encrypted_value, iv, hmac_signature))
-		except sqlite3.IntegrityError:
-			return False
-		finally:
-			cursor.close()
+		if not self.storage.supports_index:
+			return self.storage.insert(hashed_key, encrypted_value, iv, hmac_signature)
 
-		self.database.commit()
+		with self.storage.transaction(): # the record and its index row are committed together
+			if self.storage.find_existing([hashed_key]):
+				return False
+			self.storage.insert_many([(hashed_key, encrypted_value, iv, hmac_signature)])
+			self.storage.insert_names([make_index_row(self._crypter, self._index_key, hashed_key, key)])
 		return True
 
+	@_using_keys
 	def check_record(self, key):
 		if not self.check_database_initialized():
 			raise AssertionError("database not yet initialized!")
 
-		cursor = self.database.cursor()
-
-		hashed_key = cryptolib.do_sha512_hash(data = key)
-		cursor.execute("SELECT count(*) FROM tinfoil_entries WHERE hashed_key = ?", (hashed_key, ))
-		result = cursor.fetchone()[0]
-
-		cursor.close() # TODO: convert all cursors to 'with' blocks
-
-		if result > 0:
-			return True
-		else:
-			return False
+		hashed_key = self._hash_key(key)
+		return self.storage.contains(hashed_key)
 
+	@_using_keys
 	def retrieve_record(self, key):
 		if not self.check_database_initialized():
 			raise AssertionError("database not yet initialized!")
 		if not self.check_master_keys_set():
 			raise AssertionError("master keys not yet set!")
 
-		cursor = self.database.cursor()
+		hashed_key = self._hash_key(key)
+		if self._cache is not None:
+			cached_value = self._cache.get(hashed_key)
+			if cached_value is not None:
+				return cached_value
 
-		hashed_key = cryptolib.do_sha512_hash(data = key)
-		cursor.execute("SELECT encrypted_value, iv, hmac_signature FROM tinfoil_entries WHERE hashed_key = ?", (hashed_key, ))
-		result = cursor.fetchone()
+		result = self.storage.get(hashed_key)
 
 		if result == None:
 			return None
 
 		encrypted_value, iv, hmac_signature = result # unpack the values
 
-		hmac_valid = cryptolib.verify_hmac(hmac_key = self.master_hmac_key, aes_encrypted_data = (iv + encrypted_value), signature = hmac_signature)
-		if not hmac_valid:
-			raise AssertionError("HMAC authentication failed for record with key '" + key + "'!")
-
-		decrypted_value = cryptolib.aes_decrypt_bytes(data = encrypted_value, iv = iv, key = self.master_aes_key)
-		decoded_value = decrypted_value.decode("utf-8")
+		decrypted_value = self._open_record(key, hashed_key, encrypted_value, iv, hmac_signature)
+		value = decode_record_plaintext(self.version, decrypted_value)[1]
+		if self._cache is not None:
+			self._cache.put(hashed_key, value)
+		decoded_value = value.decode("utf-8")
 
-		cursor.close()
 		return decoded_value
 
+	@_using_keys
 	def delete_record(self, key):
 		if not self.check_database_initialized():
 			raise AssertionError("database not yet initialized!")
 
-		cursor = self.database.cursor()
+		hashed_key = self._hash_key(key)
+		if self._cache is not None:
+			self._cache.invalidate(hashed_key)
+		self.storage.delete(hashed_key)
+
+	@_using_keys
+	def store_records(self, mapping):
+		"""Store many key/value pairs in a single transaction
+
+Returns a dict mapping each key to True if it was stored, or False if a record already existed for it"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+
+		hashed_keys = {key: self._hash_key(key) for key in mapping}
+		self._invalidate_cached(hashed_keys.values())
+
+		with self.storage.transaction():
+			existing = self.storage.find_existing(list(hashed_keys.values()))
+
+			results = {}
+			rows = []
+			index_rows = []
+			for key, value in mapping.items():
+				hashed_key = hashed_keys[key]
+				if hashed_key in existing:
+					results[key] = False
+					continue
+
+				encrypted_value, iv, hmac_signature = self._seal_record(hashed_key, encode_record_plaintext(self.version, key.encode("utf-8"), value.encode("utf-8")))
+				rows.append((hashed_key, encrypted_value, iv, hmac_signature))
+				if self.storage.supports_index:
+					index_rows.append(make_index_row(self._crypter, self._index_key, hashed_key, key))
+				results[key] = True
+
+			self.storage.insert_many(rows)
+			if index_rows:
+				self.storage.insert_names(index_rows)
+
+		return results
+
+	@_using_keys
+	def retrieve_records(self, keys):
+		"""Retrieve many records at once
+
+Returns a dict mapping each key to its decrypted value, or None if no record exists for it"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+
+		hashed_keys = {key: self._hash_key(key) for key in keys}
+
+		results = {}
+		if self._cache is not None:
+			for key, hashed_key in hashed_keys.items():
+				cached_value = self._cache.get(hashed_key)
+				if cached_value is not None:
+					results[key] = cached_value
+
+		found = self.storage.get_many([hashed_key for key, hashed_key in hashed_keys.items() if key not in results])
+		for key, hashed_key in hashed_keys.items():
+			if key in results:
+				continue
+			if hashed_key not in found:
+				results[key] = None
+				continue
+
+			encrypted_value, iv, hmac_signature = found[hashed_key]
+
+			decrypted_value = self._open_record(key, hashed_key, encrypted_value, iv, hmac_signature)
+			value = decode_record_plaintext(self.version, decrypted_value)[1]
+			if self._cache is not None:
+				self._cache.put(hashed_key, value)
+			results[key] = value.decode("utf-8")
+
+		return results
+
+	@_using_keys
+	def check_records(self, keys):
+		"""Check for many records with a single query
+
+Returns a dict mapping each key to True if a record exists for it, or False if none does"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+
+		hashed_keys = {key: self._hash_key(key) for key in keys}
+		existing = self.storage.find_existing(list(hashed_keys.values()))
+		return {key: (hashed_key in existing) for key, hashed_key in hashed_keys.items()}
+
+	@_using_keys
+	def delete_records(self, keys):
+		"""Delete many records in a single transaction
+
+Returns a dict mapping each key to True if a record was deleted, or False if none existed"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+
+		hashed_keys = {key: self._hash_key(key) for key in keys}
+		self._invalidate_cached(hashed_keys.values())
+
+		with self.storage.transaction():
+			existing = self.storage.find_existing(list(hashed_keys.values()))
+			self.storage.delete_many(existing)
+
+		return {key: (hashed_key in existing) for key, hashed_key in hashed_keys.items()}
+
+	def _check_index_supported(self):
+		if not self.storage.supports_index:
+			raise AssertionError("listing and searching keys is not supported by this database's storage engine!")
+
+	def _open_names(self, rows):
+		names = []
+		for hashed_key, encrypted_name, iv, hmac_signature in rows:
+			name = self._crypter.open(iv, encrypted_name, hmac_signature, associated_data = (NAME_DOMAIN + hashed_key))
+			if name is None:
+				raise AssertionError("authentication failed for an indexed key name!")
+			names.append(name.decode("utf-8"))
+		return names
+
+	@_using_keys
+	def list_keys(self):
+		"""Return the key of every record in the key index, sorted
+
+Records stored before the index existed are only listed once rebuild_index() has run"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+		self._check_index_supported()
+
+		return sorted(self._open_names(self.storage.names()), key = normalize_name)
+
+	@_using_keys
+	def find_keys(self, query):
+		"""Return the keys in the key index that have a word starting with the query, ignoring case, sorted
+
+Only the names that have every blind token of the query are decrypted"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+		self._check_index_supported()
+
+		tokens = query_tokens(self._index_key, query)
+		rows = self.storage.find_names(tokens) if tokens else self.storage.names()
+		return sorted((name for name in self._open_names(rows) if name_matches(name, query)), key = normalize_name)
+
+	@_using_keys
+	def rebuild_index(self):
+		"""Rebuild the key index from the key names stored inside the records, returning how many records it holds
+
+Records of database versions before 4 do not store their names, so their index can not be rebuilt"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+		self._check_index_supported()
+		if self.version < 4:
+			raise AssertionError("records of database version " + str(self.version) + " do not store their keys; upgrade it with 'tinfoil-migrate' and store them again!")
+
+		count = 0
+		with self.storage.transaction():
+			self.storage.clear_index()
+			for rows in self.storage.scan():
+				index_rows = []
+				for position, hashed_key, encrypted_value, iv, hmac_signature in rows:
+					plaintext = self._crypter.open(iv, encrypted_value, hmac_signature, associated_data = self._record_associated_data(hashed_key))
+					if plaintext is None:
+						raise AssertionError("authentication failed for the record at position " + str(position) + "!")
+					name = decode_record_plaintext(self.version, plaintext)[0]
+					if name is not None:
+						index_rows.append(make_index_row(self._crypter, self._index_key, hashed_key, name.decode("utf-8")))
+				self.storage.insert_names(index_rows)
+				count += len(index_rows)
+		return count
+
+	@_using_keys
+	def verify_all(self, decrypt = False, workers = None, batch_size = storagelib.DEFAULT_SCAN_BATCH_SIZE, report = None):
+		"""Authenticate every record and stream in the database, returning a dict of what was checked and what failed
+
+Records are scanned batch_size at a time and checked on a pool of worker processes (see transferlib.run_pipeline), with only a few batches in memory at once
+corrupt_records lists the scan positions of the records that fail (rowids, hashed keys in the compact layout or offsets in a log), and corrupt_streams the hashed keys of the streams
+If decrypt is set, records are also decrypted and their contents checked (see verify_record); report is called with the number of records checked after each batch"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+		from . import transferlib # imported here, since transferlib imports this module
+
+		if report is None:
+			report = lambda records: None
+
+		start = time.perf_counter()
+		result = {"records": 0, "corrupt_records": [], "streams": 0, "corrupt_streams": []}
+		def consume(checked):
+			result["records"] += checked[0]
+			result["corrupt_records"].extend(checked[1])
+			report(result["records"])
+
+		transferlib.run_pipeline(self.storage.scan(batch_size = batch_size), _verify_batch, consume, workers = workers, initializer = _initialize_verifier, initargs = ((self.version, self.master_aes_key, self.master_hmac_key, self.aead_algorithm), decrypt)) # not get_record_keys(), as shared holds of the key lock must not nest
+
+		for hashed_key in (self.storage.stream_keys() if self.storage.supports_streams else []):
+			result["streams"] += 1
+			if not self._verify_stream(hashed_key):
+				result["corrupt_streams"].append(hashed_key)
+
+		result["seconds"] = time.perf_counter() - start
+		return result
+
+	def _verify_stream(self, hashed_key):
+		"""Return whether every chunk of a stream authenticates, with none missing, reordered or truncated"""
+		rows = list(self.storage.iterate_stream(hashed_key))
+		for position, (chunk_index, encrypted_chunk, iv, hmac_signature) in enumerate(rows):
+			associated_data = self._stream_chunk_associated_data(hashed_key, position, (position == (len(rows) - 1)))
+			if (chunk_index != position) or not self._crypter.verify(iv, encrypted_chunk, hmac_signature, associated_data = associated_data):
+				return False
+		return True
 
-		hashed_key = cryptolib.do_sha512_hash(key)
-		cursor.execute("DELETE FROM tinfoil_entries WHERE hashed_key = ?", (hashed_key, ))
+	def _stream_chunk_associated_data(self, hashed_key, chunk_index, final):
+		return stream_chunk_associated_data(hashed_key, chunk_index, final)
+
+	def _check_streams_supported(self):
+		if not self.storage.supports_streams:
+			raise AssertionError("streams are not supported by this database's storage engine!")
+
+	@_using_keys
+	def store_stream(self, key, fileobj, chunk_size = DEFAULT_STREAM_CHUNK_SIZE):
+		"""Encrypt everything read from a binary file object under the given key, one chunk at a time
+
+Peak memory is a couple of chunks regardless of the stream's length; all chunks are written in one transaction
+Returns False if a stream is already stored under this key"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+		self._check_streams_supported()
+
+		hashed_key = self._hash_key(key)
+
+		def seal_chunks():
+			chunk_index = 0
+			chunk = fileobj.read(chunk_size)
+			while True:
+				next_chunk = fileobj.read(chunk_size) # read one chunk ahead, so the last one can be flagged as final
+				final = not next_chunk
+
+				associated_data = self._stream_chunk_associated_data(hashed_key, chunk_index, final)
+				iv, encrypted_chunk, hmac_signature = self._crypter.seal(bytes(chunk), associated_data = associated_data)
+				yield (chunk_index, encrypted_chunk, iv, hmac_signature)
+
+				if final:
+					break
+				chunk = next_chunk
+				chunk_index += 1
+
+		return self.storage.insert_stream(hashed_key, seal_chunks())
+
+	@_using_keys
+	def retrieve_stream(self, key, fileobj):
+		"""Decrypt the stream stored under the given key into a binary file object, one chunk at a time
+
+Returns False if no stream is stored under this key
+Raises AssertionError if any chunk fails authentication or chunks are missing, reordered or truncated; output written before the failure must be discarded"""
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		if not self.check_master_keys_set():
+			raise AssertionError("master keys not yet set!")
+		self._check_streams_supported()
+		if not self.storage.has_streams():
+			return False
+
+		hashed_key = self._hash_key(key)
+
+		def open_chunk(position, row, final):
+			chunk_index, encrypted_chunk, iv, hmac_signature = row
+			if chunk_index != position:
+				raise AssertionError("stream for key '" + key + "' is missing chunk " + str(position) + "!")
+
+			associated_data = self._stream_chunk_associated_data(hashed_key, position, final)
+			chunk = self._crypter.open(iv, encrypted_chunk, hmac_signature, associated_data = associated_data)
+			if chunk is None:
+				raise AssertionError("authentication failed for chunk " + str(position) + " of stream with key '" + key + "'!")
+			return chunk
+
+		rows = self.storage.iterate_stream(hashed_key)
+		try:
+			previous = next(rows, None)
+			if previous is None:
+				return False
+
+			position = 0
+			for row in rows: # hold one row back, since only the last chunk is opened as final
+				fileobj.write(open_chunk(position, previous, False))
+				previous = row
+				position += 1
+
+			fileobj.write(open_chunk(position, previous, True))
+		finally:
+			rows.close()
+
+		return True
+
+	@_using_keys
+	def check_stream(self, key):
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		self._check_streams_supported()
+		if not self.storage.has_streams():
+			return False
+
+		hashed_key = self._hash_key(key)
+		return self.storage.contains_stream(hashed_key)
+
+	@_using_keys
+	def delete_stream(self, key):
+		if not self.check_database_initialized():
+			raise AssertionError("database not yet initialized!")
+		self._check_streams_supported()
+		if not self.storage.has_streams():
+			return
 
-		cursor.close()
-		self.database.commit()
+		hashed_key = self._hash_key(key)
+		self.storage.delete_stream(hashed_key)
 
 	def close(self):
-		self.database.close()
+		if self._cache is not None:
+			self._cache.clear()
+		self.storage.close()
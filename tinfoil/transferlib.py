@@ -0,0 +1,376 @@
+import io
+import os
+import csv
+import json
+import struct
+import itertools
+import collections
+import concurrent.futures
+
+from . import cryptolib, tinfoillib
+
+DEFAULT_BATCH_SIZE = 5000
+IN_FLIGHT_BATCHES_PER_WORKER = 2 # bounds memory to a few batches, however large the input is
+
+EXPORT_FORMATS = ("csv", "json") # json exports are JSON Lines, one {"key": ..., "value": ...} object per line
+
+# an encrypted export is a header followed by chunks sealed like tinfoil streams, under a key derived from a separate passphrase
+# each chunk authenticates the header, its position, and whether it is the last chunk, so truncation and reordering are detected
+EXPORT_MAGIC = b"TINFOIL-EXPORT\x00"
+EXPORT_FORMAT_VERSION = 1
+EXPORT_HEADER = struct.Struct(">15sBQII16s") # magic, format version, scrypt N, r, p, salt
+EXPORT_CHUNK_LENGTH = struct.Struct(">I") # ciphertext length; each chunk is this, then the nonce, ciphertext and tag
+EXPORT_CHUNK_POSITION = struct.Struct(">QB") # chunk index, final flag
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_KEY_SIZE = 32
+EXPORT_SALT_SIZE = 16
+
+def run_pipeline(batches, function, consume, workers = None, initializer = None, initargs = ()):
+	"""Apply function to each batch on a pool of worker processes, passing every result to consume in the order the batches came in
+
+Only a few batches are in flight at once; with a single worker, everything runs in this process"""
+	if workers is None:
+		workers = os.cpu_count() or 1
+
+	if workers < 2:
+		if initializer is not None:
+			initializer(*initargs)
+		for batch in batches:
+			consume(function(batch))
+		return
+
+	executor = concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = initializer, initargs = initargs)
+	try:
+		in_flight = collections.deque()
+		for batch in batches:
+			in_flight.append(executor.submit(function, batch))
+			if len(in_flight) >= (workers * IN_FLIGHT_BATCHES_PER_WORKER):
+				consume(in_flight.popleft().result())
+
+		while in_flight:
+			consume(in_flight.popleft().result())
+	finally:
+		executor.shutdown(cancel_futures = True)
+
+_worker = None # (version, record crypter, lookup key or None, index key or None) in each worker, set by _initialize_worker
+
+def _initialize_worker(record_keys, index_key = None):
+	global _worker
+	version, aes_key = record_keys[:2]
+	_worker = (version, tinfoillib.make_record_crypter(*record_keys), tinfoillib.derive_lookup_key(version, aes_key), index_key)
+
+def _seal_batch(entries):
+	"""Seal (key, value) pairs as records, returning their (hashed_key, encrypted_value, iv, hmac_signature) rows,
+and their key index rows if the worker was given an index key"""
+	version, crypter, lookup_key, index_key = _worker
+
+	rows = []
+	index_rows = []
+	for key, value in entries:
+		hashed_key = tinfoillib.hash_key(lookup_key, key)
+		plaintext = tinfoillib.encode_record_plaintext(version, key.encode("utf-8"), value.encode("utf-8"))
+		iv, encrypted_value, hmac_signature = crypter.seal(plaintext, associated_data = tinfoillib.record_associated_data(version, hashed_key))
+		rows.append((hashed_key, encrypted_value, iv, hmac_signature))
+		if index_key is not None:
+			index_rows.append(tinfoillib.make_index_row(crypter, index_key, hashed_key, key))
+	return rows, index_rows
+
+def _open_batch(rows):
+	"""Open scanned record rows, returning (key name or None, value) pairs"""
+	version, crypter, lookup_key, index_key = _worker
+
+	entries = []
+	for position, hashed_key, encrypted_value, iv, hmac_signature in rows:
+		plaintext = crypter.open(iv, encrypted_value, hmac_signature, associated_data = tinfoillib.record_associated_data(version, hashed_key))
+		if plaintext is None:
+			raise AssertionError("authentication failed for the record at position " + str(position) + "!")
+
+		name, value = tinfoillib.decode_record_plaintext(version, plaintext)
+		entries.append(((name.decode("utf-8") if name is not None else None), value.decode("utf-8")))
+	return entries
+
+def entry_key(title, username):
+	"""Return the key a password manager entry is imported under: its title, followed by its username in parentheses if it has one,
+so that several accounts on one site are kept apart"""
+	if (not title) or (not username):
+		return title
+	return title + " (" + username + ")"
+
+def _csv_entries(lines):
+	reader = csv.DictReader(lines)
+	fields = set(reader.fieldnames or ())
+
+	if {"key", "value"} <= fields: # tinfoil's own export
+		key_field, username_field, value_field = "key", None, "value"
+	elif {"name", "login_password"} <= fields: # Bitwarden
+		key_field, username_field, value_field = "name", "login_username", "login_password"
+	elif {"Title", "Password"} <= fields: # KeePassXC
+		key_field, username_field, value_field = "Title", "Username", "Password"
+	elif {"Account", "Password"} <= fields: # KeePass 2
+		key_field, username_field, value_field = "Account", "Login Name", "Password"
+	else:
+		raise AssertionError("unrecognized CSV columns: " + ", ".join(reader.fieldnames or ()))
+
+	for row in reader:
+		yield entry_key(row.get(key_field), (row.get(username_field) if username_field else None)), row.get(value_field)
+
+def _json_entries(document):
+	if isinstance(document, dict) and isinstance(document.get("items"), list): # Bitwarden
+		for item in document["items"]:
+			login = item.get("login") or {}
+			yield entry_key(item.get("name"), login.get("username")), login.get("password")
+	elif isinstance(document, dict): # {key: value, ...}
+		for key, value in document.items():
+			yield key, value
+	elif isinstance(document, list): # [{"key": ..., "value": ...}, ...]
+		for item in document:
+			yield item.get("key"), item.get("value")
+	else:
+		raise AssertionError("unrecognized JSON document!")
+
+def read_entries(stream):
+	"""Yield (key, value) pairs from a text stream in any supported format, detected from its first line; value is None for entries without a password
+Entries exported by a password manager are keyed by title and username (see entry_key)
+
+CSV (tinfoil, KeePass or Bitwarden columns) and JSON Lines are parsed as they are read; other JSON documents are loaded whole"""
+	first_line = stream.readline()
+	lines = itertools.chain([first_line], stream)
+
+	if not first_line.lstrip().startswith(("{", "[")):
+		yield from _csv_entries(lines)
+		return
+
+	try:
+		first = json.loads(first_line)
+	except ValueError:
+		first = None
+
+	if isinstance(first, dict) and ("key" in first):
+		for line in lines:
+			if line.strip():
+				item = json.loads(line)
+				yield item.get("key"), item.get("value")
+	else:
+		yield from _json_entries(json.loads("".join(lines)))
+
+def import_entries(database, entries, workers = None, batch_size = DEFAULT_BATCH_SIZE, report = None):
+	"""Store (key, value) pairs from an iterable into an unlocked database, one transaction per batch, sealing them on worker processes
+
+Existing records are never overwritten
+Returns a dict counting the entries imported, those whose key already existed (or repeated within the input), and those skipped for having no key or value"""
+	if not database.check_master_keys_set():
+		raise AssertionError("master keys not yet set!")
+	if report is None:
+		report = lambda counts: None
+
+	counts = {"imported": 0, "existing": 0, "skipped": 0}
+
+	def batches():
+		batch = {}
+		for key, value in entries:
+			if (not key) or (not value):
+				counts["skipped"] += 1
+				continue
+			if key in batch:
+				counts["existing"] += 1
+				continue
+
+			batch[key] = value
+			if len(batch) >= batch_size:
+				yield list(batch.items())
+				batch = {}
+		if batch:
+			yield list(batch.items())
+
+	def commit(result):
+		rows, index_rows = result
+		with database.storage.transaction():
+			existing = database.storage.find_existing([row[0] for row in rows])
+			database.storage.insert_many([row for row in rows if row[0] not in existing])
+			if index_rows:
+				database.storage.insert_names([row for row in index_rows if row[0] not in existing])
+		counts["imported"] += len(rows) - len(existing)
+		counts["existing"] += len(existing)
+		report(counts)
+
+	index_key = database.get_index_key() if database.storage.supports_index else None
+	run_pipeline(batches(), _seal_batch, commit, workers = workers, initializer = _initialize_worker, initargs = (database.get_record_keys(), index_key))
+	return counts
+
+def export_entries(database, stream, format = "csv", workers = None, batch_size = DEFAULT_BATCH_SIZE, report = None):
+	"""Write the key and value of every record in an unlocked database to a text stream, as CSV or JSON Lines
+
+Records created before version 4 have no stored key name and are left out
+Returns a dict counting the entries exported and the records left out"""
+	if format not in EXPORT_FORMATS:
+		raise AssertionError("unknown export format '" + str(format) + "'!")
+	if not database.check_master_keys_set():
+		raise AssertionError("master keys not yet set!")
+	if report is None:
+		report = lambda counts: None
+
+	counts = {"exported": 0, "unnamed": 0}
+
+	if format == "csv":
+		writer = csv.writer(stream)
+		writer.writerow(("key", "value"))
+		write = writer.writerow
+	else:
+		write = lambda entry: stream.write(json.dumps({"key": entry[0], "value": entry[1]}) + "\n")
+
+	def consume(entries):
+		for entry in entries:
+			if entry[0] is None:
+				counts["unnamed"] += 1
+				continue
+			write(entry)
+			counts["exported"] += 1
+		report(counts)
+
+	run_pipeline(database.storage.scan(batch_size = batch_size), _open_batch, consume, workers = workers, initializer = _initialize_worker, initargs = (database.get_record_keys(), ))
+	return counts
+
+class EncryptedExportWriter(io.RawIOBase):
+	"""Binary stream that encrypts what is written to it into an export file, one chunk at a time
+
+finish() seals the last chunk; an export that is closed without it fails authentication when read back"""
+
+	def __init__(self, fileobj, passphrase, scrypt_n, scrypt_r, scrypt_p):
+		salt = cryptolib.get_random_bytes(EXPORT_SALT_SIZE)
+		self._header = EXPORT_HEADER.pack(EXPORT_MAGIC, EXPORT_FORMAT_VERSION, scrypt_n, scrypt_r, scrypt_p, salt)
+		key = cryptolib.do_scrypt_parallel(password = passphrase, salt = salt, n = scrypt_n, r = scrypt_r, p = scrypt_p, key_length = EXPORT_KEY_SIZE)
+
+		self._crypter = cryptolib.AEADRecordCrypter(key)
+		self._fileobj = fileobj
+		self._buffer = bytearray()
+		self._chunk_index = 0
+
+		self._fileobj.write(self._header)
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		self._buffer += data
+		while len(self._buffer) > EXPORT_CHUNK_SIZE: # never empty the buffer here, so the final chunk is known to hold data
+			self._write_chunk(bytes(self._buffer[:EXPORT_CHUNK_SIZE]), False)
+			del self._buffer[:EXPORT_CHUNK_SIZE]
+		return len(data)
+
+	def _write_chunk(self, chunk, final):
+		nonce, ciphertext, tag = self._crypter.seal(chunk, associated_data = (self._header + EXPORT_CHUNK_POSITION.pack(self._chunk_index, final)))
+		self._fileobj.write(EXPORT_CHUNK_LENGTH.pack(len(ciphertext)) + nonce + ciphertext + tag)
+		self._chunk_index += 1
+
+	def finish(self):
+		self._write_chunk(bytes(self._buffer), True)
+		self._buffer = bytearray()
+		self._fileobj.flush()
+
+class EncryptedExportReader(io.RawIOBase):
+	"""Binary stream of the plaintext of an export written by EncryptedExportWriter, decrypted one chunk at a time
+
+Raises AssertionError on a wrong passphrase, or if the export was tampered with or truncated"""
+
+	def __init__(self, fileobj, passphrase):
+		header = fileobj.read(EXPORT_HEADER.size)
+		if len(header) != EXPORT_HEADER.size:
+			raise AssertionError("not a tinfoil export!")
+		magic, format_version, scrypt_n, scrypt_r, scrypt_p, salt = EXPORT_HEADER.unpack(header)
+		if magic != EXPORT_MAGIC:
+			raise AssertionError("not a tinfoil export!")
+		if format_version != EXPORT_FORMAT_VERSION:
+			raise AssertionError("export format version mismatch! expected '" + str(EXPORT_FORMAT_VERSION) + "', got '" + str(format_version) + "'")
+
+		key = cryptolib.do_scrypt_parallel(password = passphrase, salt = salt, n = scrypt_n, r = scrypt_r, p = scrypt_p, key_length = EXPORT_KEY_SIZE)
+		self._crypter = cryptolib.AEADRecordCrypter(key)
+		self._header = header
+		self._fileobj = fileobj
+		self._chunk = b""
+		self._offset = 0
+		self._chunk_index = 0
+		self._finished = False
+
+	def readable(self):
+		return True
+
+	def _read_chunk(self):
+		length = self._fileobj.read(EXPORT_CHUNK_LENGTH.size)
+		if len(length) != EXPORT_CHUNK_LENGTH.size:
+			raise AssertionError("export is truncated!")
+		body_length = cryptolib.AEAD_NONCE_SIZE + EXPORT_CHUNK_LENGTH.unpack(length)[0] + cryptolib.AEAD_TAG_SIZE
+		body = self._fileobj.read(body_length)
+		if len(body) != body_length:
+			raise AssertionError("export is truncated!")
+
+		nonce, ciphertext, tag = body[:cryptolib.AEAD_NONCE_SIZE], body[cryptolib.AEAD_NONCE_SIZE:-cryptolib.AEAD_TAG_SIZE], body[-cryptolib.AEAD_TAG_SIZE:]
+		for final in (False, True): # the flag is only known once the chunk authenticates
+			chunk = self._crypter.open(nonce, ciphertext, tag, associated_data = (self._header + EXPORT_CHUNK_POSITION.pack(self._chunk_index, final)))
+			if chunk is not None:
+				break
+		else:
+			raise AssertionError("export failed authentication! (wrong passphrase, or the file was modified)")
+
+		if final:
+			self._finished = True
+			if self._fileobj.read(1):
+				raise AssertionError("export has data after its final chunk!")
+
+		self._chunk = chunk
+		self._offset = 0
+		self._chunk_index += 1
+
+	def readinto(self, buffer):
+		while (self._offset == len(self._chunk)) and not self._finished:
+			self._read_chunk()
+
+		count = min(len(buffer), len(self._chunk) - self._offset)
+		buffer[:count] = self._chunk[self._offset:(self._offset + count)]
+		self._offset += count
+		return count
+
+def is_encrypted_export(path):
+	with open(path, "rb") as f:
+		return (f.read(len(EXPORT_MAGIC)) == EXPORT_MAGIC)
+
+def import_file(database, path, passphrase = None, **kwargs):
+	"""Import a CSV or JSON file, or an encrypted export (which needs its passphrase); see import_entries
+
+An encrypted export that fails authentication part way through leaves the batches before the failure imported"""
+	with open(path, "rb") as f:
+		if f.read(len(EXPORT_MAGIC)) == EXPORT_MAGIC:
+			if passphrase is None:
+				raise AssertionError("'" + path + "' is an encrypted export; a passphrase is required!")
+			f.seek(0)
+			raw = io.BufferedReader(EncryptedExportReader(f, passphrase))
+		else:
+			f.seek(0)
+			raw = f
+
+		stream = io.TextIOWrapper(raw, encoding = "utf-8-sig", newline = "") # exports from other managers often start with a BOM
+		return import_entries(database, read_entries(stream), **kwargs)
+
+def export_file(database, path, passphrase = None, format = "csv", **kwargs):
+	"""Export every named record to a new file, encrypted under passphrase unless it is None; see export_entries
+
+The export's passphrase is strengthened with the database's own scrypt parameters"""
+	descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+	try:
+		with os.fdopen(descriptor, "wb") as f:
+			writer = None
+			raw = f
+			if passphrase is not None:
+				kdf_parameters = database.get_kdf_parameters()
+				writer = EncryptedExportWriter(f, passphrase, kdf_parameters["n"], kdf_parameters["r"], kdf_parameters["p"])
+				raw = io.BufferedWriter(writer, buffer_size = EXPORT_CHUNK_SIZE)
+
+			stream = io.TextIOWrapper(raw, encoding = "utf-8", newline = "")
+			counts = export_entries(database, stream, format = format, **kwargs)
+			stream.flush()
+			if writer is not None:
+				writer.finish()
+			stream.detach() # f is closed by the with block
+	except BaseException:
+		os.unlink(path) # created above, so it is this export's partial output
+		raise
+	return counts